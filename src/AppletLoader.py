@@ -8,6 +8,7 @@ import urlparse
 from Tkinter import *
 from BaseReader import BaseReader
 from Bastion import Bastion
+import grailutil
 
 
 # Pattern for valid CODE attribute; group(2) extracts module name
@@ -169,7 +170,8 @@ class AppletLoader:
         else:
             # Asynchronous loading
             self.parent = self.make_parent()
-            api = self.app.open_url(self.codeurl, 'GET', {}, self.reload)
+            params = {'.priority': grailutil.PRIORITY_INLINE}
+            api = self.app.open_url(self.codeurl, 'GET', params, self.reload)
             ModuleReader(self.context, api, self)
 
     def make_parent(self):
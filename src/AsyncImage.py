@@ -83,7 +83,7 @@ class BaseAsyncImage:
         self.url = url
         self.reader = None
         self.loaded = 0
-        self.headers = {}
+        self.headers = {'.priority': grailutil.PRIORITY_INLINE}
         if reload:
             self.reload = 1
         else:
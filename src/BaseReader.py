@@ -51,10 +51,11 @@ class BaseReader:
         self.killed = None
 
         # Only http_access has delayed startup property.
-        # Second argument would allow implementation of persistent
-        # connections.
+        # The second argument lets the api call us when there is
+        # something to read without the file becoming readable, as at
+        # the end of a response on a persistent connection.
         try:
-            self.api.register_reader(self.start, self.checkapi)
+            self.api.register_reader(self.start, self.wakeup)
         except AttributeError:
             # if the protocol doesn't do that
             ok = 0
@@ -68,11 +69,17 @@ class BaseReader:
 
     def start(self):
         # when the protocol API is ready to go, it tells the reader
-        # to get busy
+        # to get busy; it tells it again when it moves on to another
+        # connection (see httpAPI's resend())
         self.message = "awaiting server response"
-        if self.killed:
-            print "start() called after a kill"
+        if self.killed or not self.api:
+            # stopped meanwhile
             return
+        polling = self.fno is not None and self.fno < 0
+        if self.fno >= 0:
+            fno = self.fno
+            self.fno = -1
+            self.context.app.root.deletefilehandler(fno)
         self.fno = self.api.fileno()
         if TkVersion == 4.0 and sys.platform == 'irix5':
             if self.fno >= 20: self.fno = -1 # XXX for SGI Tk OPEN_MAX bug
@@ -80,7 +87,7 @@ class BaseReader:
         if self.fno >= 0:
             self.context.app.root.createfilehandler(
                 self.fno, tkinter.READABLE, self.checkapi)
-        else:
+        elif not polling:
             # No fileno() -- check every 100 ms
             self.checkapi_regularly()
 
@@ -154,12 +161,22 @@ class BaseReader:
         if not self.callback:
 ##          print "*** checkapi_regularly -- too late ***"
             return
+        if self.fno >= 0:
+            # started again, with a file to watch
+            return
         self.callback()
         if self.callback:
             sleeptime = self.sleeptime
             if self.poller and self.poller()[1]: sleeptime = 0
             self.context.root.after(sleeptime, self.checkapi_regularly)
 
+    def wakeup(self):
+        # the api has something for us that doesn't make the file
+        # readable, e.g. the end of a response on a kept-alive
+        # connection
+        if self.callback:
+            self.checkapi()
+
     def checkapi(self, *args):
         if not self.callback:
             print "*** checkapi -- too late ***"
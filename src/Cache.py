@@ -7,16 +7,45 @@ XXX To do
   even if the cache decides against it)
 """
 
+# To benchmark, "(cd <scriptdir>; python Cache.py -b)".
+
+import sys
+if __name__ == '__main__':
+    sys.path.insert(0, 'utils')
+
 META, DATA, DONE = 'META', 'DATA', 'DONE' # Three stages
 
 SharedItemExpired = 'SharedItem Expired'
 
 from Assert import Assert
+from chunkbuffer import ChunkBuffer
 import os
 import protocols
+import string
 import time
 import copy
 
+def parse_content_range(value):
+    """Return (first, last, length) from a Content-Range header value.
+
+    length is -1 if the server gave '*'; None is returned for anything
+    but a single byte range.
+    """
+    try:
+        unit, spec = string.split(string.strip(value), None, 1)
+        range, length = string.splitfields(spec, '/')
+        first, last = string.splitfields(range, '-')
+        first, last = string.atoi(first), string.atoi(last)
+        if string.strip(length) == '*':
+            length = -1
+        else:
+            length = string.atoi(length)
+    except ValueError:
+        return None
+    if string.lower(unit) != 'bytes' or first > last:
+        return None
+    return first, last, length
+
 class SharedItem:
 
     """A shareable cache item.
@@ -24,18 +53,34 @@ class SharedItem:
     The interface is subtly different from that of protocol objects:
     getdata() takes an offset argument, and the sequencing
     restrictions are lifted (i.e. you can call anything in any order).
+    The data read so far is kept in a SpoolFile in the disk cache, or
+    in a ChunkBuffer if it can't be spooled (e.g. for a POST), so a
+    reader at any offset is served without a scan.
 
     A SharedItem hides all protocol access from the rest of the
     system. The reset() method actually calls on the protocol to
     retrieve an object.
 
+    A spooled body is written to disk as it arrives and never held in
+    memory.  When it is complete the cache renames the spool file into
+    place (see DiskCache.make_file()); a body bigger than the size limit
+    for cached objects stays a temporary file.  If the last reader goes
+    away before the end, the part read so far is kept in the cache as a
+    partial entry.  The next load of the URL asks only for the rest of
+    the body (see resume()); resumed is the number of bytes that came
+    from the partial entry.
+
     The disk cache passes an disk_cache_access api which sets some
-    basic headers and starts the object out in the DATA state.
+    basic headers and starts the object out in the DATA state. If the
+    api can memory-map the cached file, getdata() slices the map at
+    the requested offset instead of reading the file into self.data;
+    every reader of the item shares the one map.
 
     """
 
     def __init__(self, url, mode, params, cache, key, data=None,
-                 api=None, reload=None, refresh=None):  
+                 api=None, reload=None, refresh=None, etag=None,
+                 resume=None):
         self.refcnt = 0
 
         # store the arguments 
@@ -48,12 +93,15 @@ class SharedItem:
 
         # status
         self.reloading = 0
-        self.data = []
+        self.data = ChunkBuffer()
         self.datalen = 0
-        self.datamap = {}
         self.complete = 0
+        self.mapped = None
+        self.spool = None
+        self.resumed = 0
+        self.readers = []               # (start, callback), see resume()
 
-        # initialize in one of four states
+        # initialize in one of five states
         # some variables may be initialized in reset or refresh
 
         if reload:               ## forced reload
@@ -67,7 +115,11 @@ class SharedItem:
             self.cache_meta = api.getmeta()
             self.cache_stage = api.state
             self.incache = 1
-            self.refresh(refresh)
+            self.refresh(refresh, etag)
+
+        elif resume:             ## continue a partial body
+            self.incache = 0
+            self.resume(api, resume)
 
         elif api == None:        ## a POST
             self.incache = 0
@@ -78,6 +130,7 @@ class SharedItem:
             self.api = api
             self.meta = api.getmeta()
             self.stage = self.api.state
+            self.map_cached_data()
 
             # status
             self.incache = 1
@@ -109,7 +162,10 @@ class SharedItem:
             if self.stage == DONE:
                 self.finish()
             else:
+                self.save_partial()
                 self.abort()
+            self.mapped = None
+            self.discard_spool()
 
     def cache_update(self):
         if (self.incache == 0 or self.reloading == 1) \
@@ -118,6 +174,15 @@ class SharedItem:
             self.cache.add(self,self.reloading)
             self.incache = 1
 
+    def promote(self, priority):
+        """Hurry up the load for a reader that waits at priority."""
+        try:
+            promote = self.api.promote
+        except AttributeError:
+            # loaded already, or not over http
+            return
+        promote(priority)
+
     def pollmeta(self):
         if self.stage == META:
             return self.api.pollmeta()
@@ -132,9 +197,13 @@ class SharedItem:
             self.stage = DATA
         return self.meta
 
+    def register_reader(self, reader_start, reader_callback):
+        self.api.register_reader(reader_start, reader_callback)
+        self.readers.append((reader_start, reader_callback))
+
     def polldata(self):
         if self.stage == META:
-            msg, ready = self.api.pollmeta()
+            msg, ready = self.pollmeta()
             if ready:
                 self.getmeta()
                 msg, ready = self.api.polldata()
@@ -144,45 +213,42 @@ class SharedItem:
             msg, ready = "Reading cache", 1
         return msg, ready
 
+    def map_cached_data(self):
+        """Serve the data from a memory map of the cached file if possible."""
+        try:
+            getmap = self.api.getmap
+        except AttributeError:
+            return
+        self.mapped = getmap()
+        if self.mapped is not None:
+            self.datalen = len(self.mapped)
+
     def getdata(self, offset, maxbytes):
         Assert(offset >= 0)
         Assert(maxbytes > 0)
 
+        if self.mapped is not None:
+            if offset >= self.datalen and not self.complete:
+                self.complete = 1
+                self.finish()
+            return self.mapped[offset:offset+maxbytes]
+
         while self.stage == DATA and offset >= self.datalen:
             buf = self.api.getdata(maxbytes)
             if not buf:
                 self.finish()
                 self.complete = 1
             else:
-                l = len(buf)
-                if l > maxbytes:
-                    # we got more than we wanted,
-                    # so split into two strings (avoid search next time)
-                    self.data.append(buf[:maxbytes])
-                    self.datamap[offset] = len(self.data) - 1
-                    self.data.append(buf[maxbytes:])
-                    self.datamap[offset+maxbytes] = len(self.data) - 1
-                else:
-                    self.data.append(buf)
-                    self.datamap[offset] = len(self.data) - 1
-                self.datalen = self.datalen + l
+                self.store_data(buf)
 
-        try:
-            # the common case
-            chunk = self.data[self.datamap[offset]]
-            if len(chunk) > maxbytes:
-                return chunk[0:maxbytes]
-            else:
-                return chunk
-        except KeyError:
-            if self.stage == META:
-                self.meta = self.api.getmeta()
-                self.stage = DATA
-            elif self.complete == 1 and offset >= self.datalen:
-                return ''
-            chunk_key, delta = self._getdata_search_string_list(offset)
-            chunk = self.data[self.datamap[chunk_key]]
-            return chunk[delta:]
+        if offset < self.datalen:
+            if self.spool:
+                return self.spool.read(offset, maxbytes)
+            return self.data.read(offset, maxbytes)
+        if self.stage == META:
+            self.getmeta()
+            return self.getdata(offset, maxbytes)
+        return ''
 
     def fileno(self):
         if self.api:
@@ -194,8 +260,9 @@ class SharedItem:
         self.finish()
 
     def finish(self):
+        self.readers = []
         if self.cache:
-            self.cache.deactivate(self.key)
+            self.cache.deactivate(self.key, self)
             if not (self.meta and self.meta[0] == 200):
                 self.cache.delete(self.key)
         self.stage = DONE
@@ -204,48 +271,87 @@ class SharedItem:
         if api:
             api.close()
 
-    def _getdata_search_string_list(self, offset):
-        ### WARNING: this lookup is costly, please avoid
-        ###          cost is O(k), where k is # of chunks
-        ###          if you use this a lot, you'll get O(N^2) reads
-        delta = offset
-        chunk_key = None
-        for chunk_offset in self.datamap.keys():
-            if offset > chunk_offset:
-                diff = offset - chunk_offset
-                if diff <= delta:
-                    delta = diff
-                    chunk_key = chunk_offset
-        return chunk_key, delta
-
     def init_new_load(self,stage):
         self.meta = None
-        self.data = []
+        self.data = ChunkBuffer()
         self.datalen = 0
-        self.datamap = {}
         self.stage = stage
         self.complete = 0
-
-    def refresh(self,when):
+        self.discard_spool()
+        if self.cache and not self.postdata:
+            self.spool = self.cache.open_spool()
+
+    def store_data(self, buf):
+        spool = self.spool
+        self.datalen = self.datalen + len(buf)
+        if not spool:
+            self.data.append(buf)
+            return
+        try:
+            spool.write(buf)
+        except IOError:
+            # the disk is full or gone; carry on in memory
+            error = sys.exc_info()
+            self.data = ChunkBuffer()
+            try:
+                self.data.append(spool.read(0, spool.size))
+            except IOError:
+                pass
+            self.data.append(buf)
+            if len(self.data) != self.datalen:
+                # the write error, not one from reading back
+                raise error[0], error[1], error[2]
+            self.discard_spool()
+            return
+        if self.datalen > self.cache.partial_size_limit():
+            # too big to keep, it only serves our readers now
+            spool.cacheable = 0
+
+    def save_partial(self):
+        """Keep what was loaded of an unfinished body in the cache."""
+        if self.spool and self.spool.cacheable and self.datalen \
+           and self.cache and not self.postdata and not self.complete \
+           and self.meta and self.meta[0] == 200:
+            self.cache.add_partial(self)
+
+    def discard_spool(self):
+        spool = self.spool
+        self.spool = None
+        if spool:
+            spool.discard()
+
+    def refresh(self, when, etag=None):
         params = copy.copy(self.params)
         params['If-Modified-Since'] = when.get_str()
+        if etag:
+            # takes precedence over If-Modified-Since on the server
+            params['If-None-Match'] = etag
         self.api = protocols.protocol_access(self.url,
                                              self.mode, params,
                                              data=self.postdata)
         self.meta = None
-        self.stage = self.api.state
+        # like reset(), so pollmeta() waits for the response instead
+        # of leaving getmeta() to block on it
+        self.stage = META
         self.hidden_getmeta = self.getmeta
         self.getmeta = self.refresh_getmeta
 
     def refresh_getmeta(self):
         self.meta = self.api.getmeta()
+        if self.cache:
+            self.cache.refreshed(self, self.meta[0])
         ### which errcode should I try to handle
         if self.meta[0] == 304:
             # we win! it hasn't been modified
-            # but we probably need to delete the api object
+            # but we probably need to delete the api object; read its
+            # (empty) body to the end first, so a kept-alive
+            # connection goes back to the pool instead of being dropped
+            while self.api.getdata(1024):
+                pass
             self.api.close()
             self.api = self.cache_api
             self.meta = self.api.getmeta()
+            self.map_cached_data()
         #elif errcode == 200:
             # there may be cases when we get an error response that
             # doesn't require us to delete the object (a server busy
@@ -254,8 +360,87 @@ class SharedItem:
             # forget about the cached stuff
             self.cache_api.close()
             self.reloading = 1
+            if self.cache:
+                self.spool = self.cache.open_spool()
+
+        self.getmeta = self.hidden_getmeta
+        self.stage = DATA
+        return self.meta
+
+    def resume(self, api, validator):
+        """Ask for the part of the body after the partial one api reads.
 
+        The request carries Range and If-Range headers, so a server
+        whose copy still matches validator sends just the rest (206)
+        and any other sends the whole body (200) as usual.
+        """
+        self.cache_api = api
+        self.resume_offset = string.atoi(api.getmeta()[2]['content-length'])
+        params = copy.copy(self.params)
+        params['Range'] = 'bytes=%d-' % self.resume_offset
+        params['If-Range'] = validator
+        self.api = protocols.protocol_access(self.url,
+                                             self.mode, params,
+                                             data=self.postdata)
+        self.init_new_load(META)
+        self.hidden_getmeta = self.getmeta
+        self.getmeta = self.resume_getmeta
+        self.hidden_pollmeta = self.pollmeta
+        self.pollmeta = self.resume_pollmeta
+
+    def resume_pollmeta(self):
+        msg, ready = self.api.pollmeta()
+        if ready:
+            # look at the response now, so that a server that sends
+            # the wrong range doesn't leave getmeta() to start over
+            # and block
+            self.pollmeta = self.hidden_pollmeta
+            if not self.resume_getmeta(wait=0):
+                return self.pollmeta()
+        return msg, ready
+
+    def resume_getmeta(self, wait=1):
         self.getmeta = self.hidden_getmeta
+        self.pollmeta = self.hidden_pollmeta
+        self.meta = self.api.getmeta()
+        cache_api = self.cache_api
+        self.cache_api = None
+        errcode, errmsg, headers = self.meta
+        if errcode != 206:
+            # the whole body, or an error that finish() will clear
+            # the partial entry for
+            cache_api.close()
+            self.stage = DATA
+            return self.meta
+        range = None
+        if headers.has_key('content-range'):
+            range = parse_content_range(headers['content-range'])
+        if not range or range[0] != self.resume_offset:
+            # not what we asked for; start over without the range
+            cache_api.close()
+            self.api.close()
+            self.reset()
+            for reader_start, reader_callback in self.readers:
+                self.api.register_reader(reader_start, reader_callback)
+                # off the old connection until the new one is ready
+                reader_start()
+            if wait:
+                return self.getmeta()
+            return None
+        while 1:
+            buf = cache_api.getdata(8192)
+            if not buf:
+                break
+            self.store_data(buf)
+        cache_api.close()
+        self.resumed = self.datalen
+        # readers see the whole body, as if it were loaded in one go
+        del headers['content-range']
+        if range[2] >= 0:
+            headers['content-length'] = str(range[2])
+        elif headers.has_key('content-length'):
+            del headers['content-length']
+        self.meta = 200, "OK", headers
         self.stage = DATA
         return self.meta
 
@@ -319,8 +504,25 @@ class SharedAPI:
                     self.fno = -1
         return self.fno
 
+    def resumed(self):
+        """Return the number of bytes taken from a partial cache entry."""
+        if self.item:
+            return self.item.resumed
+        return 0
+
     def register_reader(self, reader_start, reader_callback):
-        self.item.api.register_reader(reader_start, reader_callback)
+        self.reader_start = reader_start
+        self.item.register_reader(self.start_reader, reader_callback)
+
+    def start_reader(self):
+        # the api may have moved to another connection since the last
+        # start, so the reader gets a new dup; the old one is closed
+        # only after the reader has stopped watching it
+        fno = self.fno
+        self.fno = -1
+        self.reader_start()
+        if fno >= 0:
+            os.close(fno)
 
     def tk_img_access(self):
         if hasattr(self.item.api, 'tk_img_access'):
@@ -366,5 +568,47 @@ def test():
         api.close()
 
 
+def benchmark(nbytes=4*1024*1024, bufsizes=(512, 300, 1000, 77, 4096)):
+    """Time concurrent readers of one SharedItem at misaligned offsets.
+
+    One reader per entry in bufsizes reads the same item in round
+    robin; the protocol object delivers the body in 512 byte chunks.
+    """
+    class api:
+        state = DATA
+        def __init__(self, nbytes):
+            self.left = nbytes
+        def getmeta(self):
+            return 200, "OK", {}
+        def getdata(self, maxbytes):
+            n = min(512, self.left)
+            self.left = self.left - n
+            return 'x' * n
+        def close(self):
+            pass
+
+    item = SharedItem('bench:', 'GET', {}, None, 'bench:', api=api(nbytes))
+    readers = []
+    for bufsize in bufsizes:
+        reader = SharedAPI(item)
+        reader.getmeta()
+        readers.append((reader, bufsize))
+    t0 = time.time()
+    total = 0
+    while readers:
+        for pair in readers[:]:
+            reader, bufsize = pair
+            data = reader.getdata(bufsize)
+            if not data:
+                readers.remove(pair)
+            total = total + len(data)
+    t1 = time.time()
+    print "%d readers read %d bytes in %.2f sec" % (len(bufsizes), total,
+                                                    t1 - t0)
+
+
 if __name__ == '__main__':
-    test()
+    if sys.argv[1:] == ['-b']:
+        benchmark()
+    else:
+        test()
@@ -1,5 +1,16 @@
+"""Cache manager and persistent disk cache."""
+
+# To benchmark, "(cd <scriptdir>; python CacheMgr.py benchmark)".
+
+import sys
+if __name__ == '__main__':
+    sys.path.insert(0, 'utils')
+
 from Cache import SharedItem, SharedAPI
 from Assert import Assert
+from lrulist import LRUList
+from expiryqueue import ExpiryQueue
+import CachePolicy
 import urlparse
 import string
 import os
@@ -8,6 +19,21 @@ import ht_time
 import grailutil
 import mimetypes
 import re
+import copy
+import errno
+import struct
+import stat
+import md5
+
+try:
+    import mmap
+except ImportError:
+    mmap = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 META, DATA, DONE = 'META', 'DATA', 'DONE' # Three stages
 
@@ -39,6 +65,99 @@ def parse_cache_control(s):
     elts = string.splitfields(s, ',')
     return map(parse_directive, elts)
 
+def parse_freshness(headers):
+    """Return (max-age, stale-while-revalidate) from Cache-Control.
+
+    Both are in seconds, or None if the response doesn't give them.
+    """
+    max_age = swr = None
+    if headers.has_key('cache-control'):
+        for k, v in parse_cache_control(headers['cache-control']):
+            k = string.lower(string.strip(k))
+            try:
+                v = string.atoi(string.strip(v))
+            except ValueError:
+                continue
+            if k == 'max-age':
+                max_age = v
+            elif k == 'stale-while-revalidate':
+                swr = v
+    return max_age, swr
+
+def parse_vary(headers):
+    """Return the sorted, lowercased header names in Vary, or None."""
+    if not headers.has_key('vary'):
+        return None
+    names = []
+    for name in string.splitfields(headers['vary'], ','):
+        name = string.lower(string.strip(name))
+        if name and name not in names:
+            names.append(name)
+    names.sort()
+    return names or None
+
+def resume_validator(etag, lastmod):
+    """Return the If-Range value for a partial body, or None.
+
+    A weak ETag can't be used for a range request, so the strong ETag
+    is preferred, then the Last-Modified date (a string or HTTime).
+    """
+    if etag and etag[:2] != 'W/':
+        return etag
+    if lastmod:
+        if type(lastmod) != type(''):
+            lastmod = lastmod.get_str()
+        return lastmod
+    return None
+
+class CacheStats:
+    """Counters describing how the cache is used.
+
+    count(name, n=1) adds n to the named counter; counters start at
+    zero.  The CacheManager keeps these:
+
+    requests -- GET requests for URLs of cacheable schemes
+    hits -- requests served from the cache without asking the server
+    validations -- requests for stale pages, checked with the server
+    validated-hits -- validations answered 304, served from the cache
+    not-modified, modified -- conditional requests (including
+        background ones) answered 304 and otherwise
+    background-revalidations -- stale pages served at once and then
+        checked in the background
+    reloads -- requests that bypassed the cache
+    resumes -- requests continuing a partial body
+    misses -- requests not in the cache at all
+    hit-bytes -- bytes of the pages served from the cache
+    loads, load-bytes -- pages, and their bytes, loaded completely
+        from the network
+    too-big -- loaded pages bigger than the largest cacheable object
+    evictions, evicted-bytes -- entries removed from the disk cache
+    policy-evictions, policy-evicted-bytes -- of those, the ones the
+        replacement policy chose to make room for new pages
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.counters = {}
+        self.since = time.time()
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def get(self, name):
+        return self.counters.get(name, 0)
+
+    def get_stats(self):
+        """Return a dictionary of the counters, and the time since."""
+        stats = self.counters.copy()
+        stats['since'] = self.since
+        return stats
+
+# results of CacheManager.check_freshness()
+FRESH, STALE, REVALIDATE = 'fresh', 'stale', 'revalidate'
+
 class CacheManager:
     """Manages one or more caches in hierarchy.
 
@@ -66,6 +185,26 @@ class CacheManager:
     tests are preference driven, can be never, per session, or per
     time-unit. on each open, check to see if we should send an
     If-Mod-Since to the original server (based on fresh_p method).
+    an explicit Cache-Control max-age from the server overrides the
+    preference. a stale page may be served at once and revalidated in
+    the background (see Revalidator) if the server allows it with
+    stale-while-revalidate, or for every page if the
+    revalidate-in-background preference is set.
+
+    variants: when a response has a Vary header, it is cached under
+    its URL key plus the values of the varying request headers, e.g.
+    'http://host/page#accept-language=en'. url2key() never leaves a
+    '#' in a key, so variants sit side by side with each other and
+    never clash with a plain key. vary maps a URL key to the header
+    names its last response varied on, so open() can find the
+    variant for a request before anything is fetched.
+
+    memory: a MemoryCache of small cached bodies that are read again
+    and again (style sheets, icons, dingbats). cache_read() serves
+    them without opening the file in the disk cache.
+
+    stats: a CacheStats counting hits, misses, revalidations and
+    evictions; get_stats() adds the state of the caches to them.
 
     """
     
@@ -78,11 +217,20 @@ class CacheManager:
         self.caches = []
         self.items = {}
         self.active = {}
+        self.revalidating = {}
+        self.vary = {}
         self.disk = None
         self.disk = DiskCache(self, self.app.prefs.GetInt('disk-cache',
                                                      'size') * 1024,
-                         self.app.prefs.Get('disk-cache', 'directory'))
+                         self.app.prefs.Get('disk-cache', 'directory'),
+                         self.app.prefs.Get('disk-cache',
+                                            'replacement-policy'),
+                         self.app.prefs.GetBoolean('disk-cache', 'shared'))
+        self.memory = MemoryCache(0)
+        self.stats = CacheStats()
         self.set_freshness_test()
+        self.set_max_object_size()
+        self.set_memory_size()
         self.app.prefs.AddGroupCallback('disk-cache', self.update_prefs)
 
         # check preferences
@@ -96,15 +244,22 @@ class CacheManager:
 
     def update_prefs(self):
         self.set_freshness_test()
+        self.set_max_object_size()
+        self.set_memory_size()
         size = self.caches[0].max_size = self.app.prefs.GetInt('disk-cache',
                                                                'size') \
                                                                * 1024
+        policy = self.app.prefs.Get('disk-cache', 'replacement-policy')
+        if policy != self.disk.policy_name:
+            self.disk.set_policy(policy)
         new_dir = self.app.prefs.Get('disk-cache', 'directory')
-        if new_dir != self.disk.pref_dir:
+        shared = self.app.prefs.GetBoolean('disk-cache', 'shared')
+        if new_dir != self.disk.pref_dir or shared != self.disk.shared:
             self.disk._checkpoint_metadata()
-            self.reset_disk_cache(size, new_dir)
+            self.reset_disk_cache(size, new_dir, shared=shared)
 
-    def reset_disk_cache(self, size=None, dir=None, flush_log=0):
+    def reset_disk_cache(self, size=None, dir=None, flush_log=0,
+                         shared=None):
         """Close the current disk cache and open a new one.
 
         Used primarily to change the cache directory or to clear
@@ -118,20 +273,58 @@ class CacheManager:
             size = self.disk.max_size
         if not dir:
             dir = self.disk.directory
+        if shared is None:
+            shared = self.disk.shared
+        policy = self.disk.policy_name
         self.disk.close(flush_log)
-        self.disk = DiskCache(self, size, dir)
-        
+        self.memory.clear()
+        self.disk = DiskCache(self, size, dir, policy, shared)
+
+    def set_memory_size(self):
+        self.memory.set_max_size(self.app.prefs.GetInt(
+            'disk-cache', 'memory-size') * 1024)
+
+    def set_max_object_size(self):
+        self.max_object_size = self.app.prefs.GetInt(
+            'disk-cache', 'max-object-size') * 1024
+
+    def object_size_limit(self):
+        """Return the size of the largest object that may be cached."""
+        if not self.caches:
+            return 0
+        return min(self.max_object_size, self.caches[0].max_size)
+
+    def partial_size_limit(self):
+        """Return the size of the largest partial body that may be kept.
+
+        Partial bodies are what make a stopped download resumable, so
+        they may be as big as the cache, not only as big as the objects
+        it keeps.
+        """
+        if not self.caches:
+            return 0
+        return self.caches[0].max_size
+
+    def open_spool(self):
+        """Return a SpoolFile in the disk cache, or None."""
+        if self.caches:
+            return self.caches[0].open_spool()
+        return None
+
     def set_freshness_test(self):
         # read preferences to determine when pages should be checked
         # for freshness -- once per session, every n secs, or never
         fresh_type = self.app.prefs.Get('disk-cache', 'freshness-test-type')
         fresh_rate = int(self.app.prefs.GetFloat('disk-cache', 
                                              'freshness-test-period') * 3600.0)
+        self.fresh_type = fresh_type
+        self.background_revalidate = self.app.prefs.GetBoolean(
+            'disk-cache', 'revalidate-in-background')
 
-        if fresh_type == 'per session':
+        if fresh_type in ('per session', 'once'):
             self.fresh_p = lambda key, self=self: \
                            self.fresh_every_session(self.items[key])
-            self.session_freshen = []
+            self.session_freshen = {}
         elif fresh_type == 'periodic':
             self.fresh_p = lambda key, self=self, t=fresh_rate: \
                            self.fresh_periodic(self.items[key],t)  
@@ -145,16 +338,22 @@ class CacheManager:
 
         This is the method called by the Application to load a
         URL. First, it checks the shared object list (and returns a
-        second reference to a URL that is currently active). Then it
+        second reference to a URL that is currently active, giving its
+        load the priority of the new request if that is better). Then it
         calls open routines specialized for GET or POST.
         """
 
         key = self.url2key(url, mode, params)
         if mode == 'GET':
+            if self.vary.has_key(key):
+                key = self.variant_key(key, self.vary[key], params)
             if self.active.has_key(key):
                 # XXX This appeared to be a bad idea!
 ##              if reload:
 ##                  self.active[key].reset()
+                # the item may be a prefetch still waiting for a socket
+                self.active[key].promote(
+                    params.get('.priority', grailutil.PRIORITY_DOCUMENT))
                 return SharedAPI(self.active[key])
             return self.open_get(key, url, mode, params, reload, data)
         elif mode == 'POST':
@@ -168,14 +367,23 @@ class CacheManager:
         2. If it is in the cache,
               1. Create a SharedItem for it.
               2. Reload the cached copy if reload flag is on.
-              3. Refresh the page if the freshness test fails.
+              3. Refresh the page if the freshness test fails,
+                 or serve it and refresh it in the background if
+                 that is allowed.
            If it isn't in the cache,
               1. Create a SharedItem (which will create a CacheEntry 
               after the page has been loaded.)
+              2. If only the beginning of it is in the cache, ask
+                 for the rest (see SharedItem.resume()).
         3. call activate(), which adds the URL to the shared object
         list and creates a SharedAPI for the item
         """
 
+        if self.cacheable_url_p(url):
+            count = self.stats.count
+        else:
+            count = self.count_nothing
+        count('requests')
         try:
             api = self.cache_read(key)
         except CacheReadFailed, cache:
@@ -187,19 +395,56 @@ class CacheManager:
                 item = SharedItem(url, mode, params, self, key, data, api,
                                  reload=reload)
                 self.touch(key)
-            elif not self.fresh_p(key):
-                item = SharedItem(url, mode, params, self, key, data, api,
-                                 refresh=self.items[key].lastmod)
-                self.touch(key,refresh=1)
+                count('reloads')
             else:
-                item = SharedItem(url, mode, params, self, key, data, api)
+                freshness = self.check_freshness(key)
+                if freshness == STALE:
+                    entry = self.items[key]
+                    item = SharedItem(url, mode, params, self, key, data,
+                                      api, refresh=entry.lastmod,
+                                      etag=entry.etag)
+                    self.touch(key,refresh=1)
+                    count('validations')
+                else:
+                    item = SharedItem(url, mode, params, self, key, data,
+                                      api)
+                    count('hits')
+                    count('hit-bytes', self.items[key].size)
+                    if freshness == REVALIDATE:
+                        self.revalidate(key, url, params)
+                        count('background-revalidations')
                 
         else:
-            # cause item to be loaded (and perhaps cached)
-            item = SharedItem(url, mode, params, self, key, data)
+            item = None
+            if not reload and self.items.has_key(key) \
+               and self.items[key].partial is not None:
+                item = self.resume_partial(key, url, mode, params, data)
+            if item:
+                count('resumes')
+            else:
+                # cause item to be loaded (and perhaps cached)
+                item = SharedItem(url, mode, params, self, key, data)
+                count('misses')
 
         return self.activate(item)
 
+    def resume_partial(self, key, url, mode, params, data):
+        """Return a SharedItem loading the rest of a partial entry.
+
+        Returns None if the entry can't be used.
+        """
+        entry = self.items[key]
+        validator = resume_validator(entry.etag, entry.lastmod)
+        if not validator:
+            return None
+        try:
+            api = entry.get()
+        except CacheReadFailed, cache:
+            cache.evict(key)
+            return None
+        return SharedItem(url, mode, params, self, key, data, api,
+                          resume=validator)
+
     def open_post(self, key, url, mode, params, reload, data):
         """Open a URL with a POST request. Do not cache."""
         key = self.url2key(url, mode, params)
@@ -212,10 +457,62 @@ class CacheManager:
         self.active[item.key] = item
         return SharedAPI(self.active[item.key])
 
-    def deactivate(self,key):
-        """Removes a SharedItem from the shared object list."""
+    def count_nothing(self, name, n=1):
+        pass
+
+    def refreshed(self, item, errcode):
+        """Count the answer to the conditional request of item."""
+        if errcode == 304:
+            self.stats.count('not-modified')
+            if self.active.get(item.key) is item \
+               and self.items.has_key(item.key):
+                # somebody was waiting for the answer
+                self.stats.count('validated-hits')
+                self.stats.count('hit-bytes', self.items[item.key].size)
+        else:
+            self.stats.count('modified')
+
+    def get_stats(self):
+        """Return a dictionary of cache statistics.
+
+        These are the counters of the CacheStats, the hit ratios
+        derived from them, and the state of the disk cache and of the
+        memory cache (prefixed 'disk-' and 'memory-').
+        """
+        stats = self.stats.get_stats()
+        get = self.stats.get
+        stats['hit-ratio'] = float(get('hits') + get('validated-hits')) \
+                             / max(get('requests'), 1)
+        stats['byte-hit-ratio'] = float(get('hit-bytes')) \
+                                  / max(get('hit-bytes') + get('load-bytes'),
+                                        1)
+        if self.caches:
+            disk = self.caches[0]
+            stats['disk-objects'] = len(disk.items)
+            stats['disk-bytes'] = disk.size
+            stats['disk-max-size'] = disk.max_size
+        for name, value in self.memory.get_stats().items():
+            stats['memory-' + name] = value
+        return stats
+
+    def deactivate(self, key, item=None):
+        """Removes a SharedItem from the shared object list.
+
+        If item is given, only if it is the active item for key; a
+        background revalidation is never on the list.
+        """
         if self.active.has_key(key):
-            del self.active[key]
+            if item is None or self.active[key] is item:
+                del self.active[key]
+
+    def revalidate(self, key, url, params):
+        """Refresh a cached page in the background."""
+        if self.revalidating.has_key(key):
+            return
+        try:
+            self.revalidating[key] = Revalidator(self, key, url, params)
+        except (IOError, CacheReadFailed):
+            pass
 
     def add_cache(self, cache):
         """Called by cache to notify manager this it is ready."""
@@ -229,10 +526,20 @@ class CacheManager:
 
         Looks for a cache entry object in the items dictionary. If the
         CE object is found, call its method get() to create a protocol
-        API for the item.
+        API for the item. The body is taken from the memory cache if
+        it is there, and put there if it is small enough.
         """
-        if self.items.has_key(key):
-            return self.items[key].get()
+        if self.caches:
+            # see what other processes added
+            self.caches[0].sync()
+        if self.items.has_key(key) and self.items[key].partial is None:
+            entry = self.items[key]
+            data = self.memory.get(entry)
+            if data is None and self.memory.admit_p(entry):
+                data = entry.read()
+                if data is not None:
+                    self.memory.add(entry, data)
+            return entry.get(data)
         else:
             return None
 
@@ -268,51 +575,112 @@ class CacheManager:
 
     def add(self,item,reload=0):
         """If item is not in the cache and is allowed to be cached, add it. 
+
+        A response with a Vary header is added as a variant.
         """
+        base = self.base_key(item.key)
+        names = parse_vary(item.meta[2])
+        self.note_vary(base, names)
+        if names:
+            key = self.variant_key(base, names, item.params)
+        else:
+            key = base
+        partial = self.items.has_key(key) \
+                  and self.items[key].partial is not None
+        if self.cacheable_url_p(item.url):
+            self.stats.count('loads')
+            self.stats.count('load-bytes', item.datalen)
+            if item.datalen > self.object_size_limit():
+                self.stats.count('too-big')
         try:
-            if not self.items.has_key(item.key) and self.okay_to_cache_p(item):
-                self.caches[0].add(item)
-            elif reload == 1:
-                self.caches[0].update(item)
+            if not self.items.has_key(key) and self.okay_to_cache_p(item):
+                self.caches[0].add(item, key)
+            elif reload == 1 or partial and self.okay_to_cache_p(item):
+                self.caches[0].update(item, key)
+            elif partial:
+                # loaded completely, but not to be kept
+                self.delete(key)
         except CacheFileError, err_tuple:
             (file, err) = err_tuple
             print "error adding item %s (file %s): %s" % (item.url,
                                                           file, err)
 
+    def add_partial(self, item):
+        """Keep the part of item loaded so far, so it can be resumed.
+
+        Only done for a 200 response with a validator for If-Range (a
+        strong ETag or Last-Modified), since otherwise the rest could
+        not be fetched safely, and for bodies that would fit in the
+        cache whole.
+        """
+        headers = item.meta[2]
+        if not resume_validator(headers.get('etag'),
+                                headers.get('last-modified')):
+            return
+        total = -1
+        if headers.has_key('content-length'):
+            try:
+                total = string.atoi(headers['content-length'])
+            except ValueError:
+                pass
+        if total > self.partial_size_limit() or not self.okay_to_cache_p(item, 1):
+            return
+        key = self.base_key(item.key)
+        names = parse_vary(headers)
+        if names:
+            key = self.variant_key(key, names, item.params)
+        try:
+            self.caches[0].update(item, key, total)
+        except CacheFileError:
+            pass
+
     # list of protocols that we can cache
     cache_protocols = ['http', 'ftp', 'hdl']
 
-    def okay_to_cache_p(self,item):
+    def cacheable_url_p(self, url):
+        """Check if the scheme of url is one that is cached."""
+        scheme = urlparse.urlparse(url)[0]
+        return scheme in self.cache_protocols
+
+    def okay_to_cache_p(self,item,partial=0):
         """Check if this item should be cached.
 
         This routine probably (definitely) needs more thought.
         Currently, we do not cache URLs with the following properties:
         1. The scheme is not on the list of cacheable schemes.
-        2. The item is bigger than a quarter of the cache size.
+        2. The item is bigger than the disk-cache--max-object-size
+           preference or the cache itself (only the cache itself if
+           partial is true; see partial_size_limit()).
         3. The 'Pragma: no-cache' header was sent
         4. The 'Expires: 0' header was sent
-        5. The URL includes a query part '?'
+        5. The URL includes a query part '?', unless the response
+           says explicitly how long it stays fresh (see
+           explicitly_fresh())
         
         """
 
         if len(self.caches) < 1:
             return 0
 
+        if not self.cacheable_url_p(item.url):
+            return 0
+
         (scheme, netloc, path, parm, query, frag) = \
                  urlparse.urlparse(item.url)
 
-        if query or scheme not in self.cache_protocols:
-            return 0
-
         # don't cache really big things
-        #####
-        ##### limit is hardcoded, please fix
-        #####
-        if item.datalen > self.caches[0].max_size / 4:
+        if partial:
+            limit = self.partial_size_limit()
+        else:
+            limit = self.object_size_limit()
+        if item.datalen > limit:
             return 0
 
         code, msg, params = item.meta
 
+        if query and not self.explicitly_fresh(params):
+            return 0
+
         # don't cache things that don't want to be cached
         if params.has_key('pragma'):
             pragma = params['pragma']
@@ -325,19 +693,98 @@ class CacheManager:
                 return 0
 
         # respond to http/1.1 cache control directives
+        # (max-age and stale-while-revalidate are kept with the entry)
         if params.has_key('cache-control'):
             for k, v in parse_cache_control(params['cache-control']):
-                if k in  ('no-cache', 'no-store'):
+                if string.lower(string.strip(k)) in ('no-cache', 'no-store'):
                     return 0
-                if k == 'max-age':
-                    expires = string.atoi(v)
+
+        # Vary: * means no request can be matched to the response
+        names = parse_vary(params)
+        if names and '*' in names:
+            return 0
 
         return 1
 
+    def explicitly_fresh(self, headers):
+        """Return true if the response gives itself a lifetime.
+
+        That is a positive Cache-Control max-age, Cache-Control public,
+        or an Expires date in the future.  Responses to URLs with a
+        query are only cached if they do.
+        """
+        max_age, swr = parse_freshness(headers)
+        if max_age > 0:
+            return 1
+        if headers.has_key('cache-control'):
+            for k, v in parse_cache_control(headers['cache-control']):
+                if string.lower(string.strip(k)) == 'public':
+                    return 1
+        if headers.has_key('expires'):
+            if HTTime(str=headers['expires']).get_secs() > time.time():
+                return 1
+        return 0
+
+    def base_key(self, key):
+        """Strip the variant part from a cache key."""
+        i = string.find(key, '#')
+        if i >= 0:
+            return key[:i]
+        return key
+
+    def variant_key(self, key, names, params):
+        """Return the key of the variant of key that a request with the
+        headers in params would get, if the response varies on the
+        request headers in names."""
+        values = {}
+        for k, v in params.items():
+            values[string.lower(k)] = v
+        parts = []
+        for name in names:
+            # whitespace is normalized, which also keeps tabs and
+            # newlines out of the log
+            value = string.join(string.split(str(values.get(name, ''))))
+            parts.append('%s=%s' % (name, value))
+        return key + '#' + string.join(parts, ';')
+
+    def note_vary(self, key, names):
+        """Remember which request headers the responses for key vary on."""
+        key = self.base_key(key)
+        if names:
+            self.vary[key] = names
+        elif self.vary.has_key(key):
+            del self.vary[key]
+
+    def check_freshness(self, key):
+        """Decide how a cached entry may be used.
+
+        Returns FRESH if it can be served as it is, REVALIDATE if it
+        can be served while it is refreshed in the background, and
+        STALE if it must be refreshed first.
+        """
+        if self.fresh_type == 'never':
+            return FRESH
+        entry = self.items[key]
+        age = entry.age()
+        if entry.max_age is not None and age is not None \
+           and self.fresh_type != 'always':
+            # the server said how long the page stays fresh
+            if age <= entry.max_age:
+                return FRESH
+        elif self.fresh_p(key):
+            return FRESH
+        if entry.stale_while_revalidate is not None \
+           and entry.max_age is not None and age is not None \
+           and age <= entry.max_age + entry.stale_while_revalidate:
+            return REVALIDATE
+        if self.background_revalidate:
+            return REVALIDATE
+        return STALE
+
     def fresh_every_session(self,entry):
         """Refresh the page once per session"""
-        if not entry.key in self.session_freshen:
-            self.session_freshen.append(entry.key)
+        if not self.session_freshen.has_key(entry.key):
+            self.session_freshen[entry.key] = 1
             return 0
         return 1
 
@@ -385,6 +832,151 @@ class CacheManager:
         return urlparse.urlunparse((scheme, netloc, path, params, query, ""))
 
 
+class BackgroundReader:
+
+    """Read an api to the end for nobody in particular.
+
+    Like a BaseReader it watches the api's file with a Tk file handler
+    and registers a callback for what the api has without the file
+    becoming readable; only an api without a file is polled from Tk's
+    timer.  Derived classes define poll(), which reads what is there
+    and calls close() once they are done.
+    """
+
+    poll_interval = 100                 # milliseconds, without a file
+    bufsize = 8*1024
+
+    def __init__(self, app, api):
+        self.app = app
+        self.api = api
+        self.fno = -1
+        self.timer = None
+        try:
+            self.api.register_reader(self.start, self.wakeup)
+        except AttributeError:
+            # only http_access has delayed startup
+            self.start()
+
+    def start(self):
+        # called again when the api moves to another connection
+        if not self.api:
+            return
+        self.unwatch()
+        self.fno = self.api.fileno()
+        if self.fno >= 0:
+            import Tkinter
+            self.app.root.createfilehandler(self.fno, Tkinter.READABLE,
+                                            self.checkapi)
+        else:
+            self.timer = self.app.root.after(self.poll_interval,
+                                             self.checkapi_regularly)
+
+    def unwatch(self):
+        fno = self.fno
+        self.fno = -1
+        if fno >= 0:
+            self.app.root.deletefilehandler(fno)
+        timer = self.timer
+        self.timer = None
+        if timer:
+            self.app.root.after_cancel(timer)
+
+    def wakeup(self):
+        self.checkapi()
+
+    def checkapi(self, *args):
+        if self.api:
+            self.poll()
+
+    def checkapi_regularly(self):
+        self.timer = None
+        if not self.api or self.fno >= 0:
+            return
+        self.poll()
+        if self.api and self.fno < 0 and not self.timer:
+            self.timer = self.app.root.after(self.poll_interval,
+                                             self.checkapi_regularly)
+
+    def poll(self):
+        pass
+
+    def close(self):
+        self.unwatch()
+        api = self.api
+        self.api = None
+        if api:
+            api.close()
+
+
+class Revalidator(BackgroundReader):
+
+    """Refresh a cached page in the background.
+
+    The stale copy has already been served.  This sends the
+    conditional request at background priority and reads the response
+    like a reader would, but with nobody waiting for it: on 304 the
+    entry's date is brought up to date, on 200 the new page replaces
+    the entry once it has been read completely, and on an error the
+    stale copy is kept.
+    """
+
+    def __init__(self, manager, key, url, params):
+        self.manager = manager
+        self.key = key
+        params = copy.copy(params)
+        params['.priority'] = grailutil.PRIORITY_BACKGROUND
+        entry = manager.items[key]
+        self.item = SharedItem(url, 'GET', params, manager, key, None,
+                               entry.get(), refresh=entry.lastmod,
+                               etag=entry.etag)
+        BackgroundReader.__init__(self, manager.app, SharedAPI(self.item))
+
+    def poll(self):
+        try:
+            done = self.step()
+        except:
+            # whatever went wrong, keep the stale copy
+            self.abandon()
+            return
+        if done:
+            self.close()
+
+    def step(self):
+        api = self.api
+        if api.stage == META:
+            message, ready = api.pollmeta()
+            if not ready:
+                return 0
+            api.getmeta()
+            if not self.item.reloading:
+                # 304: the cached copy is still good
+                self.manager.touch(self.key, refresh=1)
+                return 1
+            if self.item.meta[0] != 200:
+                self.abandon()
+                return 1
+        while 1:
+            message, ready = api.polldata()
+            if not ready:
+                return 0
+            if not api.getdata(self.bufsize):
+                # the SharedItem has updated the cache
+                return 1
+
+    def abandon(self):
+        # don't let the SharedItem touch the cache
+        if self.item:
+            self.item.discard_spool()
+            self.item.cache = None
+        self.close()
+
+    def close(self):
+        self.item = None
+        BackgroundReader.close(self)
+        if self.manager.revalidating.get(self.key) is self:
+            del self.manager.revalidating[self.key]
+
+
 class DiskCacheEntry:
     """Data about item stored in a disk cache.
 
@@ -398,13 +990,22 @@ class DiskCacheEntry:
     The data members include:
     date -- the date of the most recent HTTP request to the server
     (either a regular load or an If-Modified-Since request)
+    max_age, stale_while_revalidate -- the Cache-Control directives
+    of that name, in seconds, or None
+    etag -- the entity tag, sent back in If-None-Match, or None
+    vary -- the sorted request header names the response varied on,
+    or None
+    partial -- None for a complete body; for the beginning of one that
+    was not loaded completely, the length of the whole body, or -1 if
+    it is not known
     """
 
     def __init__(self, cache=None):
         self.cache = cache
 
     def fill(self,key,url,size,date,lastmod,expires,ctype,
-             cencoding,ctencoding):
+             cencoding,ctencoding,max_age=None,swr=None,etag=None,
+             vary=None,partial=None):
         self.key = key
         self.url = url
         self.size = size
@@ -423,6 +1024,11 @@ class DiskCacheEntry:
         self.type = ctype
         self.encoding = cencoding
         self.transfer_encoding = ctencoding
+        self.max_age = max_age
+        self.stale_while_revalidate = swr
+        self.etag = etag
+        self.vary = vary
+        self.partial = partial
 
     string_date = re.compile('^[A-Za-z]')
 
@@ -454,6 +1060,15 @@ class DiskCacheEntry:
             else:
                 if self.transfer_encoding == 'None':
                     self.transfer_encoding = None
+        self.max_age = self.parse_int(vars, 10)
+        self.stale_while_revalidate = self.parse_int(vars, 11)
+        self.etag = self.vary = None
+        if len(vars) > 13:
+            if vars[12] != 'None':
+                self.etag = vars[12]
+            if vars[13] != 'None':
+                self.vary = string.splitfields(vars[13], ',')
+        self.partial = self.parse_int(vars, 14)
         self.date = None
         self.lastmod = None
         self.expires = None
@@ -461,6 +1076,13 @@ class DiskCacheEntry:
                      (vars[6], 'expires')]:
             self.parse_assign(tup[0],tup[1])
 
+    def parse_int(self, vars, i):
+        # optional fields added after log version 1.3
+        try:
+            return string.atoi(vars[i])
+        except (IndexError, ValueError):
+            return None
+
     def parse_assign(self,rep,var):
         if rep == 'None':
             setattr(self,var,None)
@@ -478,13 +1100,19 @@ class DiskCacheEntry:
             self.file = ''
         stuff = [self.key, self.url, self.file, self.size, self.date,
                  self.lastmod, self.expires, self.type, self.encoding,
-                 self.transfer_encoding]
+                 self.transfer_encoding, self.max_age,
+                 self.stale_while_revalidate, self.etag, None, self.partial]
+        if self.vary:
+            stuff[13] = string.join(self.vary, ',')
         s = string.join(map(str, stuff), '\t')
         return s
 
-    def get(self):
+    def get(self, data=None):
         """Create a disk_cache_access API object and return it.
 
+        If data is given it is the body, kept in memory, and a
+        memory_cache_access serving it is returned instead.
+
         Calls cache.get() to update the LRU information.
 
         Also checks to see if a page with an explicit Expire date has
@@ -495,14 +1123,37 @@ class DiskCacheEntry:
                 # we need to refresh the page; can we just reload?
                 raise CacheReadFailed, self.cache
         self.cache.get(self.key) 
+        path = self.cache.get_file_path(self.file)
+        if data is not None:
+            return memory_cache_access(data, path, self.type, self.date,
+                                       self.size, self.encoding,
+                                       self.transfer_encoding)
         try:
-            api = disk_cache_access(self.cache.get_file_path(self.file),
+            api = disk_cache_access(path,
                                     self.type, self.date, self.size,
                                     self.encoding, self.transfer_encoding)
         except IOError:
             raise CacheReadFailed, self.cache
         return api
 
+    def read(self):
+        """Return the whole cached body, or None if it can't be read."""
+        try:
+            fp = open(self.cache.get_file_path(self.file), 'rb')
+            data = fp.read()
+            fp.close()
+        except IOError:
+            return None
+        if len(data) != self.size:
+            return None
+        return data
+
+    def age(self):
+        """Seconds since the most recent check with the server, or None."""
+        if self.date:
+            return time.time() - self.date.get_secs()
+        return None
+
     def touch(self,refresh=0):
         """Change the date of most recent check with server."""
         self.date = HTTime(secs=time.time())
@@ -512,30 +1163,62 @@ class DiskCacheEntry:
     def delete(self):
         pass
 
-def compare_expire_items(item1,item2):
-    """used with list.sort() to sort list of CacheEntries by expiry date."""
-    e1 = item1.expires.get_secs() 
-    e2 = item2.expires.get_secs()
-    if e1 > e2:
-        return 1
-    elif e2 > e1:
-        return -1
-    else:
+def process_alive(pid):
+    """Return true unless process pid is known to have gone."""
+    try:
+        os.kill(pid, 0)
+    except AttributeError:
+        # no kill() on this platform
         return 0
+    except os.error, (code, msg):
+        return code == errno.EPERM
+    return 1
 
 class DiskCache:
     """Persistent object cache.
 
     need to discuss:
 
-    use_order
-
-    the log: writes every change to cache or use_order, writes
-    flushed, do a checkpoint run on startup, format is tuple (entry
-    type, object), where entry type is add, evict, update use_order,
-    version. 
-
-    expires
+    use_order: an LRUList of keys, least recently used first.
+    touching, evicting the oldest and deleting are constant time.
+
+    the log: a journal of length-prefixed binary records, one for
+    each add and evict, plus batched use_order updates. each record is
+    a one-character kind ('0' add, '1' evict, '2' use_order update,
+    '3' version), a four-byte big-endian payload length and the
+    payload. use_order updates are group-committed: touched keys are
+    collected and written as a single record once use_batch keys are
+    pending, after use_commit_delay milliseconds, or before the next
+    add or evict. when more than compact_ratio of the records are dead
+    the journal is rewritten from the live entries at idle time, so
+    startup cost follows the size of the cache rather than its
+    history. old text logs (versions 1.2 and 1.3) are still read and
+    converted on startup. version 2.1 add records carry the freshness
+    directives, ETag and Vary of the entry in extra fields; 2.0
+    records simply lack them.
+
+    policy: a CachePolicy.ReplacementPolicy that picks the page
+    make_space() evicts once expired pages are gone. it is told about
+    every add, hit and removal, including those replayed from the log;
+    frequency information does not survive a checkpoint.
+
+    expires: an ExpiryQueue of the keys of pages with an explicit
+    expire date, keyed on HTTime.get_secs(). expired pages are evicted
+    by make_space() and, when running under Tk, every
+    expiry_check_period milliseconds.
+
+    sharing: if shared is true (and fcntl is available), several
+    processes may use the cache directory at once. every change is
+    made holding an flock() on the file LOCK, between lock() and
+    unlock(); lock() first replays the records other processes have
+    appended to the log since this one last looked (see sync()), so
+    the change is made to the current contents. reading needs no
+    lock: cache_read() calls sync(), which only replays complete
+    records, and a log replaced by another process's checkpoint is
+    noticed by its inode and read afresh. cache files are always
+    written elsewhere and renamed into place before they are logged,
+    so no process sees a partial one, and a file unlinked while it is
+    being read stays readable on Unix.
 
     evict
 
@@ -544,7 +1227,7 @@ class DiskCache:
 
     """
 
-    def __init__(self, manager, size, directory):
+    def __init__(self, manager, size, directory, policy='lru', shared=0):
         self.max_size = size
         self.size = 0
         self.pref_dir = directory
@@ -556,89 +1239,272 @@ class DiskCache:
         self.manager = manager
         self.manager.add_cache(self)
         self.items = {}
-        self.use_order = []
+        self.use_order = LRUList()
+        self.policy_name = policy
+        self.policy = CachePolicy.get_policy(policy)
         self.log = None
         self.checkpoint = 0
-        self.expires = []
+        self.expires = ExpiryQueue()
         self.types = {}
+        self.pending_use = []
+        self.log_records = 0
+        self.compaction_pending = 0
 
-        grailutil.establish_dir(self.directory)
-        self._read_metadata()
-        self._reinit_log()
+        self.spool_count = 0
+
+        self.log_id = None
+        self.log_pos = 0
+        self.lock_depth = 0
+        self.lock_file = None
 
-    log_version = "1.3"
-    log_ok_versions = ["1.2", "1.3"]
+        grailutil.establish_dir(self.directory)
+        self.shared = shared
+        if shared and fcntl:
+            try:
+                self.lock_file = open(os.path.join(self.directory, 'LOCK'),
+                                      'a')
+            except IOError:
+                print "can't open cache lock file; not sharing the cache"
+        self.lock()
+        try:
+            self._clear_spool()
+            self._read_metadata()
+            self._migrate_flat_files()
+            self._reinit_log()
+        finally:
+            self.unlock()
+        self._check_compaction()
+        self._after(self.expiry_check_period, self.expire_timer)
+
+    log_version = "2.1"
+    log_ok_versions = ["2.0", "2.1"]
+    text_log_ok_versions = ["1.2", "1.3"]
+    log_magic = '\211GRAIL-LOG\r\n\032\n'
+    record_header = '>cL'
+    record_header_size = struct.calcsize(record_header)
+
+    # group commit and compaction tuning
+    use_batch = 64
+    use_commit_delay = 2000
+    compact_ratio = 0.5
+    compact_min_records = 1000
+
+    # milliseconds between checks for expired pages
+    expiry_check_period = 60000
 
     def close(self,log):
-        self.manager.delete(self.items.keys(), evict=0)
-        if log:
-            self.use_order = []
-            self._checkpoint_metadata()
+        self.lock()
+        try:
+            self.commit_use_order()
+            self.manager.delete(self.items.keys(), evict=0)
+            if log:
+                self.use_order.clear()
+                self.policy.clear()
+                self._checkpoint_metadata()
+        finally:
+            self.unlock()
+        if self.log:
+            self.log.close()
+            self.log = None
+        if self.lock_file:
+            self.lock_file.close()
+            self.lock_file = None
         del self.items
         del self.expires
         self.manager.close_cache(self)
         self.dead = 1
 
+    def lock(self):
+        """Start a change to the cache.
+
+        In a shared cache this takes the lock and replays what other
+        processes logged.  Calls nest; only the outermost unlock()
+        flushes the log and releases the lock.
+        """
+        self.lock_depth = self.lock_depth + 1
+        if self.lock_depth == 1 and self.lock_file:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX)
+            self.sync()
+
+    def unlock(self):
+        self.lock_depth = self.lock_depth - 1
+        if self.lock_depth > 0:
+            return
+        if self.log:
+            self.log.flush()
+            self.log_pos = os.fstat(self.log.fileno())[stat.ST_SIZE]
+        if self.lock_file:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+
+    def sync(self):
+        """Replay the records other processes added to the log."""
+        if not self.lock_file or not self.log:
+            return
+        logpath = os.path.join(self.directory, 'LOG')
+        try:
+            st = os.stat(logpath)
+        except os.error:
+            return
+        if (st[stat.ST_DEV], st[stat.ST_INO]) != self.log_id:
+            # another process checkpointed the log
+            self._reload_metadata()
+        elif st[stat.ST_SIZE] > self.log_pos:
+            self.log.seek(self.log_pos)
+            data = self.log.read()
+            self.log.seek(0, 2)
+            # a record still being written is left for next time
+            pos = self._replay_records(data, 0)
+            if pos is not None:
+                self.log_pos = self.log_pos + pos
+
+    def _reload_metadata(self):
+        """Read the log afresh, after it was replaced."""
+        self.log.close()
+        self.log = None
+        self._forget_metadata()
+        self.log_records = 0
+        self._reinit_log()
+        # read through the file just opened, so the records replayed
+        # and the ones appended later are in the same file
+        self.log.seek(0)
+        data = self.log.read()
+        self.log.seek(0, 2)
+        pos = None
+        if data[:len(self.log_magic)] == self.log_magic:
+            pos = self._replay_records(data, len(self.log_magic))
+        if pos is not None:
+            self.log_pos = pos
+
     def _read_metadata(self):
         """Read the transaction log from the cache directory.
 
-        Reads the pickled log entries and re-creates the cache's
-        current contents and use_order from the log.
+        Replays the log records and re-creates the cache's current
+        contents and use_order from the log. A log in the old text
+        format is converted to the journal format after it is read.
 
-        A version number is included, but currently we only assert
-        that a the version number read is the same as the current
-        version number.
+        A journal with an unknown version is ignored; a journal
+        truncated by a crash is read up to the last complete record
+        and then rewritten.
         """
         logpath = os.path.join(self.directory, 'LOG')
         try:
-            log = open(logpath)
+            log = open(logpath, 'rb')
         except IOError:
             # now what happens if there is an error here?
-            log = open(logpath, 'w')
-            log.close()
+            self._checkpoint_metadata()
             return
 
-        for line in log.readlines():
+        data = log.read()
+        log.close()
+        if data[:len(self.log_magic)] == self.log_magic:
+            if not self._read_journal(data):
+                self._checkpoint_metadata()
+        else:
+            self._read_text_log(string.splitfields(data, '\n'))
+            self._checkpoint_metadata()
+
+    def _read_journal(self, data):
+        """Replay a binary journal; returns false if it must be rewritten."""
+        self.log_records = 0
+        pos = self._replay_records(data, len(self.log_magic))
+        # otherwise a partial record was written during a crash
+        return pos == len(data)
+
+    def _replay_records(self, data, pos):
+        """Replay the complete journal records in data, from pos on.
+
+        Returns the position after the last one, or None if the
+        journal has a version we don't know.
+        """
+        end = len(data)
+        hsize = self.record_header_size
+        while pos + hsize <= end:
+            kind, length = struct.unpack(self.record_header,
+                                         data[pos:pos+hsize])
+            if pos + hsize + length > end:
+                break
+            payload = data[pos+hsize:pos+hsize+length]
+            pos = pos + hsize + length
+            if kind == '2':
+                for key in string.splitfields(payload, '\n'):
+                    self._replay_use(key)
+            elif kind == '1':
+                self._replay_delete(payload)
+            elif kind == '0':
+                self._replay_add(payload)
+            elif kind == '3':
+                if payload not in self.log_ok_versions:
+                    self._forget_metadata()
+                    return None
+                continue
+            self.log_records = self.log_records + 1
+        return pos
+
+    def _read_text_log(self, lines):
+        """Replay a log in the old, line-oriented text format."""
+        for line in lines:
             try:
-                kind = line[0:1]        
+                kind = line[0:1]
                 if kind == '2': # use update
-                    key = line[2:-1]
-                    self.use_order.remove(key)
-                    self.use_order.append(key)
+                    self._replay_use(line[2:])
                 elif kind == '1':           # delete
-                    key = line[2:-1]
-                    if self.items.has_key(key):
-                        self.size = self.size - self.items[key].size
-                        del self.items[key]
-                        del self.manager.items[key]
-                        self.use_order.remove(key)
-                        Assert(not key in self.use_order)
+                    self._replay_delete(line[2:])
                 elif kind == '0': # add
-                    newentry = DiskCacheEntry(self)
-                    newentry.parse(line[2:-1])
-                    if not self.items.has_key(newentry.key):
-                        self.use_order.append(newentry.key)
-                    newentry.cache = self
-                    self.items[newentry.key] = newentry
-                    self.manager.items[newentry.key] = newentry
-                    self.size = self.size + newentry.size
+                    self._replay_add(line[2:])
                 elif kind == '3': # version (hopefully first)
-                    ver = line[2:-1]
-                    if ver not in self.log_ok_versions:
+                    ver = line[2:]
+                    if ver not in self.text_log_ok_versions:
                    ### clear out anything we might have read
                    ### and bail. this is an old log file.
-                        if len(self.use_order) > 0:
-                            self.use_order = []
-                            for key in self.items.keys():
-                                del self.items[key]
-                                del self.manager.items[key]
-                                self.size = 0
-                            return
-                    Assert(ver in self.log_ok_versions)
+                        self._forget_metadata()
+                        return
             except IndexError:
                 # ignore this line
                 pass
 
+    def _replay_use(self, key):
+        if self.items.has_key(key):
+            self.use_order.touch(key)
+            self.policy.touch(key)
+
+    def _replay_delete(self, key):
+        if self.items.has_key(key):
+            self.size = self.size - self.items[key].size
+            del self.items[key]
+            del self.manager.items[key]
+            self.use_order.remove(key)
+            self.policy.remove(key)
+            self.expires.remove(key)
+
+    def _replay_add(self, rep):
+        newentry = DiskCacheEntry(self)
+        newentry.parse(rep)
+        if self.items.has_key(newentry.key):
+            self.size = self.size - self.items[newentry.key].size
+            self.policy.remove(newentry.key)
+        else:
+            self.use_order.touch(newentry.key)
+        self.policy.add(newentry.key, newentry.size)
+        newentry.cache = self
+        self.items[newentry.key] = newentry
+        self.manager.items[newentry.key] = newentry
+        if newentry.vary:
+            self.manager.note_vary(newentry.key, newentry.vary)
+        self.size = self.size + newentry.size
+        if newentry.expires:
+            self.add_expireable(newentry)
+        else:
+            self.expires.remove(newentry.key)
+
+    def _forget_metadata(self):
+        for key in self.items.keys():
+            del self.items[key]
+            del self.manager.items[key]
+        self.use_order.clear()
+        self.policy.clear()
+        self.expires.clear()
+        self.size = 0
+
     def _checkpoint_metadata(self):
         """Checkpoint the transaction log.
 
@@ -646,51 +1512,185 @@ class DiskCache:
         cache.
         """
         import traceback
+        self.lock()
+        self.pending_use = []
         if self.log:
             self.log.close()
+            self.log = None
         try:
-            newpath = os.path.join(self.directory, 'CHECKPOINT')
+            newpath = os.path.join(self.directory,
+                                   'CHECKPOINT.%d' % os.getpid())
 
-            newlog = open(newpath, 'w')
-            newlog.write('3 ' + self.log_version + '\n')
-            for key in self.use_order:
+            newlog = open(newpath, 'wb')
+            newlog.write(self.log_magic)
+            self._write_record(newlog, '3', self.log_version)
+            for key in self.use_order.keys():
                 self.log_entry(self.items[key],alt_log=newlog,flush=None)
                 # don't flush writes during the checkpoint, because if
                 # we crash it won't matter
             newlog.close()
             logpath = os.path.join(self.directory, 'LOG')
-            os.unlink(logpath)
+            if os.path.exists(logpath):
+                os.unlink(logpath)
             os.rename(newpath, logpath)
+            self.log_records = len(self.items)
         except:
             print "exception during checkpoint"
             traceback.print_exc()
+        self.unlock()
 
     def _reinit_log(self):
-        """Open the log for writing new transactions."""
+        """Open the log for writing new transactions.
+
+        It is opened for reading too, for sync().
+        """
         logpath = os.path.join(self.directory, 'LOG')
-        self.log = open(logpath, 'a')
+        self.log = open(logpath, 'a+b')
+        st = os.fstat(self.log.fileno())
+        self.log_id = st[stat.ST_DEV], st[stat.ST_INO]
+        self.log_pos = st[stat.ST_SIZE]
+
+    def _write_record(self, dest, kind, payload):
+        dest.write(struct.pack(self.record_header, kind, len(payload))
+                   + payload)
 
     def log_entry(self,entry,delete=0,alt_log=None,flush=1):
         """Write to the log adds and evictions."""
         if alt_log:
-            dest = alt_log
-        else:
-            dest = self.log
+            self.__log_entry(entry, delete, alt_log, flush)
+            return
+        # callers such as touch() don't hold the lock, and in a shared
+        # cache the record must not interleave with another process's
+        self.lock()
+        try:
+            # keep pending use_order updates ahead of this record
+            self.commit_use_order(flush=0)
+            self.log_records = self.log_records + 1
+            self.__log_entry(entry, delete, self.log, flush)
+        finally:
+            self.unlock()
+        self._check_compaction()
+
+    def __log_entry(self, entry, delete, dest, flush):
         if delete:
-            dest.write('1 ' + entry.key + '\n')
+            self._write_record(dest, '1', entry.key)
         else:
-            dest.write('0 ' + entry.unparse() + '\n')
+            self._write_record(dest, '0', entry.unparse())
         if flush:
             dest.flush()
 
     def log_use_order(self,key):
-        """Write to the log changes in use_order."""
+        """Queue a change in use_order for the next group commit."""
         if self.items.has_key(key):
-            self.log.write('2 ' + key + '\n')
-            # should we flush() here? probably...
-            self.log.flush()
+            pending = self.pending_use
+            if not pending:
+                self._after(self.use_commit_delay, self.commit_use_order)
+            pending.append(key)
+            if len(pending) >= self.use_batch:
+                self.commit_use_order()
+
+    def commit_use_order(self, flush=1):
+        """Write pending use_order updates to the log as one record."""
+        if not self.pending_use or not self.log or hasattr(self, 'dead'):
+            return
+        self.lock()
+        try:
+            keys = self.pending_use
+            self.pending_use = []
+            self._write_record(self.log, '2', string.joinfields(keys, '\n'))
+            self.log_records = self.log_records + 1
+            if flush:
+                self.log.flush()
+        finally:
+            self.unlock()
+        self._check_compaction()
+
+    def _check_compaction(self):
+        records = self.log_records
+        if self.compaction_pending or records < self.compact_min_records:
+            return
+        if records - len(self.items) > records * self.compact_ratio:
+            self.compaction_pending = 1
+            self._after_idle(self.compact)
+
+    def compact(self):
+        """Rewrite the log so that it holds only live entries."""
+        self.compaction_pending = 0
+        if hasattr(self, 'dead'):
+            return
+        self.lock()
+        try:
+            self._checkpoint_metadata()
+            self._reinit_log()
+        finally:
+            self.unlock()
 
-    cache_file = re.compile('^spam[0-9]+')
+    def _after(self, ms, func):
+        """Call func after ms milliseconds; in the Tk main loop if any."""
+        try:
+            root = self.manager.app.root
+        except AttributeError:
+            return
+        root.after(ms, func)
+
+    def _after_idle(self, func):
+        """Call func when the Tk main loop is idle, or right now."""
+        try:
+            root = self.manager.app.root
+        except AttributeError:
+            func()
+        else:
+            root.after_idle(func)
+
+    # cache bodies live in a two-level fan-out of directories named by
+    # the first four hex digits of the md5 of their key; files from
+    # the old flat layout are named spam<time>
+    flat_file = re.compile('^spam[0-9]+')
+    cache_file = re.compile('^(spam[0-9]+|[0-9a-f]{32})')
+    shard_dir = re.compile('^[0-9a-f][0-9a-f]$')
+
+    def _cache_files(self):
+        """Return (filename, path) for every cache body on disk.
+
+        filename is relative to the cache directory, as in the log.
+        """
+        files = []
+        isdir = os.path.isdir
+        join = os.path.join
+        for name in os.listdir(self.directory):
+            path = join(self.directory, name)
+            if self.shard_dir.match(name) and isdir(path):
+                for sub in os.listdir(path):
+                    subpath = join(path, sub)
+                    if not (self.shard_dir.match(sub) and isdir(subpath)):
+                        continue
+                    for file in os.listdir(subpath):
+                        if self.cache_file.match(file):
+                            files.append((join(name, sub, file),
+                                          join(subpath, file)))
+            elif self.flat_file.match(name) and os.path.isfile(path):
+                files.append((name, path))
+        return files
+
+    def _migrate_flat_files(self):
+        """Move bodies from the old flat layout into the fan-out."""
+        moved = 0
+        for entry in self.items.values():
+            if not self.flat_file.match(entry.file):
+                continue
+            oldpath = self.get_file_path(entry.file)
+            if not os.path.isfile(oldpath):
+                # leave it; reading it will fail and evict the entry
+                continue
+            newfile = self.get_file_name(entry)
+            try:
+                os.rename(oldpath, self.get_file_path(newfile))
+            except os.error:
+                continue
+            entry.file = newfile
+            moved = 1
+        if moved:
+            self._checkpoint_metadata()
 
     def erase_cache(self):
 
@@ -699,15 +1699,17 @@ class DiskCache:
             self.manager.disk.erase_cache()
             return
 
-        def walk_erase(regexp,dir,files):
-            for file in files:
-                if regexp.match(file) != -1:
-                    path = os.path.join(dir,file)
-                    if os.path.isfile(path):
-                        os.unlink(path)
-
-        os.path.walk(self.directory, walk_erase, self.cache_file)
-        self.manager.reset_disk_cache(flush_log=1)
+        self.lock()
+        try:
+            for file, path in self._cache_files():
+                try:
+                    os.unlink(path)
+                except os.error:
+                    pass
+            self._clear_spool()
+            self.manager.reset_disk_cache(flush_log=1)
+        finally:
+            self.unlock()
 
     def erase_unlogged_files(self):
 
@@ -716,61 +1718,87 @@ class DiskCache:
             self.manager.disk.erase_unlogged_files()
             return
 
-        def walk_erase_unknown(known,dir,files,regexp=self.cache_file):
-            for file in files:
-                if not known.has_key(file) \
-                   and regexp.match(file) != -1:
-                    path = os.path.join(dir,file)
-                    if os.path.isfile(path):
+        self.lock()
+        try:
+            known = {}
+            for entry in self.items.values():
+                known[entry.file] = 1
+            for file, path in self._cache_files():
+                if not known.has_key(file):
+                    try:
                         os.unlink(path)
-
-        files = map(lambda entry:entry.file, self.items.values())
-        file_dict = { 'LOG': 1 }
-        for file in files:
-            file_dict[file] = 1
-        os.path.walk(self.directory, walk_erase_unknown, file_dict)
+                    except os.error:
+                        pass
+        finally:
+            self.unlock()
 
     def get(self,key):
         """Update and log use_order."""
         Assert(self.items.has_key(key))
-        self.use_order.remove(key)
-        self.use_order.append(key)
+        self.use_order.touch(key)
+        self.policy.touch(key)
         self.log_use_order(key)
 
-    def update(self,object):
+    def update(self,object,key=None,partial=None):
         # this is simple, but probably not that efficient
-        self.evict(object.key)
-        self.add(object)
+        key = key or object.key
+        self.lock()
+        try:
+            if self.items.has_key(key):
+                self.evict(key)
+            self.add(object, key, partial)
+        finally:
+            self.unlock()
 
-    def add(self,object):
+    def add(self,object,key=None,partial=None):
         """Creates a DiskCacheEntry for object and adds it to cache.
 
         Examines the object and its headers for size, date, type,
         etc. The DiskCacheEntry is placed in the DiskCache and the
-        CacheManager and the entry is logged.
+        CacheManager and the entry is logged. key defaults to the
+        object's key; the manager passes the key of a variant. partial
+        is passed on to the entry (see DiskCacheEntry).
 
         XXX Need to handle replacement better?
         """
+        self.lock()
+        try:
+            return self.__add(object, key or object.key, partial)
+        finally:
+            self.unlock()
+
+    def __add(self, object, key, partial):
         respcode, msg, headers = object.meta
         size = object.datalen
 
+        if self.items.has_key(key):
+            # another process added it meanwhile
+            self.evict(key)
         self.make_space(size)
 
         newitem = DiskCacheEntry(self)
         (date, lastmod, expires, ctype, cencoding, ctencoding) \
                = self.read_headers(headers)
-        newitem.fill(object.key, object.url, size, date, lastmod,
-                     expires, ctype, cencoding, ctencoding)
+        max_age, swr = parse_freshness(headers)
+        etag = None
+        if headers.has_key('etag'):
+            etag = string.join(string.split(headers['etag']))
+        newitem.fill(key, object.url, size, date, lastmod,
+                     expires, ctype, cencoding, ctencoding, max_age, swr,
+                     etag, parse_vary(headers), partial)
         newitem.file = self.get_file_name(newitem)
         if expires:
             self.add_expireable(newitem)
 
         self.make_file(newitem,object)
-        self.log_entry(newitem)
 
-        self.items[object.key] = newitem
-        self.manager.items[object.key] = newitem
-        self.use_order.append(object.key)
+        # a compaction started by log_entry() checkpoints self.items,
+        # so the entry has to be there first
+        self.items[key] = newitem
+        self.manager.items[key] = newitem
+        self.use_order.touch(key)
+        self.policy.add(key, size)
+        self.log_entry(newitem)
 
         return newitem
 
@@ -810,13 +1838,20 @@ class DiskCache:
 
 
     def add_expireable(self,entry):
-        """Adds entry to list of pages with explicit expire date."""
-        self.expires.append(entry)
+        """Adds entry to the queue of pages with explicit expire date."""
+        self.expires.add(entry.key, entry.expires.get_secs())
 
     def get_file_name(self,entry):
-        """Invent a filename for a new cache entry."""
-        filename = 'spam' + str(time.time()) + self.get_suffix(entry.type)
-        return filename
+        """Invent a filename for a new cache entry.
+
+        The name is derived from the md5 of the key, inside a two-level
+        fan-out of directories, e.g. 3f/a2/3fa2...e1.html.  The
+        directories are created as needed.
+        """
+        digest = md5.new(entry.key).hexdigest()
+        shard = os.path.join(digest[:2], digest[2:4])
+        grailutil.establish_dir(os.path.join(self.directory, shard))
+        return os.path.join(shard, digest + self.get_suffix(entry.type))
 
     def get_file_path(self,filename):
         path = os.path.join(self.directory, filename)
@@ -829,23 +1864,75 @@ class DiskCache:
             return guess_extension(type) or ''
 
     def make_file(self,entry,object):
-        """Write the object's data to disk."""
+        """Write the object's data to disk.
+
+        If the object was spooled to disk as it arrived, the spool file
+        is just renamed.
+        """
         path = self.get_file_path(entry.file)
+        spool = getattr(object, 'spool', None)
+        if spool and spool.cacheable and not spool.committed \
+           and spool.size == object.datalen:
+            try:
+                spool.commit(path)
+            except (IOError, os.error), err:
+                raise CacheFileError, (path, err)
+            return
+        spool = self.open_spool()
         try:
-            f = open(path, 'wb')
-            f.writelines(object.data)
-            f.close()
-        except IOError, err:
+            if not spool:
+                raise IOError, "can't open a spool file"
+            for chunk in object.data.chunks():
+                spool.write(chunk)
+            spool.commit(path)
+        except (IOError, os.error), err:
+            if spool:
+                spool.discard()
             raise CacheFileError, (path, err)
 
+    spool_dir = 'spool'
+
+    def open_spool(self):
+        """Return a new SpoolFile in the cache directory, or None."""
+        directory = os.path.join(self.directory, self.spool_dir)
+        self.spool_count = self.spool_count + 1
+        name = "%d-%d" % (os.getpid(), self.spool_count)
+        try:
+            grailutil.establish_dir(directory)
+            return SpoolFile(os.path.join(directory, name))
+        except (IOError, os.error):
+            return None
+
+    def _clear_spool(self):
+        """Remove spool files left behind by an earlier session.
+
+        Those of other processes still running are left alone.
+        """
+        directory = os.path.join(self.directory, self.spool_dir)
+        try:
+            names = os.listdir(directory)
+        except os.error:
+            return
+        for name in names:
+            try:
+                pid = string.atoi(string.splitfields(name, '-')[0])
+            except ValueError:
+                pid = None
+            if pid and pid != os.getpid() and process_alive(pid):
+                continue
+            try:
+                os.unlink(os.path.join(directory, name))
+            except os.error:
+                pass
+
     def make_space(self,amount):
         """Ensures that there are amount bytes free in the disk cache.
 
         If the cache does not have amount bytes free, pages are
         evicted. First, we check the list of pages with explicit
         expire dates and evict any that have expired. If we need more
-        space, evict the least recently used page. Continue LRU
-        eviction until enough space is available.
+        space, evict the page chosen by the replacement policy (see
+        CachePolicy). Continue until enough space is available.
 
         Raises CacheEmpty if there are no entries in the cache, but
         amount bytes are not available.
@@ -856,7 +1943,9 @@ class DiskCache:
 
         try:
             while self.size + amount > self.max_size:
-                self.evict_any_page()
+                size = self.evict_any_page()
+                self.manager.stats.count('policy-evictions')
+                self.manager.stats.count('policy-evicted-bytes', size)
         except CacheEmpty:
             print "Can't make more room in the cache"
             pass
@@ -864,37 +1953,64 @@ class DiskCache:
             # but I don't think this should ever happen
         self.size = self.size + amount
 
+    def set_policy(self, name):
+        """Switch to another replacement policy.
+
+        The new policy learns the current entries in use_order, so it
+        starts out with recency but no frequency information.
+        """
+        policy = CachePolicy.get_policy(name)
+        for key in self.use_order.keys():
+            policy.add(key, self.items[key].size)
+        self.policy = policy
+        self.policy_name = name
+
     def evict_any_page(self):
-        """Evict the least recently used page."""
-        # get ride of least-recently used thing
+        """Evict the page chosen by the replacement policy.
+
+        Returns the size of the page.
+        """
         if len(self.items) > 0:
-            key = self.use_order[0]
+            key = self.policy.victim()
+            size = self.items[key].size
+            self.policy.evict(key)
             self.evict(key)
+            return size
         else:
             raise CacheEmpty
 
     def evict_expired_pages(self):
-        """Evict any pages on the expires list that have expired."""
-        self.expires.sort(compare_expire_items)
-        size = len(self.expires)
-        if size > 0 \
-           and self.expires[0].expires.get_secs() < time.time():
-            index = 0
-            t = time.time()
-            while index < size and self.expires[index].expires.get_secs() < t:
-                index = index + 1
-            for item in self.expires[0:index]:
-                self.evict(item.key)
-            del self.expires[0:index]
+        """Evict any pages on the expires queue that have expired."""
+        for key in self.expires.pop_expired(time.time()):
+            if self.items.has_key(key):
+                self.evict(key)
+
+    def expire_timer(self):
+        """Evict expired pages now and again every expiry_check_period."""
+        if hasattr(self, 'dead'):
+            return
+        self.evict_expired_pages()
+        self._after(self.expiry_check_period, self.expire_timer)
 
     def evict(self,key):
-        """Remove an entry from the cache and delete the file from disk."""
+        """Remove an entry from the cache and delete the file from disk.
+
+        Does nothing if another process has already removed it.
+        """
+        self.lock()
+        try:
+            if self.items.has_key(key):
+                self.__evict(key)
+        finally:
+            self.unlock()
+
+    def __evict(self, key):
         self.use_order.remove(key)
+        self.policy.remove(key)
         evictee = self.items[key]
         del self.manager.items[key]
         del self.items[key]
-        if key in self.expires:
-            self.expires.remove(key)
+        self.expires.remove(key)
         try:
             os.unlink(self.get_file_path(evictee.file))
         except (os.error, IOError), err:
@@ -903,19 +2019,177 @@ class DiskCache:
         self.log_entry(evictee,1) # 1 indicates delete entry
         evictee.delete()
         self.size = self.size - evictee.size
+        self.manager.stats.count('evictions')
+        self.manager.stats.count('evicted-bytes', evictee.size)
+
+class MemoryCache:
+    """Bodies of small cache entries kept in memory.
+
+    A body is read into memory the first time it is served from the
+    disk cache, so only documents that are used again take up room
+    here, and only those of at most max_size / max_object_ratio
+    bytes.  The bodies together take at most max_size bytes; the least
+    recently used go first.
+
+    Bodies are stored with the DiskCacheEntry they were read for.  A
+    replaced or evicted entry is no longer the one in the disk cache,
+    so get() drops its body instead of serving it.
+
+    hits, misses and evictions count what happened to lookups since
+    the cache was created; see get_stats().
+    """
+
+    max_object_ratio = 16
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = self.misses = self.evictions = 0
+        self.clear()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __repr__(self):
+        return "<MemoryCache: %d bodies, %d of %d bytes>" % (
+            len(self.items), self.size, self.max_size)
+
+    def clear(self):
+        self.items = {}
+        self.order = LRUList()
+        self.size = 0
+
+    def set_max_size(self, max_size):
+        self.max_size = max_size
+        self.make_space(0)
+
+    def admit_p(self, entry):
+        """Return true if entry's body may be kept in memory."""
+        return 0 < entry.size <= self.max_size / self.max_object_ratio
+
+    def get(self, entry):
+        """Return the body for entry, or None."""
+        key = entry.key
+        if self.items.has_key(key):
+            if self.items[key][0] is entry:
+                self.hits = self.hits + 1
+                self.order.touch(key)
+                return self.items[key][1]
+            self.remove(key)
+        self.misses = self.misses + 1
+        return None
+
+    def add(self, entry, data):
+        key = entry.key
+        if self.items.has_key(key):
+            self.remove(key)
+        self.make_space(len(data))
+        self.items[key] = entry, data
+        self.order.touch(key)
+        self.size = self.size + len(data)
+
+    def remove(self, key):
+        entry, data = self.items[key]
+        del self.items[key]
+        self.order.remove(key)
+        self.size = self.size - len(data)
+
+    def make_space(self, amount):
+        while self.items and self.size + amount > self.max_size:
+            self.remove(self.order.oldest())
+            self.evictions = self.evictions + 1
+
+    def get_stats(self):
+        """Return a dictionary describing the use of the memory cache."""
+        return {'objects': len(self.items),
+                'bytes': self.size,
+                'max-size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
+
+
+class SpoolFile:
+    """A response body being written to the cache as it arrives.
+
+    The file is written in the spool directory of the disk cache,
+    which is on the same file system as the cache files, so commit()
+    can move it into place with a rename once the body is complete; a
+    crash leaves either no cache file or a whole one.  Until then it
+    also holds the body for the readers of the item: read() can be
+    called at any offset written so far, before or after commit().
+    cacheable is cleared when the body grows too big to keep in the
+    cache, even as a partial entry.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fp = open(path, 'wb')
+        self.rfp = None
+        self.size = 0
+        self.cacheable = 1
+        self.committed = 0
+
+    def write(self, data):
+        self.fp.write(data)
+        # readers use their own file object
+        self.fp.flush()
+        self.size = self.size + len(data)
+
+    def read(self, offset, maxbytes):
+        if not self.rfp:
+            self.rfp = open(self.path, 'rb')
+        self.rfp.seek(offset)
+        return self.rfp.read(min(maxbytes, self.size - offset))
+
+    def close(self):
+        fp = self.fp
+        self.fp = None
+        if fp:
+            fp.close()
+
+    def commit(self, path):
+        self.close()
+        if os.name != 'posix' and os.path.exists(path):
+            # rename() won't replace a file (nor move an open one)
+            if self.rfp:
+                self.rfp.close()
+                self.rfp = None
+            os.unlink(path)
+        os.rename(self.path, path)
+        self.path = path
+        self.committed = 1
+
+    def discard(self):
+        """Close the spool file, and remove it unless it was committed."""
+        rfp = self.rfp
+        self.rfp = None
+        try:
+            self.close()
+            if rfp:
+                rfp.close()
+        except IOError:
+            pass
+        if not self.committed:
+            try:
+                os.unlink(self.path)
+            except os.error:
+                pass
+
 
 class disk_cache_access:
-    """protocol access interface for disk cache"""
+    """protocol access interface for disk cache
+
+    Besides the sequential getdata(), getmap() returns a read-only
+    memory map of the cached file (or None where mmap is unavailable
+    or the file is empty). SharedItem serves cache hits by slicing the
+    map at each reader's offset, so the body is not copied into
+    Python strings for every reader.
+    """
 
     def __init__(self, filename, content_type, date, len,
                  content_encoding, transfer_encoding):
-        self.headers = { 'content-type' : content_type,
-                         'date' : date,
-                         'content-length' : str(len) }
-        if content_encoding:
-            self.headers['content-encoding'] = content_encoding
-        if transfer_encoding:
-            self.headers['content-transfer-encoding'] = transfer_encoding
+        self.set_headers(content_type, date, len,
+                         content_encoding, transfer_encoding)
         self.filename = filename
         try:
             self.fp = open(filename, 'rb')
@@ -923,8 +2197,19 @@ class disk_cache_access:
             print "io error opening %s: %s" % (filename, err)
             # propogate error through
             raise IOError, err
+        self.map = None
         self.state = DATA
 
+    def set_headers(self, content_type, date, len,
+                    content_encoding, transfer_encoding):
+        self.headers = { 'content-type' : content_type,
+                         'date' : date,
+                         'content-length' : str(len) }
+        if content_encoding:
+            self.headers['content-encoding'] = content_encoding
+        if transfer_encoding:
+            self.headers['content-transfer-encoding'] = transfer_encoding
+
     def pollmeta(self):
         return "Ready", 1
 
@@ -941,6 +2226,16 @@ class disk_cache_access:
             self.state = DONE
         return data
 
+    def getmap(self):
+        if self.map is None and mmap and self.fp:
+            try:
+                self.map = mmap.mmap(self.fp.fileno(), 0,
+                                     access=mmap.ACCESS_READ)
+            except (EnvironmentError, ValueError):
+                # e.g. an empty file, which cannot be mapped
+                pass
+        return self.map
+
     def fileno(self):
         try:
             return self.fp.fileno()
@@ -950,6 +2245,8 @@ class disk_cache_access:
     def close(self):
         fp = self.fp
         self.fp = None
+        # the map stays valid for whoever still refers to it
+        self.map = None
         if fp:
             fp.close()
 
@@ -961,6 +2258,39 @@ class disk_cache_access:
         """
         return self.filename, self.headers['content-type']
 
+class memory_cache_access(disk_cache_access):
+    """protocol access interface for a body in the MemoryCache
+
+    The cached file is not opened; getmap() returns the body itself,
+    which SharedItem slices just like a memory map. tk_img_access()
+    still names the file in the disk cache.
+    """
+
+    def __init__(self, data, filename, content_type, date, len,
+                 content_encoding, transfer_encoding):
+        self.set_headers(content_type, date, len,
+                         content_encoding, transfer_encoding)
+        self.filename = filename
+        self.map = data
+        self.offset = 0
+        self.state = DATA
+
+    def getdata(self, maxbytes):
+        data = self.map[self.offset:self.offset+maxbytes]
+        self.offset = self.offset + len(data)
+        if not data:
+            self.state = DONE
+        return data
+
+    def getmap(self):
+        return self.map
+
+    def fileno(self):
+        return -1
+
+    def close(self):
+        self.map = None
+
 class HTTime:
     """Stores time as HTTP string or seconds since epoch or both.
 
@@ -1008,3 +2338,121 @@ class HTTime:
             return self.str
         else:
             return str(None)
+
+
+class _ScratchManager:
+    """Just enough of a CacheManager for a DiskCache outside Grail."""
+    def __init__(self):
+        self.items = {}
+        self.stats = CacheStats()
+    def add_cache(self, cache):
+        pass
+    def close_cache(self, cache):
+        pass
+    def delete(self, keys, evict=1):
+        pass
+    def note_vary(self, key, vary):
+        pass
+
+
+def test(nentries=200):
+    """Add entries to a scratch disk cache, compact it and reopen it."""
+    import tempfile
+    from chunkbuffer import ChunkBuffer
+
+    class Object:
+        def __init__(self, url):
+            self.key = self.url = url
+            self.meta = 200, "OK", {'content-type': 'text/html'}
+            self.data = ChunkBuffer()
+            self.data.append(url)
+            self.datalen = len(url)
+
+    directory = tempfile.mktemp()
+    os.mkdir(directory)
+    try:
+        cache = DiskCache(_ScratchManager(), 1000000, directory)
+        # compact whenever the log holds a dead record; without a Tk
+        # root that happens inside log_entry()
+        cache.compact_min_records = 1
+        cache.compact_ratio = 0
+        for i in range(nentries):
+            url = 'http://test.invalid/%d' % i
+            cache.add(Object(url))
+            if i % 3 == 0:
+                # replace, so the log holds dead records to compact
+                cache.update(Object(url))
+        assert len(cache.items) == nentries
+        cache.close(0)
+
+        cache = DiskCache(_ScratchManager(), 1000000, directory)
+        keys = cache.items.keys()
+        assert len(keys) == nentries, \
+               "%d entries added, %d after reopening" % (nentries, len(keys))
+        for key in keys:
+            f = open(cache.get_file_path(cache.items[key].file))
+            assert f.read() == key
+            f.close()
+        cache.close(0)
+    finally:
+        import shutil
+        shutil.rmtree(directory)
+    print "DiskCache tests passed."
+
+
+def benchmark(nentries=100000, ngets=1000000):
+    """Time LOG replay and get() against a scratch disk cache.
+
+    Writes a text LOG with nentries adds (plus one use update per
+    entry), opens a DiskCache on it (converting it to a journal),
+    reopens the journal, then calls get() ngets times.
+    """
+    import tempfile
+    import random
+
+    directory = tempfile.mktemp()
+    os.mkdir(directory)
+    try:
+        keys = []
+        log = open(os.path.join(directory, 'LOG'), 'w')
+        log.write('3 1.3\n')
+        for i in range(nentries):
+            key = 'http://bench.invalid/%d' % i
+            keys.append(key)
+            log.write('0 %s\t%s\tspam%d\t1\t0\t0\tNone\ttext/html\tNone\tNone\n'
+                      % (key, key, i))
+        for i in range(nentries):
+            log.write('2 %s\n' % random.choice(keys))
+        log.close()
+
+        t0 = time.time()
+        cache = DiskCache(_ScratchManager(), nentries, directory)
+        t1 = time.time()
+        print "converted %d text log entries in %.2f sec" % (2 * nentries,
+                                                           t1 - t0)
+        cache.close(0)
+
+        t0 = time.time()
+        cache = DiskCache(_ScratchManager(), nentries, directory)
+        t1 = time.time()
+        print "replayed %d journal records in %.2f sec" % (cache.log_records,
+                                                         t1 - t0)
+
+        choice = random.choice
+        get = cache.get
+        t0 = time.time()
+        for i in xrange(ngets):
+            get(choice(keys))
+        t1 = time.time()
+        print "%d get() calls in %.2f sec" % (ngets, t1 - t0)
+        cache.close(0)
+    finally:
+        import shutil
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['benchmark']:
+        benchmark()
+    else:
+        test()
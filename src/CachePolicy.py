@@ -0,0 +1,359 @@
+"""Replacement policies for the disk cache.
+
+A policy decides which entry DiskCache.make_space() evicts next.  The
+cache tells its policy about every entry it adds, every hit and every
+entry it removes, asks victim() for the key to evict and confirms with
+evict() when it does evict it.  Policies
+are chosen by name through the 'disk-cache--replacement-policy'
+preference; see get_policy().
+
+The policies are:
+
+lru -- least recently used, ignoring size.
+
+gdsf -- Greedy-Dual-Size-Frequency.  Each entry has priority
+    L + frequency / size, where L is the priority of the last entry
+    evicted.  Small, frequently used pages outlive large ones that
+    were fetched once.
+
+2q -- the 2Q algorithm.  New entries go on a FIFO queue (A1in) that
+    is held to kin_ratio of the cache's bytes; entries evicted from
+    it are remembered in a ghost queue (A1out), and only pages seen
+    again while still remembered move to the main LRU queue (Am).  A
+    single large download passes through A1in without flushing Am.
+
+Run this module as a script to replay a recorded access trace against
+every policy and print byte and object hit ratios:
+
+    python CachePolicy.py [-s KB] tracefile ...
+
+Trace lines are either '<url> <size>' or Squid native access.log lines;
+blank lines and lines starting with '#' are skipped.
+"""
+
+import sys
+if __name__ == '__main__':
+    sys.path.insert(0, 'utils')
+
+import string
+import heapq
+from lrulist import LRUList
+
+
+class ReplacementPolicy:
+    """Interface for disk cache replacement policies.
+
+    add(key, size) -- key was added to the cache
+    touch(key) -- key was read from the cache
+    remove(key) -- key left the cache without being evicted
+    victim() -- the key to evict next; raises IndexError if empty
+    evict(key) -- the victim() key is being evicted; forgets it
+    clear() -- forget all keys
+
+    """
+
+    name = None
+
+    def __init__(self):
+        self.clear()
+
+    def __repr__(self):
+        return "<%s policy, %d keys>" % (self.name, len(self))
+
+    def clear(self):
+        pass
+
+    def __len__(self):
+        return 0
+
+    def add(self, key, size):
+        pass
+
+    def touch(self, key):
+        pass
+
+    def remove(self, key):
+        pass
+
+    def victim(self):
+        raise IndexError, "victim() of empty policy"
+
+    def evict(self, key):
+        self.remove(key)
+
+
+class LRUPolicy(ReplacementPolicy):
+    """Evict the least recently used entry."""
+
+    name = 'lru'
+
+    def clear(self):
+        self.order = LRUList()
+
+    def __len__(self):
+        return len(self.order)
+
+    def add(self, key, size):
+        self.order.touch(key)
+
+    def touch(self, key):
+        if self.order.has_key(key):
+            self.order.touch(key)
+
+    def remove(self, key):
+        if self.order.has_key(key):
+            self.order.remove(key)
+
+    def victim(self):
+        return self.order.oldest()
+
+
+class GDSFPolicy(ReplacementPolicy):
+    """Greedy-Dual-Size-Frequency: evict the lowest L + freq / size.
+
+    Entries sit in a heap of (priority, sequence, key); an entry whose
+    priority changes is pushed again and the old tuple is skipped when
+    it reaches the top.  The sequence number makes the older of two
+    entries with the same priority go first.
+    """
+
+    name = 'gdsf'
+
+    def clear(self):
+        self.inflation = 0.0
+        self.heap = []
+        self.priority = {}              # key -> (priority, sequence)
+        self.sequence = 0
+        self.freq = {}
+        self.size = {}
+
+    def __len__(self):
+        return len(self.priority)
+
+    def __update(self, key):
+        self.sequence = self.sequence + 1
+        entry = (self.inflation
+                 + float(self.freq[key]) / max(self.size[key], 1),
+                 self.sequence)
+        self.priority[key] = entry
+        heapq.heappush(self.heap, entry + (key,))
+        if len(self.heap) > 2 * len(self.priority) + 16:
+            self.heap = []
+            for other, entry in self.priority.items():
+                self.heap.append(entry + (other,))
+            heapq.heapify(self.heap)
+
+    def add(self, key, size):
+        self.freq[key] = self.freq.get(key, 0) + 1
+        self.size[key] = size
+        self.__update(key)
+
+    def touch(self, key):
+        if self.freq.has_key(key):
+            self.freq[key] = self.freq[key] + 1
+            self.__update(key)
+
+    def remove(self, key):
+        if self.freq.has_key(key):
+            del self.priority[key]
+            del self.freq[key]
+            del self.size[key]
+
+    def victim(self):
+        heap = self.heap
+        priority = self.priority
+        while heap and priority.get(heap[0][2]) != heap[0][:2]:
+            heapq.heappop(heap)
+        if not heap:
+            raise IndexError, "victim() of empty policy"
+        return heap[0][2]
+
+    def evict(self, key):
+        if self.priority.has_key(key):
+            # evicting an entry inflates everyone else; only evictions
+            # do, removing a page for another reason says nothing
+            # about what is worth keeping
+            self.inflation = self.priority[key][0]
+            self.remove(key)
+
+
+class TwoQueuePolicy(ReplacementPolicy):
+    """2Q: a byte-bounded FIFO for new entries in front of an LRU."""
+
+    name = '2q'
+
+    # share of the cached bytes that A1in may hold
+    kin_ratio = 0.25
+    # ghost entries remembered, relative to the number of cached keys
+    kout_ratio = 0.5
+
+    def clear(self):
+        self.a1in = LRUList()
+        self.a1out = LRUList()
+        self.am = LRUList()
+        self.size = {}
+        self.a1in_bytes = 0
+        self.total_bytes = 0
+
+    def __len__(self):
+        return len(self.size)
+
+    def add(self, key, size):
+        if self.size.has_key(key):
+            self.remove(key)
+        self.size[key] = size
+        self.total_bytes = self.total_bytes + size
+        if self.a1out.has_key(key):
+            self.a1out.remove(key)
+            self.am.touch(key)
+        else:
+            self.a1in.touch(key)
+            self.a1in_bytes = self.a1in_bytes + size
+
+    def touch(self, key):
+        # hits on A1in are deliberately ignored, that is what keeps
+        # correlated references from promoting a page
+        if self.am.has_key(key):
+            self.am.touch(key)
+
+    def remove(self, key):
+        if not self.size.has_key(key):
+            return
+        size = self.size[key]
+        del self.size[key]
+        self.total_bytes = self.total_bytes - size
+        if self.a1in.has_key(key):
+            self.a1in.remove(key)
+            self.a1in_bytes = self.a1in_bytes - size
+        else:
+            self.am.remove(key)
+
+    def __victim(self):
+        if len(self.a1in) and (self.a1in_bytes
+                               > self.total_bytes * self.kin_ratio
+                               or not len(self.am)):
+            return self.a1in.oldest()
+        if len(self.am):
+            return self.am.oldest()
+        return None
+
+    def victim(self):
+        key = self.__victim()
+        if key is None:
+            raise IndexError, "victim() of empty policy"
+        return key
+
+    def evict(self, key):
+        # only pages evicted from A1in are remembered in A1out
+        ghost = self.a1in.has_key(key)
+        self.remove(key)
+        if ghost:
+            self.a1out.touch(key)
+            while len(self.a1out) > max(1, len(self.size) * self.kout_ratio):
+                self.a1out.remove(self.a1out.oldest())
+
+
+policies = {
+    'lru': LRUPolicy,
+    'gdsf': GDSFPolicy,
+    '2q': TwoQueuePolicy,
+    }
+
+def get_policy(name):
+    """Return a new policy instance by name; unknown names give LRU."""
+    name = string.lower(string.strip(name or ''))
+    if policies.has_key(name):
+        return policies[name]()
+    return LRUPolicy()
+
+
+def read_trace(file):
+    """Return a list of (url, size) pairs from a trace file.
+
+    Accepts '<url> <size>' lines and Squid native access.log lines
+    (time elapsed client code/status bytes method url ...).
+    """
+    trace = []
+    fp = open(file)
+    while 1:
+        line = fp.readline()
+        if not line:
+            break
+        words = string.split(line)
+        if not words or words[0][:1] == '#':
+            continue
+        try:
+            if len(words) >= 7:
+                url, size = words[6], string.atoi(words[4])
+            else:
+                url, size = words[0], string.atoi(words[1])
+        except (IndexError, ValueError):
+            continue
+        trace.append((url, size))
+    fp.close()
+    return trace
+
+def replay_trace(trace, max_size, policy):
+    """Simulate a cache of max_size bytes over trace.
+
+    Returns (object hits, requests, bytes hit, bytes requested).
+    Objects bigger than max_size / 4 are never cached, which is what
+    the default disk-cache--max-object-size amounts to for the default
+    cache size.
+    """
+    resident = {}
+    used = 0
+    hits = requests = byte_hits = byte_requests = 0
+    for url, size in trace:
+        requests = requests + 1
+        byte_requests = byte_requests + size
+        if resident.has_key(url) and resident[url] == size:
+            hits = hits + 1
+            byte_hits = byte_hits + size
+            policy.touch(url)
+            continue
+        if resident.has_key(url):
+            # changed on the server: replace it
+            used = used - resident[url]
+            del resident[url]
+            policy.remove(url)
+        if size > max_size / 4:
+            continue
+        while used + size > max_size:
+            key = policy.victim()
+            used = used - resident[key]
+            del resident[key]
+            policy.evict(key)
+        resident[url] = size
+        used = used + size
+        policy.add(url, size)
+    return hits, requests, byte_hits, byte_requests
+
+def main():
+    import getopt
+    opts, args = getopt.getopt(sys.argv[1:], 's:')
+    max_size = 1024 * 1024
+    for o, a in opts:
+        if o == '-s':
+            max_size = string.atoi(a) * 1024
+    if not args:
+        print "usage: %s [-s KB] tracefile ..." % sys.argv[0]
+        sys.exit(2)
+    trace = []
+    for file in args:
+        trace = trace + read_trace(file)
+    names = policies.keys()
+    names.sort()
+    print "%d requests, cache size %dK" % (len(trace), max_size / 1024)
+    print "%-6s %10s %10s" % ("policy", "object hit", "byte hit")
+    for name in names:
+        hits, requests, byte_hits, byte_requests = \
+              replay_trace(trace, max_size, get_policy(name))
+        print "%-6s %9.1f%% %9.1f%%" % (
+            name,
+            100.0 * hits / max(requests, 1),
+            100.0 * byte_hits / max(byte_requests, 1))
+
+
+if __name__ == '__main__':
+    main()
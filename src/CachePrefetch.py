@@ -0,0 +1,212 @@
+"""Load batches of URLs into the cache ahead of time.
+
+A Prefetcher is given a list of URLs and loads them through the
+CacheManager, a few at a time and at background priority, so the
+pages the user asks for get their sockets first.  Each page is read to
+the end and nobody looks at it: when it is complete the SharedItem
+adds it to the disk cache like any other page.  A page that is already
+in the cache and fresh is left alone; a stale one is revalidated.
+
+The URLs can come from anywhere; bookmark_urls() gets them from a
+bookmarks file and GlobalHistory.recent_urls() from the history.  The
+prefetch.py script and the PREFETCH remote control command (see
+RemoteControl.register_prefetch()) use this to warm the cache.
+"""
+
+import string
+
+import grailutil
+from Cache import META
+from CacheMgr import BackgroundReader
+
+# what became of a URL
+LOADED = 'loaded'                       # read from the network
+CACHED = 'cached'                       # the cached copy is good
+FAILED = 'failed'                       # error response or exception
+SKIPPED = 'skipped'                     # not cacheable: scheme or size
+
+
+class PrefetchLoader(BackgroundReader):
+
+    """Read one URL to the end, to get it into the cache.
+
+    Called back by the api like the Revalidator; tells the Prefetcher
+    what became of the URL with loader_done().
+    """
+
+    def __init__(self, prefetcher, url):
+        self.prefetcher = prefetcher
+        self.url = url
+        self.nbytes = 0
+        params = {'.priority': grailutil.PRIORITY_BACKGROUND}
+        api = prefetcher.manager.open(url, 'GET', params)
+        BackgroundReader.__init__(self, prefetcher.app, api)
+
+    def poll(self):
+        try:
+            status = self.step()
+        except:
+            status = FAILED
+        if status:
+            self.close()
+            self.prefetcher.loader_done(self, status)
+
+    def step(self):
+        api = self.api
+        if api.stage == META:
+            message, ready = api.pollmeta()
+            if not ready:
+                return None
+            errcode, errmsg, headers = api.getmeta()
+            if errcode != 200:
+                return FAILED
+            if api.iscached():
+                # fresh, or validated by the server
+                return CACHED
+            length = -1
+            if headers.has_key('content-length'):
+                try:
+                    length = string.atoi(headers['content-length'])
+                except ValueError:
+                    pass
+            if length > self.size_limit():
+                return SKIPPED
+        limit = self.size_limit()
+        while 1:
+            message, ready = api.polldata()
+            if not ready:
+                return None
+            data = api.getdata(self.bufsize)
+            if not data:
+                # the SharedItem has added it to the cache
+                return LOADED
+            self.nbytes = self.nbytes + len(data)
+            if self.nbytes > limit:
+                # the cache won't keep it; don't waste the bandwidth
+                return SKIPPED
+
+    def size_limit(self):
+        return self.prefetcher.manager.object_size_limit()
+
+
+class Prefetcher:
+
+    """Load a list of URLs into the cache, max_active at a time.
+
+    start() begins loading; callback(prefetcher) is called once every
+    URL has been dealt with, and stop() gives up on the rest.  Each URL
+    ends up in one of the lists of results, keyed by LOADED, CACHED,
+    FAILED and SKIPPED.  Duplicates (URLs with the same cache key) are
+    loaded once.
+    """
+
+    def __init__(self, app, urls, max_active=4, callback=None):
+        self.app = app
+        self.manager = app.url_cache
+        self.max_active = max(max_active, 1)
+        self.callback = callback
+        self.pending = []
+        self.active = []
+        self.results = {LOADED: [], CACHED: [], FAILED: [], SKIPPED: []}
+        self.nbytes = 0
+        self.stopped = 0
+        seen = {}
+        for url in urls:
+            key = self.manager.url2key(url, 'GET', {})
+            if not seen.has_key(key):
+                seen[key] = 1
+                self.pending.append(url)
+        self.pending.reverse()          # pop() from the end
+
+    def start(self):
+        self.fill()
+
+    def stop(self):
+        """Abandon the URLs not loaded yet."""
+        self.stopped = 1
+        self.pending = []
+        active = self.active
+        self.active = []
+        for loader in active:
+            loader.close()
+
+    def done_p(self):
+        return not (self.pending or self.active)
+
+    def fill(self):
+        while self.pending and len(self.active) < self.max_active:
+            url = self.pending.pop()
+            if not self.manager.cacheable_url_p(url):
+                self.results[SKIPPED].append(url)
+                continue
+            try:
+                loader = PrefetchLoader(self, url)
+            except:
+                self.results[FAILED].append(url)
+                continue
+            self.active.append(loader)
+        if self.done_p() and not self.stopped:
+            self.stopped = 1
+            if self.callback:
+                self.callback(self)
+
+    def loader_done(self, loader, status):
+        if loader not in self.active:
+            # stopped meanwhile
+            return
+        self.active.remove(loader)
+        self.results[status].append(loader.url)
+        self.nbytes = self.nbytes + loader.nbytes
+        self.fill()
+
+    def get_stats(self):
+        """Return a dictionary of counts: pending, active, the number
+        of URLs for each result, and bytes loaded."""
+        stats = {'pending': len(self.pending),
+                 'active': len(self.active),
+                 'bytes': self.nbytes}
+        for status, urls in self.results.items():
+            stats[status] = len(urls)
+        return stats
+
+
+def bookmark_urls(filename, folder=None):
+    """Return the URLs of the bookmarks in a bookmarks file.
+
+    If folder is given, only the bookmarks in the folders with that
+    title (and in the folders below them) are returned.  Raises
+    IOError if the file can't be read and
+    bookmarks.BookmarkFormatError if it isn't a bookmarks file.
+    """
+    import bookmarks
+    import bookmarks.walker
+    fp = open(filename, 'rb')
+    try:
+        format = bookmarks.get_format(fp)
+        if not format:
+            raise bookmarks.BookmarkFormatError(filename,
+                                                'unknown bookmarks format')
+        parser = bookmarks.get_parser_class(format)(filename)
+        root = bookmarks.BookmarkReader(parser).read_file(fp)
+    finally:
+        fp.close()
+
+    class URLWalker(bookmarks.walker.TreeWalker):
+        def __init__(self, root, folder):
+            bookmarks.walker.TreeWalker.__init__(self, root)
+            self.folder = folder
+            self.inside = 0             # depth in the chosen folders
+            self.urls = []
+        def start_Folder(self, node):
+            if self.inside or node.title() == self.folder:
+                self.inside = self.inside + 1
+        def end_Folder(self, node):
+            if self.inside:
+                self.inside = self.inside - 1
+        def start_Bookmark(self, node):
+            if (self.inside or self.folder is None) and node.uri():
+                self.urls.append(node.uri())
+
+    walker = URLWalker(root, folder)
+    walker.walk()
+    return walker.urls
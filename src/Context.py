@@ -64,6 +64,7 @@ class Context(URIContext):
         self.set_headers({})
         self.set_postdata(None)
         self.local_api_handlers = {}    # This pages local API handlers
+        self.links = []                 # (url, rel-next) for prefetching
 
     def register_notification(self, callback):
         if callback not in self.notifications:
@@ -78,6 +79,7 @@ class Context(URIContext):
             callback(self)
 
     def clear_reset(self):
+        self.links = []
         self.viewer.clear_reset()
         if self.on_top():
             self.browser.clear_reset()
@@ -98,6 +100,15 @@ class Context(URIContext):
     def get_postdata(self):
         return self.__postdata
 
+    def add_link(self, url, next=0):
+        """Note a link on the page, for the LinkPrefetcher.
+
+        next is true for a <LINK REL=next>.  url is taken relative to
+        the base URL.
+        """
+        if url:
+            self.links.append((self.get_baseurl(url), next))
+
     # Load URL, base URL and target
 
     def set_url(self, url, baseurl=None, target=None, histify=1):
@@ -561,6 +572,7 @@ class Context(URIContext):
 
     def addreader(self, reader):
         self.readers.append(reader)
+        self.app.link_prefetcher.reader_added(self)
         if self.on_top():
             self.browser.allowstop()
         self.new_reader_status()
@@ -575,6 +587,7 @@ class Context(URIContext):
                 self.source.remove_temp_tag(histify=1)
                 self.source = None
             self.notify()
+            self.app.link_prefetcher.context_idle(self)
         self.new_reader_status()
 
     def busy(self):
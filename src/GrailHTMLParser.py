@@ -128,9 +128,11 @@ class GrailHTMLParser(HTMLParser):
             else:
                 utag = '>' + href
             self.viewer.bind_anchors(utag)
+            url = self.context.get_baseurl(href)
             hist = self.app.global_history
-            if hist.inhistory_p(self.context.get_baseurl(href)):
+            if hist.inhistory_p(url):
                 atag = 'ahist'
+            self.context.add_link(url)
         if id and self.register_id(id):
             idtag = id and ('#' + id) or None
         if name and self.register_id(name):
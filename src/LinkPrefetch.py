@@ -0,0 +1,131 @@
+"""Load the documents the user is likely to visit next while idle.
+
+Contexts report the links on their page (Context.add_link()), and when
+the last reader of every context is gone the network is idle.  After
+IDLE_DELAY milliseconds of that the LinkPrefetcher ranks the links of
+the page that finished last and loads the best few into the cache
+with a CachePrefetch.Prefetcher, at most MAX_ACTIVE at a time.
+
+A link ranks higher for being marked <LINK REL=next>, for coming early
+on the page, and for leading to a page the global history says is
+visited often.  Only http: links are loaded; links with a query, links
+back to the page itself and pages already in the cache are left alone.
+Pages too big for the cache are abandoned as soon as that is known.
+
+Any new reader stops the prefetching at once.  A page that is being
+prefetched is a SharedItem in the CacheManager like any other, so when
+the user follows the link the reader shares the load (and lifts it to
+the reader's priority, see SocketQueue.promote()); the others are
+abandoned, keeping what they loaded as partial entries.
+
+The number of links to load is the disk-cache--prefetch-links
+preference; 0 turns prefetching off.
+"""
+
+import urlparse
+
+import CachePrefetch
+
+IDLE_DELAY = 1000                       # milliseconds
+MAX_ACTIVE = 2
+
+# weights of the ranking
+NEXT_WEIGHT = 4.0                       # <LINK REL=next>
+POSITION_WEIGHT = 1.0                   # first link 1.0 down to last 0.0
+VISIT_WEIGHT = 1.0                      # most often visited 1.0
+
+
+class LinkPrefetcher:
+
+    def __init__(self, app):
+        self.app = app
+        self.busy = {}                  # contexts with readers
+        self.context = None             # whose links to load
+        self.timer = None
+        self.prefetcher = None
+        self.set_count()
+        app.prefs.AddGroupCallback('disk-cache', self.set_count)
+
+    def set_count(self):
+        self.count = self.app.prefs.GetInt('disk-cache', 'prefetch-links')
+
+    def reader_added(self, context):
+        """A context started reading; stop prefetching."""
+        self.busy[context] = 1
+        self.stop()
+
+    def context_idle(self, context):
+        """The last reader of context is gone."""
+        if self.busy.has_key(context):
+            del self.busy[context]
+        if context.links:
+            self.context = context
+        if self.busy or not self.context or self.count <= 0:
+            return
+        self.cancel_timer()
+        self.timer = self.app.root.after(IDLE_DELAY, self.start)
+
+    def start(self):
+        self.timer = None
+        context = self.context
+        self.context = None
+        if self.busy or not context:
+            return
+        urls = self.rank(context)
+        if urls:
+            self.prefetcher = CachePrefetch.Prefetcher(
+                self.app, urls, MAX_ACTIVE, self.prefetch_done)
+            self.prefetcher.start()
+
+    def stop(self):
+        self.cancel_timer()
+        prefetcher = self.prefetcher
+        self.prefetcher = None
+        if prefetcher:
+            prefetcher.stop()
+
+    def cancel_timer(self):
+        if self.timer:
+            self.app.root.after_cancel(self.timer)
+            self.timer = None
+
+    def prefetch_done(self, prefetcher):
+        if self.prefetcher is prefetcher:
+            self.prefetcher = None
+
+    def rank(self, context):
+        """Return the URLs of the count best links of context."""
+        manager = self.app.url_cache
+        history = self.app.global_history
+        here = manager.url2key(context.get_url(), 'GET', {})
+        links = context.links
+        candidates = {}
+        for i in range(len(links)):
+            url, next = links[i]
+            url = urlparse.urldefrag(url)[0]
+            scheme, netloc, path, params, query, fragment = \
+                    urlparse.urlparse(url)
+            if scheme != 'http' or query \
+               or not manager.cacheable_url_p(url):
+                continue
+            key = manager.url2key(url, 'GET', {})
+            if key == here or manager.items.has_key(key):
+                continue
+            position = 1.0 - float(i) / len(links)
+            if candidates.has_key(key):
+                old_url, old_next, old_position = candidates[key]
+                next = next or old_next
+                position = max(position, old_position)
+            candidates[key] = url, next, position
+        visits = {}
+        most = 1
+        for key, (url, next, position) in candidates.items():
+            visits[key] = history.visit_count(url)
+            most = max(most, visits[key])
+        ranked = []
+        for key, (url, next, position) in candidates.items():
+            score = next * NEXT_WEIGHT + position * POSITION_WEIGHT \
+                    + float(visits[key]) / most * VISIT_WEIGHT
+            ranked.append((-score, url))
+        ranked.sort()
+        return map(lambda pair: pair[1], ranked[:self.count])
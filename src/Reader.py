@@ -340,6 +340,154 @@ class GzipWrapper:
         self.__parser.close()
 
 
+# HTTP response framers.  A framer is the outermost wrapper (see
+# wrap_parser()): it is fed the raw bytes off the connection, passes
+# the body on and closes the parser it wraps at the end of the body.
+# In addition it knows where the body ends: done becomes true once
+# the whole body has been seen, and any bytes after it are kept in
+# extra.  close() is called at end of file; truncated is then set if
+# the connection was closed before the end of the body.
+
+class CloseFramer:
+    """The body runs until the server closes the connection."""
+
+    def __init__(self, parser):
+        self.__parser = parser
+        self.done = 0
+        self.truncated = 0
+        self.extra = ''
+
+    def feed(self, data):
+        self.__parser.feed(data)
+
+    def close(self):
+        if not self.done:
+            self.done = 1
+            self.__parser.close()
+
+
+class LengthFramer:
+    """The body is Content-Length bytes long."""
+
+    def __init__(self, parser, length):
+        self.__parser = parser
+        self.__remaining = length
+        self.done = 0
+        self.truncated = 0
+        self.extra = ''
+        if length <= 0:
+            self.done = 1
+            parser.close()
+
+    def feed(self, data):
+        if self.done:
+            self.extra = self.extra + data
+            return
+        n = self.__remaining
+        if len(data) < n:
+            self.__remaining = n - len(data)
+            self.__parser.feed(data)
+            return
+        self.__remaining = 0
+        self.extra = data[n:]
+        self.done = 1
+        self.__parser.feed(data[:n])
+        self.__parser.close()
+
+    def close(self):
+        if not self.done:
+            self.done = self.truncated = 1
+            self.__parser.close()
+
+
+class ChunkedFramer:
+    """Decode Transfer-Encoding: chunked.
+
+    Each chunk is a hex size line (possibly with extensions after a
+    semicolon), that many bytes of data and a CRLF; a chunk of size
+    zero is followed by optional trailer lines and an empty line.
+    Trailers are ignored.
+    """
+
+    # states
+    SIZE = 'size'
+    DATA = 'data'
+    DATA_END = 'data end'
+    TRAILER = 'trailer'
+
+    # refuse size and trailer lines longer than this
+    max_line = 4096
+
+    def __init__(self, parser):
+        self.__parser = parser
+        self.__state = self.SIZE
+        self.__remaining = 0
+        self.__buffer = ''
+        self.done = 0
+        self.truncated = 0
+        self.extra = ''
+
+    def feed(self, data):
+        if self.done:
+            self.extra = self.extra + data
+            return
+        data = self.__buffer + data
+        self.__buffer = ''
+        pos = 0
+        while pos < len(data) and not self.done:
+            if self.__state == self.DATA:
+                end = min(pos + self.__remaining, len(data))
+                self.__parser.feed(data[pos:end])
+                self.__remaining = self.__remaining - (end - pos)
+                pos = end
+                if not self.__remaining:
+                    self.__state = self.DATA_END
+                continue
+            i = string.find(data, '\n', pos)
+            if i < 0:
+                self.__buffer = data[pos:]
+                if self.__state == self.DATA_END \
+                   and self.__buffer not in ('', '\r'):
+                    raise IOError, "bad chunked encoding: %s after chunk" \
+                          % `self.__buffer`
+                if len(self.__buffer) > self.max_line:
+                    raise IOError, "bad chunked encoding: line too long"
+                return
+            line = data[pos:i]
+            pos = i + 1
+            if self.__state == self.DATA_END:
+                # the CRLF after the chunk data (a bare LF will do)
+                if line not in ('', '\r'):
+                    raise IOError, \
+                          "bad chunked encoding: %s after chunk" % `line`
+                self.__state = self.SIZE
+                continue
+            line = string.strip(line)
+            if self.__state == self.SIZE:
+                i = string.find(line, ';')
+                if i >= 0:
+                    line = string.strip(line[:i])
+                try:
+                    size = string.atoi(line, 16)
+                except ValueError:
+                    raise IOError, "bad chunked encoding: %s" % `line`
+                if size:
+                    self.__remaining = size
+                    self.__state = self.DATA
+                else:
+                    self.__state = self.TRAILER
+            elif not line:
+                # the empty line after the trailers
+                self.done = 1
+                self.__parser.close()
+        self.extra = data[pos:]
+
+    def close(self):
+        if not self.done:
+            self.done = self.truncated = 1
+            self.__parser.close()
+
+
 # This table maps content-transfer-encoding values to the appropriate
 # decoding wrappers.  It should not be needed with HTTP (1.1 explicitly
 # forbids it), but it's never a good idea to ignore the possibility.
@@ -382,14 +530,45 @@ def get_encodings(headers):
     return content_encoding, transfer_encoding
 
 
-def wrap_parser(parser, ctype, content_encoding=None, transfer_encoding=None):
+def wrap_parser(parser, ctype, content_encoding=None, transfer_encoding=None,
+                framing=None):
     if ctype[:5] == "text/":
         parser = TextLineendWrapper(parser)
     if content_encoding:
         parser = content_decoding_wrappers[content_encoding](parser)
     if transfer_encoding:
         parser = transfer_decoding_wrappers[transfer_encoding](parser)
+    if framing:
+        # (class, args) from get_framing(); it sees the raw bytes
+        framer, args = framing
+        parser = apply(framer, (parser,) + args)
     return parser
+
+
+def get_framing(version, method, errcode, headers):
+    """Return the framing of the body of an HTTP response.
+
+    This is a framer class and the arguments after the parser, for
+    the framing argument of wrap_parser().
+
+    The rules are those of RFC 2616, section 4.4: responses to HEAD and
+    1xx, 204 and 304 responses have no body, then a Transfer-Encoding
+    other than identity means chunked, then Content-Length, and
+    otherwise the body ends when the connection closes.
+    """
+    if method == 'HEAD' or errcode in (204, 304) or 100 <= errcode < 200:
+        return LengthFramer, (0,)
+    if not hasattr(headers, 'getheader'):
+        # HTTP/0.9
+        return CloseFramer, ()
+    te = string.lower(headers.getheader('transfer-encoding') or 'identity')
+    if string.strip(te) != 'identity':
+        return ChunkedFramer, ()
+    try:
+        length = string.atoi(headers.getheader('content-length'))
+    except (TypeError, ValueError):
+        return CloseFramer, ()
+    return LengthFramer, (max(length, 0),)
     
 
 def get_content_encodings():
@@ -957,10 +1136,19 @@ class TransferDisplay:
 
     __datasize = 0
     __prevtime = 0.0
+    __resumed = None
     def write(self, data):
         self.__save_file.write(data)
         datasize = self.__datasize = self.__datasize + len(data)
-        self.__bytes['text'] = datasize
+        if self.__resumed is None:
+            self.__resumed = self.get_resumed()
+            if self.__resumed:
+                self.__bytes['width'] = 0
+        if self.__resumed:
+            self.__bytes['text'] = "%d (resumed after %s)" % (
+                datasize, grailutil.nicebytes(self.__resumed))
+        else:
+            self.__bytes['text'] = datasize
         if self.__progbar:
             self.__progbar.config(
                 width=max(1, int(datasize * (200 / self.__maxsize))))
@@ -971,6 +1159,15 @@ class TransferDisplay:
                 self.root.update_idletasks()
                 self.__prevtime = t
 
+    def get_resumed(self):
+        """Return how much of the data came from an earlier, stopped
+        transfer kept in the cache."""
+        try:
+            resumed = self.__reader.api.resumed
+        except AttributeError:
+            return 0
+        return resumed()
+
     def close(self):
         # make sure the 100% mark is updated on the display:
         self.root.update_idletasks()
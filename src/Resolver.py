@@ -0,0 +1,188 @@
+"""Look up host names without blocking the user interface.
+
+socket.gethostbyname() blocks until the name servers answer, which
+can take seconds for a host not seen before.  A Resolver does the
+lookups on a few worker threads instead.  A thread that is done writes
+a byte to a pipe that Tk watches with a file handler, and the
+callbacks are called from there, in the main thread like all code that
+touches Tk.
+
+Addresses are kept for POSITIVE_TTL seconds and failures for
+NEGATIVE_TTL seconds; the resolver library doesn't tell us the real
+TTLs.  Without threads, or without a Tk root to watch the pipe,
+lookups are done at once and block.
+
+SocketQueue.request_socket() uses this to let a request wait for the
+address of its server before it takes a socket, so the lookups for a
+page with images from many servers run in parallel.
+"""
+
+import os
+import re
+import socket
+import time
+
+try:
+    import threading
+    import Queue
+except ImportError:
+    threading = None
+
+POSITIVE_TTL = 300.0                    # seconds
+NEGATIVE_TTL = 30.0
+MAX_THREADS = 4
+
+addressprog = re.compile('^[0-9]+\\.[0-9]+\\.[0-9]+\\.[0-9]+$')
+
+
+class Resolver:
+
+    """Cache of host name lookups, done by a pool of threads.
+
+    resolve(host, callback) calls callback() once the answer for host
+    is known; lookup() and gethostbyname() then return it from the
+    cache.
+    """
+
+    def __init__(self, app=None, max_threads=MAX_THREADS):
+        self.app = app
+        self.max_threads = max_threads
+        self.cache = {}                 # host -> (expires, address, error)
+        self.callbacks = {}             # host -> callbacks, while looking up
+        self.threads = 0
+        self.pipe = None
+        root = app and getattr(app, 'root', None)
+        if threading and root:
+            try:
+                self.pipe = os.pipe()
+                import Tkinter
+                root.createfilehandler(self.pipe[0], Tkinter.READABLE,
+                                       self.ready)
+            except (AttributeError, os.error):
+                # no createfilehandler() on this platform
+                self.close()
+        if self.pipe:
+            # shared with the worker threads
+            self.todo = Queue.Queue()
+            self.results = Queue.Queue()
+
+    def close(self):
+        pipe = self.pipe
+        self.pipe = None
+        if pipe:
+            try:
+                self.app.root.deletefilehandler(pipe[0])
+            except AttributeError:
+                pass
+            os.close(pipe[0])
+            os.close(pipe[1])
+
+    def known(self, host):
+        """Return true if lookup() has an answer for host."""
+        if addressprog.match(host):
+            return 1
+        return self.get(host) is not None
+
+    def lookup(self, host):
+        """Return the address of host, or None if it isn't known.
+
+        Raises socket.error if the lookup failed.
+        """
+        if addressprog.match(host):
+            return host
+        entry = self.get(host)
+        if entry is None:
+            return None
+        expires, address, error = entry
+        if error:
+            raise socket.error, error
+        return address
+
+    def gethostbyname(self, host):
+        """Like socket.gethostbyname(), but using the cache."""
+        address = self.lookup(host)
+        if address is None:
+            self.store(host, self.do_lookup(host))
+            address = self.lookup(host)
+        return address
+
+    def resolve(self, host, callback):
+        """Call callback() once the answer for host is known.
+
+        If it is known already, callback() is called at once.
+        """
+        if self.known(host):
+            callback()
+            return
+        if not self.pipe:
+            self.store(host, self.do_lookup(host))
+            callback()
+            return
+        if self.callbacks.has_key(host):
+            self.callbacks[host].append(callback)
+            return
+        self.callbacks[host] = [callback]
+        self.todo.put(host)
+        if self.threads < min(len(self.callbacks), self.max_threads):
+            self.threads = self.threads + 1
+            t = threading.Thread(target=self.worker)
+            t.setDaemon(1)
+            t.start()
+
+    def get(self, host):
+        entry = self.cache.get(host)
+        if entry is None:
+            return None
+        if entry[0] <= time.time():
+            del self.cache[host]
+            return None
+        return entry
+
+    def store(self, host, result):
+        address, error = result
+        if error:
+            ttl = NEGATIVE_TTL
+        else:
+            ttl = POSITIVE_TTL
+        self.cache[host] = (time.time() + ttl, address, error)
+
+    def do_lookup(self, host):
+        """Look host up; return (address, error args)."""
+        try:
+            return socket.gethostbyname(host), None
+        except socket.error, msg:
+            return None, msg.args
+
+    def worker(self):
+        # runs in a thread of its own; doesn't touch anything else
+        while 1:
+            host = self.todo.get()
+            self.results.put((host, self.do_lookup(host)))
+            try:
+                os.write(self.pipe[1], 'x')
+            except (os.error, TypeError):
+                # closed
+                return
+
+    def ready(self, fd, mask):
+        os.read(fd, 512)
+        while 1:
+            try:
+                host, result = self.results.get_nowait()
+            except Queue.Empty:
+                break
+            self.store(host, result)
+            callbacks = self.callbacks.get(host, [])
+            if callbacks:
+                del self.callbacks[host]
+            for callback in callbacks:
+                # each one gets its exceptions reported on its own
+                self.app.root.after_idle(callback)
+
+
+def get_resolver(app):
+    try:
+        return app.resolver
+    except AttributeError:
+        app.resolver = Resolver(app)
+        return app.resolver
@@ -4,6 +4,7 @@
 # other Grail is being remote controlled.
 import RemoteControl
 RemoteControl.register_loads()
+RemoteControl.register_prefetch()       # if you want PREFETCH too
 try:
     RemoteControl.start()
 except RemoteControl.ClashError:
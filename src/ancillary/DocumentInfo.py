@@ -53,7 +53,8 @@ class DocumentInfoDialog:
             stretch = stretch or \
                       self.add_text_field("Query fields", query, "query")
         postdata = context.get_postdata()
-        if postdata:
+        # may also be a file being sent
+        if postdata and type(postdata) == type(''):
             postdata = string.translate(postdata, FIELD_BREAKER)
             stretch = stretch or \
                       self.add_text_field("POST fields", postdata, "postdata")
@@ -119,11 +119,22 @@ class GlobalHistory:
 
         urls()
                 Return a list, in order of all URLs on the GlobalHistory.
+
+        recent_urls(n)
+                Return a list of the N URLs visited most recently, the
+                most recent first.
+
+        visit_count(url)
+                Return a rough count of the visits to the URL: one
+                for being on the GlobalHistory at all, plus one for
+                every remember_url() in this session; 0 if it isn't
+                on the GlobalHistory.
     """
     def __init__(self, app, readonly=0):
         self._app = app
         self._urlmap = {}               # for fast lookup
         self._history = []              # to maintain order
+        self._visits = {}               # url -> visits this session
         # first try to load the Grail global history file
         fp = None
         try:
@@ -150,6 +161,7 @@ class GlobalHistory:
         elif not title:
             title, oldts = self._urlmap[url]
         self._urlmap[url] = (title, now())
+        self._visits[url] = self._visits.get(url, 0) + 1
         # Debugging...
 #       print 'remember_url:', url, self._urlmap[url]
 
@@ -164,12 +176,25 @@ class GlobalHistory:
         if self._urlmap.has_key(url): return self._urlmap[url]
         else: return None, None
 
+    def visit_count(self, url):
+        if not self._urlmap.has_key(url):
+            return 0
+        return self._visits.get(url, 0) + 1
+
     def inhistory_p(self, url):
         return self._urlmap.has_key(url)
 
     def urls(self):
         return self._history[:]
 
+    def recent_urls(self, n):
+        visits = []
+        for url, (title, timestamp) in self._urlmap.items():
+            visits.append((timestamp, url))
+        visits.sort()
+        visits.reverse()
+        return map(lambda visit: visit[1], visits[:n])
+
     def on_app_exit(self):
         stdout = sys.stdout
         try:
@@ -61,12 +61,24 @@ class IOStatusPanel:
     def fill_info(self):
         count = 0
         self.infobox.delete(0, END)
+        self.add_socket_info()
         for browser in self.app.browsers:
             count = count+1
             headline = "<Browser %d>" % count
             self.infobox.insert(END, headline)
             self.add_context_info(browser.context)
 
+    def add_socket_info(self):
+        stats = self.app.sq.get_stats()
+        self.infobox.insert(END, "Sockets: %d of %d open, %d servers, "
+                            "%d waiting, %d looking up names"
+                            % (stats['open'], stats['max'], stats['hosts'],
+                               stats['waiting'], stats['resolving']))
+        self.infobox.insert(END, "   %d requests, %d waited, "
+                            "mean wait %.1fs, max wait %.1fs"
+                            % (stats['requests'], stats['waits'],
+                               stats['mean-wait'], stats['max-wait']))
+
     def add_context_info(self, context, level=1):
         indent = "   " * level
         headline = context.get_url() or "<no document>"
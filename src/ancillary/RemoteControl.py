@@ -52,6 +52,18 @@ register_loads()
 unregister_loads()
         unregisters the built-in LOAD and LOADNEW callbacks.
 
+register_prefetch()
+        registers a callback for the command string 'PREFETCH' which
+        loads URLs into the cache in the background (see
+        CachePrefetch).  The cmdargs are either URLs separated by
+        whitespace, 'BOOKMARKS' optionally followed by the title of a
+        folder in the bookmarks file, or 'HISTORY' followed by the
+        number of most recently visited URLs to load.  The reply is
+        'ACK' followed by the number of URLs to be loaded.
+
+unregister_prefetch()
+        unregisters the built-in PREFETCH callback.
+
 
 Exported exceptions:
 
@@ -67,6 +79,7 @@ Example (put this in your grailrc.py file):
 # other Grail is being remote controlled.
 import RemoteControl
 RemoteControl.register_loads()
+RemoteControl.register_prefetch()       # if you want PREFETCH too
 try:
     RemoteControl.start()
 except RemoteControl.ClashError:
@@ -84,6 +97,7 @@ NoHandlerError = 'RemoteControl.NoHandlerError'
 _controller = None
 _filename = None
 _loads_registered = None
+_prefetch_registered = None
 
 def _create():
     global _controller
@@ -121,8 +135,26 @@ def unregister_loads():
         _controller.unregister('LOADNEW', _controller.load_new_cmd)
         _loads_registered = None
 
+def register_prefetch():
+    _create()
+    global _prefetch_registered
+    if not _prefetch_registered:
+        _controller.register('PREFETCH', _controller.prefetch_cmd)
+        _prefetch_registered = 1
+
+def unregister_prefetch():
+    global _prefetch_registered
+    if _prefetch_registered:
+        _controller.unregister('PREFETCH', _controller.prefetch_cmd)
+        _prefetch_registered = None
+
 
 
+import sys
+if __name__ == '__main__':
+    sys.path.insert(0, 'utils')
+    sys.path.insert(0, '.')
+
 import tempfile
 import os
 import socket
@@ -139,7 +171,7 @@ if not _filename:
     XDISPLAY = getenv('DISPLAY') or ':0'
     # normalize the display name
     cre = re.compile('([^:]+)?:([0-9]+)(\\.([0-9]+))?')
-    match = cre.match(XDISPLAY):
+    match = cre.match(XDISPLAY)
     if match:
         host, display, screen = match.group(1, 2, 4)
         if not host:
@@ -168,6 +200,7 @@ class Controller:
         # first.
         self._cbdict = {}
         self._cmdre = re.compile('([^ \\t]+)(.*)')
+        self._prefetchers = []
 
     def start(self):
         """Begin listening for remote control commands."""
@@ -319,9 +352,105 @@ class Controller:
     def load_new_cmd(self, cmdstr, argstr, conn):
         self._do_load(argstr, in_new_window=1)
 
+    def prefetch_cmd(self, cmdstr, argstr, conn):
+        import bookmarks
+        import CachePrefetch
+        words = string.split(argstr)
+        if words[:1] == ['BOOKMARKS']:
+            filename = self._app.prefs.Get('bookmarks', 'bookmark-file')
+            folder = string.join(words[1:]) or None
+            try:
+                urls = CachePrefetch.bookmark_urls(filename, folder)
+            except (IOError, bookmarks.Error):
+                print 'RemoteControl: unable to read bookmarks:', filename
+                urls = []
+        elif words[:1] == ['HISTORY']:
+            try:
+                n = string.atoi(words[1])
+            except (IndexError, ValueError):
+                print 'Remote Control: Ignoring badly formatted command:', \
+                      cmdstr, argstr
+                return
+            urls = self._app.global_history.recent_urls(n)
+        else:
+            urls = words
+        prefetcher = CachePrefetch.Prefetcher(
+            self._app, urls, callback=self._prefetch_done)
+        try:
+            conn.send('ACK %d' % len(prefetcher.pending))
+        except socket.error:
+            print 'RemoteControl: unable to acknowledge PREFETCH'
+        self._prefetchers.append(prefetcher)
+        prefetcher.start()
+
+    def _prefetch_done(self, prefetcher):
+        if prefetcher in self._prefetchers:
+            self._prefetchers.remove(prefetcher)
+
     def ping_cmd(self, cmdstr, argstr, conn):
         try:
             if argstr <> 'NOACK':
                 conn.send('ACK')
         except socket.error:
             print 'RemoteControl: unable to acknowledge PING'
+
+
+def test():
+    """Send PREFETCH commands through the socket of a Controller.
+
+    Uses a stand-in for the Grail application whose cache takes no
+    URLs, so nothing is loaded; checks the replies and that the
+    prefetchers are let go of when they are done.
+    """
+    global _controller
+    class Cache:
+        def url2key(self, url, mode, params):
+            return url
+        def cacheable_url_p(self, url):
+            return 0
+    class History:
+        def recent_urls(self, n):
+            return ['http://a/', 'http://b/', 'http://c/'][:n]
+    class App:
+        url_cache = Cache()
+        global_history = History()
+        def register_on_exit(self, func):
+            pass
+    import grailbase.utils
+    save_app = grailbase.utils._grail_app
+    save_controller = _controller
+    grailbase.utils._grail_app = App()
+    _controller = Controller(tempfile.mktemp())
+    try:
+        register_prefetch()
+        register_prefetch()             # only once
+        assert _controller._cbdict['PREFETCH'] == [_controller.prefetch_cmd]
+        _controller.start()
+        for command, reply in (('PREFETCH http://a/ http://b/ http://a/',
+                                'ACK 2'),
+                               ('PREFETCH HISTORY 2', 'ACK 2'),
+                               ('PREFETCH HISTORY', '')):
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            s.connect(_controller._path)
+            s.send(command)
+            _controller._dispatch()
+            s.setblocking(0)
+            try:
+                got = s.recv(1024)
+            except socket.error:
+                # no reply, and the connection is still open
+                got = ''
+            s.close()
+            assert got == reply, (command, got)
+            assert not _controller._prefetchers
+        unregister_prefetch()
+        assert not _controller._cbdict.get('PREFETCH')
+    finally:
+        _controller._close()
+        _controller = save_controller
+        grailbase.utils._grail_app = save_app
+    print "RemoteControl tests passed."
+
+
+if __name__ == '__main__':
+    test()
@@ -30,9 +30,12 @@ for path in 'utils', 'pythonlib', 'ancillary', 'applets', script_dir:
 
 import getopt
 import string
+import time
+import socket
 import urllib
 import tempfile
 import posixpath
+from collections import deque
 
 # More imports
 import filetypes
@@ -46,7 +49,9 @@ import BaseApplication
 import grailbase.GrailPrefs
 import Stylesheet
 from CacheMgr import CacheManager
+from LinkPrefetch import LinkPrefetcher
 from ImageCache import ImageCache
+from Resolver import Resolver
 from Authenticate import AuthenticationManager
 import GlobalHistory
 
@@ -193,43 +198,256 @@ class URLReadWrapper:
 
 class SocketQueue:
 
-    def __init__(self, max_sockets):
+    """Share the application's sockets among waiting requests.
+
+    At most max sockets are open at once, and at most max_per_host of
+    them to any one server, so a slow server can't take every socket.
+    Requests wait by priority (lower numbers first; see the PRIORITY_*
+    constants in grailutil), and within a priority the servers take
+    turns, each serving its own requests in order.
+
+    A request that is still waiting is cancelled by return_socket(),
+    in constant time: it is only forgotten here and its queue entry
+    is skipped when it comes up.  promote() moves a waiting request
+    to a better priority the same way.
+
+    A request may also wait for the resolver to look up the name of
+    its server first; it doesn't queue for a socket until then.
+
+    """
+
+    def __init__(self, max_sockets, max_per_host=None, resolver=None):
         self.max = max_sockets
-        self.blocked = []
-        self.callbacks = {}
+        self.max_per_host = max_per_host or max_sockets
+        self.resolver = resolver
         self.open = 0
-
-    def change_max(self, new_max):
-        old_max = self.max
+        self.owners = {}                # owner -> host
+        self.per_host = {}              # host -> sockets open
+        self.waiting = {}               # requestor -> queue entry
+        self.resolving = {}             # requestor -> entry, until resolved
+        self.queues = {}                # priority -> {host: deque}
+        self.rings = {}                 # priority -> deque of hosts
+        self.reclaimers = []
+        # statistics, for the I/O status panel
+        self.requests = 0
+        self.waits = 0
+        self.granted = 0                # waits that got a socket
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    def add_reclaimer(self, reclaim):
+        """Register a function that can give back an idle socket.
+
+        When a request has to wait, each reclaimer is called in turn
+        until one returns true; it is expected to close an idle socket
+        and call return_socket().
+        """
+        self.reclaimers.append(reclaim)
+
+    def change_max(self, new_max, new_max_per_host=None):
         self.max = new_max
-        if old_max < new_max and len(self.blocked) > 0:
-            for i in range(0,min(new_max-old_max, len(self.blocked))):
-                # run wild free sockets
-                self.open = self.open + 1
-                self.callbacks[self.blocked[0]]()
-                del self.callbacks[self.blocked[0]]
-                del self.blocked[0]
-            
-
-    def request_socket(self, requestor, callback):
+        self.max_per_host = new_max_per_host or self.max_per_host
+        # run wild free sockets
+        self.dispatch()
+
+    def request_socket(self, requestor, callback, host=None, priority=0,
+                       name=None):
+        """Call callback() once requestor may open a socket to host.
+
+        If name is given, the requestor first waits until the
+        resolver knows the address of the host of that name.  If the
+        lookup fails, callback() is called without a socket, at once;
+        it finds the error when it asks the resolver for the address.
+        """
+        self.requests = self.requests + 1
+        entry = (requestor, callback, host, time.time(), priority)
+        if name and self.resolver:
+            if not self.resolver.known(name):
+                self.resolving[requestor] = entry
+                self.resolver.resolve(name, lambda self=self, r=requestor,
+                                      name=name: self.resolved(r, name))
+                return
+            if self.lookup_failed(name):
+                callback()
+                return
+        self.queue_request(entry)
+
+    def resolved(self, requestor, name):
+        entry = self.resolving.get(requestor)
+        if not entry:
+            return
+        del self.resolving[requestor]
+        if self.lookup_failed(name):
+            entry[1]()
+            return
+        self.queue_request(entry)
+
+    def lookup_failed(self, name):
+        # don't wait for a socket just to fail
+        try:
+            self.resolver.lookup(name)
+        except socket.error:
+            return 1
+        return 0
+
+    def queue_request(self, entry):
+        requestor, callback, host = entry[:3]
+        if not self.waiting and self.may_open(host):
+            self.take(requestor, host)
+            callback()
+            return
+        self.enqueue(entry)
         if self.open >= self.max:
-            self.blocked.append(requestor)
-            self.callbacks[requestor] = callback
+            for reclaim in self.reclaimers:
+                if reclaim():
+                    break
         else:
-            self.open = self.open + 1
-            callback()
+            # another server may have a free turn
+            self.dispatch()
+        if self.waiting.get(requestor) is entry:
+            self.waits = self.waits + 1
+
+    def promote(self, requestor, priority):
+        """Let a waiting requestor wait at priority from now on.
+
+        Nothing changes unless the requestor is waiting at a lower
+        priority (a higher number).
+        """
+        entry = self.resolving.get(requestor)
+        if entry:
+            if entry[4] > priority:
+                self.resolving[requestor] = entry[:4] + (priority,)
+            return
+        entry = self.waiting.get(requestor)
+        if not entry or entry[4] <= priority:
+            return
+        # the old queue entry is skipped when it comes up
+        self.enqueue(entry[:4] + (priority,))
+        self.dispatch()
 
     def return_socket(self, owner):
-        if owner in self.blocked:
+        if self.resolving.has_key(owner):
+            # still looking up its server
+            del self.resolving[owner]
+        elif self.waiting.has_key(owner):
             # died before its time
-            self.blocked.remove(owner)
-            del self.callbacks[owner]
-        elif len(self.blocked) > 0:
-            self.callbacks[self.blocked[0]]()  # apply callback
-            del self.callbacks[self.blocked[0]]
-            del self.blocked[0]
+            del self.waiting[owner]
+        elif self.owners.has_key(owner):
+            self.release(owner)
+            self.dispatch()
+
+    def transfer(self, owner, new_owner, host=None):
+        """Pass owner's socket on to new_owner, as its socket to host.
+
+        If new_owner is waiting for a socket, it gets this one now and
+        its callback is called.
+        """
+        self.release(owner)
+        entry = self.waiting.get(new_owner)
+        if entry:
+            del self.waiting[new_owner]
+            self.grant(entry)
         else:
-            self.open = self.open - 1
+            self.take(new_owner, host)
+
+    def find_waiting(self, test):
+        """Return the first waiting requestor for which test() is true."""
+        for entry in self.waiting.values():
+            if test(entry[0]):
+                return entry[0]
+        return None
+
+    def get_stats(self):
+        """Return a dictionary of counters for the I/O status panel."""
+        oldest = 0.0
+        now = time.time()
+        for entry in self.waiting.values():
+            oldest = max(oldest, now - entry[3])
+        return {'open': self.open,
+                'max': self.max,
+                'waiting': len(self.waiting),
+                'resolving': len(self.resolving),
+                'hosts': len(self.per_host),
+                'requests': self.requests,
+                'waits': self.waits,
+                'mean-wait': self.wait_time / max(self.granted, 1),
+                'max-wait': max(self.max_wait, oldest),
+                }
+
+    def enqueue(self, entry):
+        requestor, callback, host, when, priority = entry
+        self.waiting[requestor] = entry
+        queues = self.queues.get(priority)
+        if queues is None:
+            queues = self.queues[priority] = {}
+            self.rings[priority] = deque()
+        queue = queues.get(host)
+        if queue is None:
+            queue = queues[host] = deque()
+            self.rings[priority].append(host)
+        queue.append(entry)
+
+    def may_open(self, host):
+        return self.open < self.max \
+               and self.per_host.get(host, 0) < self.max_per_host
+
+    def take(self, owner, host):
+        self.open = self.open + 1
+        self.owners[owner] = host
+        if host is not None:
+            self.per_host[host] = self.per_host.get(host, 0) + 1
+
+    def release(self, owner):
+        self.open = self.open - 1
+        host = self.owners[owner]
+        del self.owners[owner]
+        if host is not None:
+            n = self.per_host[host] - 1
+            if n:
+                self.per_host[host] = n
+            else:
+                del self.per_host[host]
+
+    def grant(self, entry):
+        requestor, callback, host, when, priority = entry
+        wait = time.time() - when
+        self.granted = self.granted + 1
+        self.wait_time = self.wait_time + wait
+        self.max_wait = max(self.max_wait, wait)
+        self.take(requestor, host)
+        callback()
+
+    def dispatch(self):
+        while self.waiting and self.open < self.max:
+            entry = self.next_entry()
+            if not entry:
+                break
+            del self.waiting[entry[0]]
+            self.grant(entry)
+
+    def next_entry(self):
+        """Dequeue the next request that may open a socket, or None."""
+        priorities = self.queues.keys()
+        priorities.sort()
+        for priority in priorities:
+            queues = self.queues[priority]
+            ring = self.rings[priority]
+            for i in range(len(ring)):
+                host = ring[0]
+                ring.rotate(-1)
+                queue = queues[host]
+                # skip cancelled requests
+                while queue and self.waiting.get(queue[0][0]) is not queue[0]:
+                    queue.popleft()
+                if not queue:
+                    del queues[host]
+                    ring.pop()
+                elif self.per_host.get(host, 0) < self.max_per_host:
+                    return queue.popleft()
+            if not ring:
+                del self.queues[priority]
+                del self.rings[priority]
+        return None
 
 class Application(BaseApplication.BaseApplication):
 
@@ -250,12 +468,16 @@ class Application(BaseApplication.BaseApplication):
 
         # socket management
         sockets = self.prefs.GetInt('sockets', 'number')
-        self.sq = SocketQueue(sockets)
+        per_host = self.prefs.GetInt('sockets', 'per-host')
+        self.resolver = Resolver(self)
+        self.sq = SocketQueue(sockets, per_host, self.resolver)
         self.prefs.AddGroupCallback('sockets',
                                     lambda self=self: \
                                     self.sq.change_max(
                                         self.prefs.GetInt('sockets',
-                                                          'number')))
+                                                          'number'),
+                                        self.prefs.GetInt('sockets',
+                                                          'per-host')))
 
         # initialize on_exit_methods before global_history
         self.on_exit_methods = []
@@ -263,6 +485,7 @@ class Application(BaseApplication.BaseApplication):
         self.login_cache = {}
         self.rexec_cache = {}
         self.url_cache = CacheManager(self)
+        self.link_prefetcher = LinkPrefetcher(self)
         self.image_cache = ImageCache(self.url_cache)
         self.auth = AuthenticationManager(self)
         self.root.report_callback_exception = self.report_callback_exception
@@ -0,0 +1,18 @@
+"""<LINK> tag support for Grail.
+
+Only REL=next is used so far: the document it names is the first one
+the LinkPrefetcher loads when the browser is idle.
+"""
+
+ATTRIBUTES_AS_KEYWORDS = 1
+
+import string
+from grailutil import extract_keyword
+
+
+def do_link(parser, attrs):
+    href = extract_keyword('href', attrs)
+    rel = string.split(string.lower(extract_keyword('rel', attrs) or ''))
+    if href and 'next' in rel:
+        parser.context.add_link(string.joinfields(string.split(href), ''),
+                                next=1)
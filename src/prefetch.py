@@ -0,0 +1,174 @@
+#! /usr/bin/env python
+
+"""Load pages into Grail's disk cache ahead of time.
+
+Usage: %(program)s [options] [url ...]
+
+Loads the URLs given on the command line, and those selected with the
+options below, into the disk cache, so a Grail started later finds
+them there.  Pages already cached and fresh are not loaded again.  A
+Grail process that is running can share the cache (see the
+disk-cache--shared preference).
+
+Options:
+    -f FILE, --file FILE : load the URLs listed in FILE, one per line
+                           ('-' for standard input)
+    -b FILE, --bookmarks FILE : load the bookmarks in FILE ('-' for the
+                           bookmarks file in the preferences)
+    -F TITLE, --folder TITLE : only the bookmarks in folders called TITLE
+    -H N, --history N : load the N URLs of the global history visited
+                        most recently
+    -n N, --concurrency N : load at most N pages at a time (default 4)
+    -q, --quiet : only report pages that could not be loaded
+    -h, --help : print this message
+
+The exit status is 1 if a page could not be loaded.
+"""
+
+import os
+import sys
+
+script_name = sys.argv[0]
+while 1:
+    script_dir = os.path.dirname(script_name)
+    if not os.path.islink(script_name):
+        break
+    script_name = os.path.join(script_dir, os.readlink(script_name))
+script_dir = os.path.normpath(os.path.join(os.getcwd(), script_dir))
+sys.path.insert(0, script_dir)
+
+import getopt
+import string
+import traceback
+
+import grail
+import bookmarks
+import grailutil
+# protocol modules get the User-agent from __main__
+from grail import GRAILVERSION
+import CachePrefetch
+
+
+class Application(grail.Application):
+
+    """A browser without windows that doesn't save its history."""
+
+    def __init__(self, prefs=None):
+        grail.Application.__init__(self, prefs)
+        self.unregister_on_exit(self.global_history.on_app_exit)
+
+    def exc_dialog(self, message, exc, val, tb, root=None):
+        sys.stderr.write("exception %s:\n" % message)
+        traceback.print_exception(exc, val, tb)
+
+    def error_dialog(self, exc, msg, root=None):
+        sys.stderr.write("%s: %s\n" % (exc, msg))
+
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'f:b:F:H:n:qh',
+                                   ['file=', 'bookmarks=', 'folder=',
+                                    'history=', 'concurrency=', 'quiet',
+                                    'help'])
+    except getopt.error, message:
+        usage(2, message)
+    files = []
+    bookmark_files = []
+    folder = None
+    history = 0
+    concurrency = 4
+    quiet = 0
+    try:
+        for o, a in opts:
+            if o in ('-f', '--file'):
+                files.append(a)
+            elif o in ('-b', '--bookmarks'):
+                bookmark_files.append(a)
+            elif o in ('-F', '--folder'):
+                folder = a
+            elif o in ('-H', '--history'):
+                history = string.atoi(a)
+            elif o in ('-n', '--concurrency'):
+                concurrency = string.atoi(a)
+            elif o in ('-q', '--quiet'):
+                quiet = 1
+            elif o in ('-h', '--help'):
+                usage(0)
+    except ValueError:
+        usage(2, "%s needs a number" % o)
+
+    app = Application()
+    urls = map(grailutil.complete_url, args)
+    for filename in files:
+        if filename == '-':
+            fp = sys.stdin
+        else:
+            try:
+                fp = open(filename)
+            except IOError, (err, message):
+                error(1, "could not open %s: %s" % (filename, message))
+        for line in fp.readlines():
+            line = string.strip(line)
+            if line and line[0] != '#':
+                urls.append(grailutil.complete_url(line))
+    for filename in bookmark_files:
+        if filename == '-':
+            filename = app.prefs.Get('bookmarks', 'bookmark-file')
+        try:
+            urls = urls + CachePrefetch.bookmark_urls(filename, folder)
+        except IOError, (err, message):
+            error(1, "could not open %s: %s" % (filename, message))
+        except bookmarks.Error, err:
+            error(1, str(err))
+    if history:
+        urls = urls + app.global_history.recent_urls(history)
+    if not urls:
+        usage(2, "no URLs to load")
+
+    prefetcher = CachePrefetch.Prefetcher(app, urls, concurrency,
+                                          lambda p, app=app: app.quit())
+    prefetcher.start()
+    if not prefetcher.done_p():
+        app.go()
+    else:
+        app.exit_notification()
+
+    results = prefetcher.results
+    if not quiet:
+        for status in (CachePrefetch.LOADED, CachePrefetch.CACHED,
+                       CachePrefetch.SKIPPED):
+            for url in results[status]:
+                print "%-8s %s" % (status, url)
+    for url in results[CachePrefetch.FAILED]:
+        sys.stderr.write("%-8s %s\n" % (CachePrefetch.FAILED, url))
+    if not quiet:
+        stats = prefetcher.get_stats()
+        print "%d loaded (%s), %d cached, %d failed, %d skipped" % (
+            stats[CachePrefetch.LOADED],
+            grailutil.nicebytes(stats['bytes']),
+            stats[CachePrefetch.CACHED], stats[CachePrefetch.FAILED],
+            stats[CachePrefetch.SKIPPED])
+    if results[CachePrefetch.FAILED]:
+        sys.exit(1)
+
+
+def usage(err=0, message=''):
+    if err:
+        sys.stdout = sys.stderr
+    program = os.path.basename(sys.argv[0])
+    if message:
+        print "%s: %s" % (program, message)
+        print
+    print __doc__ % {"program": program}
+    sys.exit(err)
+
+
+def error(err, message):
+    program = os.path.basename(sys.argv[0])
+    sys.stderr.write("%s: %s\n" % (program, message))
+    sys.exit(err)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,8 @@ __version__ = "$Revision: 1.14 $"
 import PrefsPanels
 
 from Tkinter import *
+import grailutil
+import string
 import tktools
 
 
@@ -59,6 +61,65 @@ class CachePanel(PrefsPanels.Framework):
         self.RegisterUI('disk-cache', 'freshness-test-period', 'float',
                         e.get, self.widget_set_func(e))
 
+    def CreatePolicyButtons(self, frame):
+        policy_frame = Frame(frame)
+        l = Label(policy_frame, text="Replacement:")
+        radio = StringVar(frame)
+        l.pack(side=LEFT)
+        for text, value in (("LRU", 'lru'),
+                            ("Size & frequency (GDSF)", 'gdsf'),
+                            ("2Q", '2q')):
+            Radiobutton(policy_frame, text=text, variable=radio,
+                        value=value).pack(side=LEFT)
+        policy_frame.pack()
+
+        self.RegisterUI('disk-cache', 'replacement-policy', 'string',
+                        radio.get, radio.set)
+
+    def CreateStatistics(self, frame):
+        """Show how well the cache is doing, to help choose its size.
+
+        The full set of counters is at grail:cache-stats.
+        """
+        stats_frame = Frame(frame)
+        l = Label(stats_frame, text="Statistics:", anchor=NE, width=10)
+        self.stats_label = Label(stats_frame, justify=LEFT, anchor=W)
+        buttons = Frame(stats_frame)
+        Button(buttons, text="Update",
+               command=self.UpdateStatistics).pack(side=TOP, fill=X)
+        Button(buttons, text="Reset",
+               command=self.ResetStatistics).pack(side=TOP, fill=X)
+        l.pack(side=LEFT, anchor=N)
+        buttons.pack(side=RIGHT)
+        self.stats_label.pack(side=LEFT, fill=X, expand=1)
+        stats_frame.pack(fill=X)
+        self.UpdateStatistics()
+
+    def UpdateStatistics(self):
+        stats = self.app.url_cache.get_stats()
+        get = stats.get
+        lines = [
+            "%d requests, %.1f%% served from the cache (%.1f%% of bytes)"
+            % (get('requests', 0), 100 * get('hit-ratio'),
+               100 * get('byte-hit-ratio')),
+            "Verified with the server: %d unchanged, %d changed"
+            % (get('not-modified', 0), get('modified', 0)),
+            "Evicted to make room: %d documents, %s"
+            % (get('policy-evictions', 0),
+               grailutil.nicebytes(get('policy-evicted-bytes', 0))),
+            "Too big to cache: %d documents" % get('too-big', 0),
+            "In use: %s of %s on disk, %s of %s in memory"
+            % (grailutil.nicebytes(get('disk-bytes', 0)),
+               grailutil.nicebytes(get('disk-max-size', 0)),
+               grailutil.nicebytes(get('memory-bytes', 0)),
+               grailutil.nicebytes(get('memory-max-size', 0))),
+            ]
+        self.stats_label['text'] = string.join(lines, '\n')
+
+    def ResetStatistics(self):
+        self.app.url_cache.stats.clear()
+        self.UpdateStatistics()
+
     def CreateLayout(self, name, frame):
 
         # size plus clear buttons
@@ -88,11 +149,55 @@ class CachePanel(PrefsPanels.Framework):
         self.RegisterUI('disk-cache', 'size', 'int',
                         e.get, self.widget_set_func(e))
 
+        # largest object to cache
+        f = Frame(frame)
+        l = Label(f, text="Largest document:")
+        e2 = Entry(f, relief=SUNKEN, width=8)
+        l2 = Label(f, text="KB")
+        l.pack(side=LEFT)
+        l2.pack(side=RIGHT)
+        e2.pack(side=RIGHT)
+        f.pack()
+        self.RegisterUI('disk-cache', 'max-object-size', 'int',
+                        e2.get, self.widget_set_func(e2))
+
+        # memory for small documents read again and again
+        f = Frame(frame)
+        l = Label(f, text="Memory cache:")
+        e3 = Entry(f, relief=SUNKEN, width=8)
+        l3 = Label(f, text="KB")
+        l.pack(side=LEFT)
+        l3.pack(side=RIGHT)
+        e3.pack(side=RIGHT)
+        f.pack()
+        self.RegisterUI('disk-cache', 'memory-size', 'int',
+                        e3.get, self.widget_set_func(e3))
+
+        # links to load ahead of time
+        f = Frame(frame)
+        l = Label(f, text="Prefetch when idle:")
+        e4 = Entry(f, relief=SUNKEN, width=8)
+        l4 = Label(f, text="links")
+        l.pack(side=LEFT)
+        l4.pack(side=RIGHT)
+        e4.pack(side=RIGHT)
+        f.pack()
+        self.RegisterUI('disk-cache', 'prefetch-links', 'int',
+                        e4.get, self.widget_set_func(e4))
+
         # cache directory
         e, l, f = tktools.make_labeled_form_entry(frame, "Directory:")
         self.RegisterUI('disk-cache', 'directory', 'string',
                         e.get, self.widget_set_func(e))
 
         self.CreateRadioButtons(frame)
+        self.PrefsCheckButton(frame, "Stale documents:",
+                              "Show at once, verify in the background",
+                              'disk-cache', 'revalidate-in-background')
+        self.CreatePolicyButtons(frame)
+        self.PrefsCheckButton(frame, "Sharing:",
+                              "Let other Grail processes use the cache",
+                              'disk-cache', 'shared')
+        self.CreateStatistics(frame)
 
         frame.pack()
@@ -43,6 +43,9 @@ class GeneralPanel(PrefsPanels.Framework):
         self.PrefsEntry(frame, 'Max. connections:', 'sockets', 'number', 'int',
                         entry_width=3) 
 
+        self.PrefsEntry(frame, 'Per server:', 'sockets', 'per-host', 'int',
+                        entry_width=3)
+
         self.PrefsCheckButton(frame, "Image loading:", "Load inline images",
                               'browser', 'load-images')
 
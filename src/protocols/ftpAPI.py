@@ -23,12 +23,15 @@ from urlparse import urljoin
 import mimetools
 from Assert import Assert
 import grailutil
+import Resolver
 import socket
+import sys
 
 app = grailutil.get_grailapp()          # app.guess_type(url)
 
 
 # Stages
+RESOLVE = 'RESOLVE'                     # looking up the host name
 META = 'META'
 DATA = 'DATA'
 EOF = 'EOF'
@@ -83,7 +86,6 @@ class ftp_access:
         user, host = splituser(host)
         if user: user, passwd = splitpasswd(user)
         else: passwd = None
-        host = socket.gethostbyname(host)
         if port:
             try:
                 port = string.atoi(port)
@@ -110,20 +112,56 @@ class ftp_access:
             else:
                 type = 'i'
         if dirs and not dirs[0]: dirs = dirs[1:]
-        key = (user, host, port, string.joinfields(dirs, '/'))
         self.debuglevel = None
+        for attr in attrs:
+            [attr, value] = map(string.lower, splitvalue(attr))
+            if attr == 'type' and value in ('a', 'i', 'd'):
+                type = value
+            elif attr == 'debug':
+                try:
+                    self.debuglevel = string.atoi(value)
+                except string.atoi_error:
+                    pass
+        self.args = (user, passwd, host, port, dirs, file, type)
+        self.sock = self.cand = None
+        self.reader_start = None
+        self.error = None
+        self.resolver = Resolver.get_resolver(app)
+        if self.resolver.known(host):
+            self.connect()
+        else:
+            # connect once the resolver has found the server
+            self.state = RESOLVE
+            self.resolver.resolve(host, self.resolved)
+
+    def register_reader(self, reader_start, ignore):
+        if self.state == RESOLVE:
+            self.reader_start = reader_start
+        else:
+            reader_start()
+
+    def resolved(self):
+        if self.state != RESOLVE:
+            # closed meanwhile
+            return
+        try:
+            self.connect()
+        except:
+            # raised by pollmeta()
+            self.error = sys.exc_info()
+            self.state = META
+        reader_start = self.reader_start
+        self.reader_start = None
+        if reader_start:
+            reader_start()
+
+    def connect(self):
+        user, passwd, host, port, dirs, file, type = self.args
+        host = self.resolver.gethostbyname(host)
+        key = (user, host, port, string.joinfields(dirs, '/'))
         try:
             if not ftpcache.has_key(key):
                 ftpcache[key] = []
-            for attr in attrs:
-                [attr, value] = map(string.lower, splitvalue(attr))
-                if attr == 'type' and value in ('a', 'i', 'd'):
-                    type = value
-                elif attr == 'debug':
-                    try:
-                        self.debuglevel = string.atoi(value)
-                    except string.atoi_error:
-                        pass
             candidates = ftpcache[key]
             for cand in candidates:
                 if not cand.busy():
@@ -141,11 +179,17 @@ class ftp_access:
         self.state = META
 
     def pollmeta(self):
+        if self.state == RESOLVE:
+            return "looking up host", 0
         Assert(self.state == META)
+        self.raise_error()
         return "Ready", 1
 
     def getmeta(self):
+        if self.state == RESOLVE:
+            self.connect()
         Assert(self.state == META)
+        self.raise_error()
         self.state = DATA
         headers = {}
         if self.isdir:
@@ -247,10 +291,19 @@ class ftp_access:
         s = s.replace('>', '&gt;')
         return s
 
+    def raise_error(self):
+        error = self.error
+        if error:
+            self.error = None
+            raise error[0], error[1], error[2]
+
     def fileno(self):
-        return self.sock.fileno()
+        if self.sock:
+            return self.sock.fileno()
+        return -1
 
     def close(self):
+        self.state = DONE
         sock = self.sock
         cand = self.cand
         self.sock = None
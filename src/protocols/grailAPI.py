@@ -1,17 +1,65 @@
-"""grail: URI scheme handler."""
+"""grail: URI scheme handler.
 
+Most grail: URLs name files found along the Grail path, and are
+redirected to file: URLs.  The names in pages are instead generated
+from the state of the browser, e.g. grail:cache-stats.
+"""
+
+from Assert import Assert
 import grailutil
+import nullAPI
+import string
 import urllib
-from nullAPI import null_access
 
-class grail_access(null_access):
+
+def cache_stats():
+    """Cache statistics as plain text, one 'name: value' line each.
+
+    See CacheMgr.CacheStats for what the counters mean.
+    """
+    stats = grailutil.get_grailapp().url_cache.get_stats()
+    names = stats.keys()
+    names.sort()
+    lines = []
+    for name in names:
+        value = stats[name]
+        if type(value) == type(0.0) and name != 'since':
+            value = "%.4f" % value
+        else:
+            value = str(int(value))
+        lines.append("%s: %s\n" % (name, value))
+    return 'text/plain', string.join(lines, '')
+
+pages = {
+    'cache-stats': cache_stats,
+    }
+
+
+class grail_access(nullAPI.null_access):
 
     def __init__(self, url, method, params):
-        null_access.__init__(self, url, method, params)
+        nullAPI.null_access.__init__(self, url, method, params)
+        if pages.has_key(url):
+            self.ctype, self.data = pages[url]()
+            self.url = None
+            return
         file = grailutil.which(url)
         if not file: raise IOError, "Grail file %s not found" % `url`
         self.url = "file:" + urllib.pathname2url(file)
 
     def getmeta(self):
-        null_access.getmeta(self)       # assert, state change
+        nullAPI.null_access.getmeta(self) # assert, state change
+        if self.url is None:
+            return 200, "OK", {'content-type': self.ctype,
+                               'content-length': `len(self.data)`}
         return 301, "Redirected", {'location': self.url}
+
+    def getdata(self, maxbytes):
+        if self.url is not None:
+            return nullAPI.null_access.getdata(self, maxbytes)
+        Assert(self.state == nullAPI.DATA)
+        data = self.data[:maxbytes]
+        self.data = self.data[maxbytes:]
+        if not data:
+            self.state = nullAPI.DONE
+        return data
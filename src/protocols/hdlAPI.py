@@ -20,14 +20,32 @@ XXX Remaining problems:
            experimenting with solutions in the future.  This should be
            good enough for now.
 
-           Handle resolution is done synchronously, thereby defeating
-           the intended asynchronous API.  This should be fixed by
-           adding an asynchronous interface to hdllib.py.
+Resolution is asynchronous: each hdl_access sends its requests with
+hdllib.HashTable.send_request() over a UDP socket of its own, which
+fileno() returns so the reader can wait for the replies with a Tk file
+handler, and pollmeta() never blocks.  A Tk timer calls the reader back
+when a request is due to be resent or to time out.  Handles are thus
+resolved in parallel.  Each request goes to the FANOUT fastest
+servers of the handle's bucket (see hdllib.HashTable.choose_servers()).
+
+Hash tables and resolutions are kept in a HandleCache, a file in the
+grail directory shared by all Grail processes.  The global hash table
+is fetched from the global server when first needed, and kept for
+HASH_TABLE_TTL seconds, as are the local hash tables of the
+authorities whose handles the global servers don't know; a handle of
+such an authority is sent to its local server straight away.  The
+items a handle resolved to are kept for ITEMS_TTL seconds.  When a
+local server doesn't know a handle either, its hash table is dropped
+from the cache and the handle is looked up from the start.
 
 """
 
+import os
 import sys
 import string
+import marshal
+import socket
+import time
 import urllib
 import hdllib
 import nullAPI
@@ -37,6 +55,22 @@ import grailutil
 # We are currently only concerned with URL type handles.
 HANDLE_TYPES = [hdllib.HDL_TYPE_URL]
 
+# How long the HandleCache keeps things, in seconds
+HASH_TABLE_TTL = 24*3600                # global and local hash tables
+ITEMS_TTL = 3600                        # the items of a handle
+
+CACHE_FILE = 'handle-cache'             # in the grail directory
+
+# How many servers of a bucket to ask at once; the first reply wins
+FANOUT = 2
+
+# Stages of a resolution, named after the request in progress
+GLOBAL = 'global'                       # the global hash table
+QUERY = 'query'                         # the handle
+LOCAL = 'local'                         # the local hash table's handle
+SERVICE = 'service'                     # the service handle it names
+LOCAL_QUERY = 'local query'             # the handle, at the local server
+
 
 # HTML boilerplate for response on handle with multiple URLs
 HTML_HEADER = """<HTML>
@@ -98,27 +132,86 @@ def escape(s):
     s = s.replace(">", "&gt;")
     return s
 
-class hdl_access(nullAPI.null_access):
+class HandleCache:
 
-    _types = HANDLE_TYPES
+    """Persistent cache of hash tables and handle resolutions.
 
-    try:
-        #print "Fetching global hash table"
-        _global_hashtable = hdllib.fetch_global_hash_table()
-    except hdllib.Error, inst:
-        raise IOError, inst, sys.exc_traceback
+    The entries map keys to (expiry time, value) pairs and are kept
+    marshalled in a file.  The file is read when the cache is created
+    and written after each change, merged with the changes other Grail
+    processes made meanwhile.
+
+    The keys are ('global',) and ('local', authority) for the data of
+    the hash tables, and ('items', handle, types, server) for the
+    items of a handle.
+    """
+
+    version = 1
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = self.read()
+
+    def read(self):
+        try:
+            fp = open(self.filename, 'rb')
+            try:
+                version, entries = marshal.load(fp)
+            finally:
+                fp.close()
+        except (IOError, EOFError, ValueError, TypeError):
+            return {}
+        if version != self.version:
+            return {}
+        return entries
+
+    def get(self, key):
+        """Return the value for key, or None if missing or expired."""
+        if self.entries.has_key(key):
+            expires, value = self.entries[key]
+            if expires > time.time():
+                return value
+            del self.entries[key]
+        return None
+
+    def put(self, key, value, ttl):
+        self.update(key, (time.time() + ttl, value))
+
+    def remove(self, key):
+        self.update(key, None)
+
+    def update(self, key, entry):
+        entries = self.read()
+        if entry:
+            entries[key] = entry
+        elif entries.has_key(key):
+            del entries[key]
+        now = time.time()
+        for k, (expires, value) in entries.items():
+            if expires <= now:
+                del entries[k]
+        self.entries = entries
+        tempname = "%s.%d" % (self.filename, os.getpid())
+        try:
+            fp = open(tempname, 'wb')
+            try:
+                marshal.dump((self.version, entries), fp)
+            finally:
+                fp.close()
+            os.rename(tempname, self.filename)
+        except (IOError, os.error):
+            pass
+
+
+class hdl_access(nullAPI.null_access):
 
-    _hashtable = _global_hashtable
+    _types = HANDLE_TYPES
 
-    _local_hashtables = {}
+    # Shared by all instances, set up when first needed
+    _global_hashtable = None
+    _cache = None
 
-    def get_local_hash_table(self, hdl):
-        key = hdllib.get_authority(hdl)
-        if not self._local_hashtables.has_key(key):
-            #print "Fetching local hash table for", key
-            self._local_hashtables[key] = hdllib.fetch_local_hash_table(
-                key, self._global_hashtable)
-        return self._local_hashtables[key]
+    _hashtable = None                   # the server attribute's
 
     def __init__(self, hdl, method, params):
         self._msgattrs = {"title": "Ambiguous handle resolution",
@@ -156,42 +249,221 @@ class hdl_access(nullAPI.null_access):
                 if formatter:
                     self._formatter = formatter
 
+        server = None
         if self._attrs.has_key('server'):
-            self._hashtable = hdllib.HashTable(server=self._attrs['server'])
+            server = self._attrs['server']
+            self._hashtable = hdllib.HashTable(server=server)
+
+        if not self._cache:
+            hdl_access._cache = HandleCache(
+                os.path.join(grailutil.getgraildir(), CACHE_FILE))
+        self._authority = hdllib.get_authority(self._hdl)
+        self._key = ('items', self._hdl, tuple(self._types), server)
+        self._items = self._cache.get(self._key)
+        self._cached_table = 0          # the local hash table was cached
+        self._then = None               # what to send after GLOBAL
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._request = None
+        self._reader_callback = None
+        self._timer = None
+        if self._items is None:
+            try:
+                self._start()
+            except (hdllib.Error, socket.error), inst:
+                self.close()
+                raise IOError, inst, sys.exc_traceback
+
+    def register_reader(self, reader_start, reader_callback):
+        self._reader_callback = reader_callback
+        reader_start()
+        self._schedule()
+
+    def fileno(self):
+        if self._sock:
+            return self._sock.fileno()
+        return -1
 
     def pollmeta(self):
         nullAPI.null_access.pollmeta(self)
         try:
-            replyflags, self._items = self._hashtable.get_data(
-                self._hdl, self._types)
-        except hdllib.Error, inst:
-            if inst.err == hdllib.HP_HANDLE_NOT_FOUND:
-                #print "Retry using a local handle server"
-                try:
-                    self._hashtable = self.get_local_hash_table(
-                        self._hdl)
-                    replyflags, self._items = self._hashtable.get_data(
-                        self._hdl, self._types)
-                except hdllib.Error, inst:
-                    # (Same comment as below)
-                    raise IOError, inst, sys.exc_traceback
-                else:
-                    return 'Ready', 1
+            ready = self._poll()
+        except (hdllib.Error, socket.error), inst:
+            self._close_request()
             # Catch all errors and raise an IOError.  The Grail
             # protocol extension defines this as the only error we're
             # allowed to raise.
             # Because the hdllib.Error instance is passed, no
             # information is lost.
             raise IOError, inst, sys.exc_traceback
-        else:
+        if ready:
             return 'Ready', 1
+        self._schedule()
+        return 'Resolving handle', 0
 
     def getmeta(self):
+        while self.pollmeta()[1] == 0:
+            self._request.wait()
         nullAPI.null_access.getmeta(self)
         self._data = ""
         self._pos = 0
         return self._formatter(self)
 
+    def close(self):
+        self._cancel_timer()
+        self._close_request()
+        sock = self._sock
+        self._sock = None
+        if sock:
+            sock.close()
+        nullAPI.null_access.close(self)
+
+    def _send(self, stage, hashtable, hdl, types,
+              command=hdllib.HP_QUERY, response=hdllib.HP_QUERY_RESPONSE):
+        self._stage = stage
+        self._request = hashtable.send_request(hdl, types,
+                                               command=command,
+                                               response=response,
+                                               sock=self._sock,
+                                               fanout=FANOUT)
+
+    def _start(self):
+        """Send the first request, to the server most likely to know."""
+        if self._hashtable:
+            self._send(QUERY, self._hashtable, self._hdl, self._types)
+            return
+        data = self._cache.get(('local', self._authority))
+        if data:
+            self._hashtable = hdllib.HashTable(data=data)
+            self._cached_table = 1
+            self._send(LOCAL_QUERY, self._hashtable, self._hdl, self._types)
+        else:
+            self._with_global(self._query)
+
+    def _with_global(self, send):
+        """Call send() once the global hash table is known."""
+        if not self._global_hashtable:
+            data = self._cache.get(('global',))
+            if data:
+                hdl_access._global_hashtable = hdllib.HashTable(data=data)
+        if self._global_hashtable:
+            send()
+            return
+        #print "Fetching global hash table"
+        self._then = send
+        self._send(GLOBAL,
+                   hdllib.HashTable(server=hdllib.DEFAULT_GLOBAL_SERVER),
+                   "/service-pointer", [],
+                   command=hdllib.HP_HASH_REQUEST,
+                   response=hdllib.HP_HASH_RESPONSE)
+
+    def _query(self):
+        self._send(QUERY, self._global_hashtable, self._hdl, self._types)
+
+    def _local(self):
+        """Send the handle to its authority's local server."""
+        data = self._cache.get(('local', self._authority))
+        if data:
+            self._hashtable = hdllib.HashTable(data=data)
+            self._send(LOCAL_QUERY, self._hashtable, self._hdl, self._types)
+        else:
+            self._with_global(self._fetch_local)
+
+    def _fetch_local(self):
+        #print "Fetching local hash table for", self._authority
+        self._send(LOCAL, self._global_hashtable,
+                   hdllib.local_hash_table_handle(self._hdl),
+                   hdllib.SERVICE_TYPES)
+
+    def _poll(self):
+        """Advance the resolution; return true once self._items is set.
+
+        Raises hdllib.Error if the handle can't be resolved.
+        """
+        while self._items is None:
+            if not self._poll_request():
+                return 0
+            flags, items = self._request.get_reply()
+            self._close_request()
+            self._next(items)
+        return 1
+
+    def _next(self, items):
+        """Take the next step after a reply; set self._items at the end."""
+        if self._stage in (QUERY, LOCAL_QUERY):
+            self._items = items
+            self._cache.put(self._key, items, ITEMS_TTL)
+            return
+        hashtable, handle = hdllib.parse_service_items(items)
+        if self._stage == GLOBAL:
+            if not hashtable:
+                raise hdllib.Error("Didn't get the global hash table")
+            hdl_access._global_hashtable = hdllib.HashTable(data=hashtable)
+            self._cache.put(('global',), hashtable, HASH_TABLE_TTL)
+            send = self._then
+            self._then = None
+            send()
+        elif hashtable:
+            self._hashtable = hdllib.HashTable(data=hashtable)
+            self._cache.put(('local', self._authority), hashtable,
+                            HASH_TABLE_TTL)
+            self._send(LOCAL_QUERY, self._hashtable, self._hdl, self._types)
+        elif handle and self._stage == LOCAL:
+            self._send(SERVICE, self._global_hashtable, handle,
+                       [hdllib.HDL_TYPE_SERVICE_POINTER])
+        else:
+            raise hdllib.Error("Didn't get a hash table")
+
+    def _poll_request(self):
+        try:
+            return self._request.poll()
+        except hdllib.Error, inst:
+            if inst.err != hdllib.HP_HANDLE_NOT_FOUND:
+                raise
+            if self._stage == QUERY:
+                retry = self._local
+            elif self._stage == LOCAL_QUERY and self._cached_table:
+                # The cached hash table may be out of date
+                self._cache.remove(('local', self._authority))
+                self._cached_table = 0
+                retry = lambda self=self: self._with_global(self._query)
+            else:
+                raise
+        #print "Retry using a local handle server"
+        self._close_request()
+        retry()
+        return 0
+
+    def _close_request(self):
+        request = self._request
+        self._request = None
+        if request:
+            request.close()
+
+    def _schedule(self):
+        """Call the reader back when the request is due to be resent."""
+        self._cancel_timer()
+        if not self._reader_callback:
+            return
+        if self._request:
+            delay = max(0, self._request.deadline() - time.time())
+        elif self._items is not None:
+            # resolved from the cache
+            delay = 0
+        else:
+            return
+        self._timer = self.app.root.after(int(delay * 1000) + 1,
+                                          self._wakeup)
+
+    def _cancel_timer(self):
+        if self._timer:
+            self.app.root.after_cancel(self._timer)
+            self._timer = None
+
+    def _wakeup(self):
+        self._timer = None
+        if self._reader_callback:
+            self._reader_callback()
+
     def formatter(self, alterego=None):
         if len(self._items) == 1 and self._items[0][0] == hdllib.HDL_TYPE_URL:
             return 302, 'Moved', {'location': self._items[0][1]}
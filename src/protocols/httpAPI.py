@@ -9,24 +9,34 @@ XXX Main deficiencies:
 
 - poll*() always returns ready
 - should read the headers more carefully (no blocking)
-- (could even *write* the headers more carefully)
-- should poll the connection making part too
+
+The connection is made and the request written without blocking: once
+the SocketQueue grants a socket, http_access goes through the CONNECTING
+and SENDING stages driven by a Tk file handler for writing, and only
+then tells its reader to start (see register_reader()).  A request
+body may be a string or a file-like object; either is sent a block at
+a time, and chunked if its length isn't known.
 
 """
 
 
 import string
+import errno
 import httplib
-from urllib import splithost
+from urllib import splithost, splitport
 import mimetools
+import os
 from Assert import Assert
 import grailutil
 import select
 import Reader
+import Resolver
 import re
 import StringIO
 import socket
 import sys
+import time
+import Tkinter
 from __main__ import GRAILVERSION
 
 
@@ -43,24 +53,132 @@ endofheaders = re.compile('\\n[ \\t]*\\r?\\n')
 
 
 # Stages
-# there are now five stages
+# there are now seven stages
 WAIT = 'wait'  # waiting for a socket
+CONNECTING = 'connecting'
+SENDING = 'sending'
 META = 'meta'
 DATA = 'data'
 DONE = 'done'
 CLOS = 'closed'
 
+# connect_ex() and send() results meaning "not yet"
+PENDING = (errno.EINPROGRESS, errno.EALREADY, errno.EWOULDBLOCK,
+           errno.EAGAIN, getattr(errno, 'WSAEWOULDBLOCK', errno.EWOULDBLOCK))
+
+
+class RequestBody:
+    """The body of a request, read a block at a time for sending.
+
+    The data is a string or a file-like object.  The length of a file
+    is found with seek() and tell() if it has them; a body of unknown
+    length is sent with the chunked transfer coding.  rewind() starts
+    over, for sending the request again.
+    """
+
+    blocksize = 8*1024
+
+    def __init__(self, data):
+        self.data = data
+        self.start = 0
+        self.length = None
+        if type(data) == type(''):
+            self.length = len(data)
+        else:
+            try:
+                self.start = data.tell()
+                data.seek(0, 2)
+                self.length = data.tell() - self.start
+                data.seek(self.start)
+            except (AttributeError, IOError):
+                self.start = None
+        self.chunked = self.length is None
+        self.pos = 0
+        self.eof = 0
+
+    def rewind(self):
+        if self.pos:
+            if self.start is None:
+                raise IOError, "can't send the request body again"
+            if type(self.data) != type(''):
+                self.data.seek(self.start)
+        self.pos = 0
+        self.eof = 0
+
+    def read(self):
+        """Return the next block to send, or '' at the end."""
+        if self.eof:
+            return ''
+        if type(self.data) == type(''):
+            block = self.data[self.pos:self.pos + self.blocksize]
+        else:
+            block = self.data.read(self.blocksize)
+        self.pos = self.pos + len(block)
+        if not self.chunked:
+            self.eof = not block
+            return block
+        if block:
+            return "%x\r\n%s\r\n" % (len(block), block)
+        self.eof = 1
+        return "0\r\n\r\n"
+
+
+class BodyBuffer:
+    """End of a framer chain: keeps the decoded body until it is read."""
+
+    def __init__(self):
+        self.__chunks = []
+        self.closed = 0
+
+    def __len__(self):
+        return len(self.__chunks)
+
+    def feed(self, data):
+        if data:
+            self.__chunks.append(data)
+
+    def close(self):
+        self.closed = 1
+
+    def read(self, maxbytes):
+        if not self.__chunks:
+            return ''
+        data = self.__chunks[0]
+        if len(data) <= maxbytes:
+            del self.__chunks[0]
+            return data
+        self.__chunks[0] = data[maxbytes:]
+        return data[:maxbytes]
+
+
 class MyHTTPConnection(httplib.HTTPConnection):
 
     def putrequest(self, request, selector):
         self.selector = selector
-        httplib.HTTPConnection.putrequest(self, request, selector)
+        # http_access sends its own Host and Accept-Encoding headers
+        httplib.HTTPConnection.putrequest(self, request, selector,
+                                          skip_host=1,
+                                          skip_accept_encoding=1)
+
+    def get_request(self):
+        """Return the request line and headers put so far.
+
+        Like endheaders(), but http_access sends them itself.
+        """
+        self._buffer.extend(("", ""))
+        request = string.join(self._buffer, "\r\n")
+        del self._buffer[:]
+        return request
 
 
 class MyHTTP(httplib.HTTP):
 
     _connection_class = MyHTTPConnection
 
+    # we can frame chunked responses, so ask for HTTP/1.1
+    _http_vsn = 11
+    _http_vsn_str = 'HTTP/1.1'
+
     def __init__(self, host='', port=None, strict=None):
         "Provide a default host, since the superclass requires one."
 
@@ -110,6 +228,139 @@ class MyHTTP(httplib.HTTP):
         self._conn.sock = None
 
 
+class ConnectionPool:
+
+    """Idle HTTP connections kept open for reuse.
+
+    Connections are keyed by (host, port, proxied).  A connection is
+    only handed back by http_access.close() once its response has been
+    read exactly to the end, so the next request can be sent on it.
+
+    Idle connections count against the application's socket limit:
+    each keeps the SocketQueue slot of the request that used it last,
+    though not against the limit per server.
+    checkin() hands a connection straight to a waiting request for the
+    same server, or closes it if requests for other servers are
+    waiting.  When a request has to wait, the oldest idle connection
+    is closed to make room.  Connections idle longer than idle_timeout
+    seconds are closed, and at most max_idle_per_host are kept per
+    server.
+
+    """
+
+    idle_timeout = 15.0
+    max_idle_per_host = 2
+
+    def __init__(self, app):
+        self.app = app
+        self.idle = {}                  # key -> [(sock, time), ...]
+        self.order = []                 # (key, sock), oldest first
+        self.sweeping = 0
+        app.sq.add_reclaimer(self.reclaim)
+
+    def checkin(self, owner, key, sock):
+        """Take a connection whose response has been read completely.
+
+        The owner's socket slot goes with it.
+        """
+        sq = self.app.sq
+        requestor = sq.find_waiting(
+            lambda r, key=key: getattr(r, 'pool_key', None) == key)
+        if requestor:
+            requestor.pooled_sock = sock
+            sq.transfer(owner, requestor)
+            return
+        # parked connections hold a slot but don't count against
+        # their server
+        sq.transfer(owner, sock)
+        idle = self.idle.get(key, [])
+        if sq.waiting or len(idle) >= self.max_idle_per_host:
+            self.discard(sock)
+            return
+        idle.append((sock, time.time()))
+        self.idle[key] = idle
+        self.order.append((key, sock))
+        self.schedule_sweep()
+
+    def checkout(self, key):
+        """Return an idle connection for key, or None.
+
+        The caller holds its own socket slot, so the slot of the idle
+        connection is given back.
+        """
+        idle = self.idle.get(key)
+        while idle:
+            sock, t = idle[-1]
+            self.forget(key, sock)
+            self.app.sq.return_socket(sock)
+            if self.alive(sock):
+                return sock
+            self.close_sock(sock)
+        return None
+
+    def reclaim(self):
+        """Close the oldest idle connection; return true if there was one."""
+        if not self.order:
+            return 0
+        key, sock = self.order[0]
+        self.forget(key, sock)
+        self.discard(sock)
+        return 1
+
+    def sweep(self):
+        self.sweeping = 0
+        limit = time.time() - self.idle_timeout
+        for key, sock in self.order[:]:
+            for s, t in self.idle[key]:
+                if s is sock:
+                    if t < limit:
+                        self.forget(key, sock)
+                        self.discard(sock)
+                    break
+        self.schedule_sweep()
+
+    def schedule_sweep(self):
+        if self.order and not self.sweeping:
+            self.sweeping = 1
+            self.app.root.after(int(self.idle_timeout * 1000), self.sweep)
+
+    def forget(self, key, sock):
+        idle = self.idle[key]
+        for i in range(len(idle)):
+            if idle[i][0] is sock:
+                del idle[i]
+                break
+        if not idle:
+            del self.idle[key]
+        self.order.remove((key, sock))
+
+    def discard(self, sock):
+        self.close_sock(sock)
+        self.app.sq.return_socket(sock)
+
+    def alive(self, sock):
+        # an idle connection has nothing to say; if it is readable the
+        # server has closed it (or sent garbage)
+        try:
+            return not select.select([sock], [], [], 0)[0]
+        except (select.error, socket.error):
+            return 0
+
+    def close_sock(self, sock):
+        try:
+            sock.close()
+        except socket.error:
+            pass
+
+
+def get_pool(app):
+    try:
+        return app.http_pool
+    except AttributeError:
+        app.http_pool = ConnectionPool(app)
+        return app.http_pool
+
+
 class http_access:
 
     def __init__(self, resturl, method, params, data=None):
@@ -117,18 +368,92 @@ class http_access:
         self.args = (resturl, method, params, data)
         self.state = WAIT
         self.h = None
-        self.reader_callback = None
-        self.app.sq.request_socket(self, self.open)
+        self.readers = []               # (start, callback) per reader
+        self.unstarted = []             # start()s to call once sent
+        self.watching = None            # fd with our handler for writing
+        self.error = None               # raised by pollmeta()
+        self.address = None             # of the server, once looked up
+        self.pooled_sock = None
+        self.reusable = 0
+        self.pool_key = self.get_pool_key(resturl)
+        priority = params.get('.priority', grailutil.PRIORITY_DOCUMENT)
+        name = None
+        if self.pool_key:
+            # look the server up before taking a socket; if there is
+            # an idle connection to it, it is known already
+            name = self.pool_key[0]
+            self.resolver = Resolver.get_resolver(self.app)
+            # called before the SocketQueue hears of the answer; the
+            # address is kept in case it expires while we wait
+            self.resolver.resolve(name, self.resolved)
+        self.app.sq.request_socket(self, self.open, self.pool_key, priority,
+                                   name)
+
+    def resolved(self):
+        try:
+            self.address = self.resolver.lookup(self.pool_key[0])
+        except socket.error:
+            # open() asks again
+            pass
+
+    def get_pool_key(self, resturl):
+        if type(resturl) == type(()):
+            host, proxied = resturl[0], 1
+        else:
+            host, proxied = splithost(resturl)[0], 0
+        if not host:
+            return None
+        i = string.find(host, '@')
+        if i >= 0:
+            host = host[i+1:]
+        host, port = splitport(string.lower(host))
+        try:
+            port = string.atoi(port)
+        except (TypeError, ValueError):
+            port = httplib.HTTP_PORT
+        return host, port, proxied
 
-    def register_reader(self, reader_callback, ignore):
+    def promote(self, priority):
+        """Wait for a socket at priority, if that is better."""
         if self.state == WAIT:
-            self.reader_callback = reader_callback
+            self.app.sq.promote(self, priority)
+
+    def register_reader(self, reader_start, reader_callback):
+        self.readers.append((reader_start, reader_callback))
+        if self.state in (WAIT, CONNECTING, SENDING):
+            self.unstarted.append(reader_start)
         else:
             # we've been waitin' fer ya
-            reader_callback()
+            reader_start()
 
     def open(self):
         Assert(self.state == WAIT)
+        if self.pool_key and self.address is None \
+           and not self.pooled_sock:
+            # the lookup failed; find out again without blocking, the
+            # answer may have expired
+            self.resolver.resolve(self.pool_key[0], self.reopen)
+            return
+        try:
+            self.start_request()
+        except (socket.error, IOError):
+            # raised by pollmeta()
+            self.error = sys.exc_info()
+            self.sent()
+
+    def reopen(self):
+        if self.state != WAIT:
+            # closed meanwhile
+            return
+        try:
+            self.address = self.resolver.lookup(self.pool_key[0])
+        except socket.error:
+            self.error = sys.exc_info()
+            self.sent()
+            return
+        self.open()
+
+    def start_request(self):
         resturl, method, params, data = self.args
         if data:
             Assert(method=="POST")
@@ -150,7 +475,46 @@ class http_access:
             auth = string.strip(base64.encodestring(user_passwd))
         else:
             auth = None
+        sock = self.pooled_sock
+        self.pooled_sock = None
+        if not sock:
+            sock = get_pool(self.app).checkout(self.pool_key)
+        if data:
+            data = RequestBody(data)
+        self.send_request(host, selector, method, params, data, auth, sock)
+        self.watch()
+
+    def send_request(self, host, selector, method, params, data, auth,
+                     sock=None):
+        """Start connecting, unless sock is connected already.
+
+        The request is written by send_some().
+        """
+        self.request = (host, selector, method, params, data, auth)
+        self.reused = sock is not None
         self.h = MyHTTP(host)
+        if data:
+            data.rewind()
+        self.outbuf = self.format_request(host, selector, method, params,
+                                          data, auth)
+        self.source = data
+        if sock:
+            sock.setblocking(0)
+            self.state = SENDING
+        else:
+            if self.address is None:
+                # open() looks the server up; here it would block
+                raise socket.error, "address of %s unknown" % self.pool_key[0]
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(0)
+            err = sock.connect_ex((self.address, self.h._conn.port))
+            if err and err not in PENDING:
+                sock.close()
+                raise socket.error, (err, os.strerror(err))
+            self.state = CONNECTING
+        self.h._conn.sock = sock
+
+    def format_request(self, host, selector, method, params, data, auth):
         self.h.putrequest(method, selector)
         self.h.putheader('User-agent', GRAILVERSION)
         if auth:
@@ -166,26 +530,144 @@ class http_access:
         for key, value in params.items():
             if key[:1] != '.':
                 self.h.putheader(key, value)
-        self.h.putheader('Accept', '*/*')
-        self.h.endheaders()
         if data:
-            self.h.send(data)
+            for key in params.keys():
+                if string.lower(key) in ('content-length',
+                                         'transfer-encoding'):
+                    break
+            else:
+                if data.chunked:
+                    self.h.putheader('Transfer-Encoding', 'chunked')
+                else:
+                    self.h.putheader('Content-Length', str(data.length))
+        self.h.putheader('Accept', '*/*')
+        self.h.putheader('Connection', 'keep-alive')
+        return self.h._conn.get_request()
+
+    def writable(self, fd, mask):
+        try:
+            self.send_some()
+        except (socket.error, IOError):
+            self.unwatch()
+            self.error = sys.exc_info()
+            self.sent()
+
+    def send_some(self):
+        """Connect and write as much of the request as we can."""
+        sock = self.h._conn.sock
+        if self.state == CONNECTING:
+            err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err in PENDING:
+                return
+            if err:
+                raise socket.error, (err, os.strerror(err))
+            self.state = SENDING
+        while 1:
+            if not self.outbuf and self.source:
+                self.outbuf = self.source.read()
+                if not self.outbuf:
+                    self.source = None
+            if not self.outbuf:
+                break
+            try:
+                n = sock.send(self.outbuf)
+            except socket.error, msg:
+                if msg.args[0] in PENDING:
+                    return
+                if self.reused:
+                    # the server closed the idle connection; start afresh
+                    self.reconnect()
+                    return
+                raise
+            self.outbuf = self.outbuf[n:]
+        self.unwatch()
+        self.sent()
+
+    def reconnect(self):
+        """Send the request again, on a new connection."""
+        self.unwatch()
+        self.h.close()
+        apply(self.send_request, self.request)
+        self.watch()
+
+    def finish_sending(self):
+        """Connect and write the whole request, blocking."""
+        while self.state in (CONNECTING, SENDING):
+            sock = self.h._conn.sock
+            try:
+                select.select([], [sock], [])
+            except select.error, msg:
+                raise IOError, msg, sys.exc_traceback
+            self.send_some()
+
+    def sent(self):
+        """The request is out (or failed); let the reader start."""
+        if self.h and self.h._conn.sock:
+            self.h._conn.sock.setblocking(1)
         self.readahead = ""
         self.state = META
         self.line1seen = 0
-        if self.reader_callback:
-            self.reader_callback()
+        # readers started before a resend() are watching already
+        starts = self.unstarted
+        self.unstarted = []
+        for reader_start in starts:
+            reader_start()
+
+    def watch(self):
+        """Call send_some() whenever the socket is writable."""
+        fd = self.h._conn.sock.fileno()
+        try:
+            self.app.root.createfilehandler(fd, Tkinter.WRITABLE,
+                                            self.writable)
+        except AttributeError:
+            # no file handlers here
+            self.finish_sending()
+        else:
+            self.watching = fd
+
+    def unwatch(self):
+        fd = self.watching
+        self.watching = None
+        if fd is not None:
+            self.app.root.deletefilehandler(fd)
 
     def close(self):
-        if self.h:
-            self.h.close()
+        self.unwatch()
+        self.readers = []
+        self.unstarted = []
+        h = self.h
+        self.h = None
+        if h and self.state == DONE and self.reusable and self.pool_key:
+            # keep the connection and our socket slot for the next request
+            sock = h._conn.sock
+            h._conn.sock = None
+            h.close()
+            self.state = CLOS
+            get_pool(self.app).checkin(self, self.pool_key, sock)
+            return
+        if h:
+            h.close()
         if self.state != CLOS:
             self.app.sq.return_socket(self)
             self.state = CLOS
-        self.h = None
 
     def pollmeta(self, timeout=0):
+        if self.state in (CONNECTING, SENDING) and timeout is None:
+            self.unwatch()
+            try:
+                self.finish_sending()
+            except (socket.error, IOError):
+                self.error = sys.exc_info()
+                self.sent()
+        if self.state == WAIT:
+            # a reader polling before we have a socket
+            return "waiting for socket", 0
+        if self.state == CONNECTING:
+            return "connecting to server", 0
+        if self.state == SENDING:
+            return "sending request", 0
         Assert(self.state == META)
+        self.raise_error()
 
         sock = self.h._conn.sock
         try:
@@ -196,8 +678,12 @@ class http_access:
         try:
             new = sock.recv(1024)
         except socket.error, msg:
+            if self.reused and not self.readahead:
+                return self.resend()
             raise IOError, msg, sys.exc_traceback
         if not new:
+            if self.reused and not self.readahead:
+                return self.resend()
             return "EOF in server response", 1
         self.readahead = self.readahead + new
         if '\n' not in new:
@@ -215,42 +701,234 @@ class http_access:
             return "received server response", 1
         return "receiving server response", 0
 
+    def resend(self):
+        """Repeat the request on a new connection.
+
+        Used when a reused connection turns out to have been closed by
+        the server before it saw our request.  The request goes out on
+        another idle connection or a new one, like the first time, and
+        the readers are started again to watch it instead.
+        """
+        self.h.close()
+        host, selector, method, params, data, auth = self.request
+        try:
+            self.send_request(host, selector, method, params, data, auth,
+                              get_pool(self.app).checkout(self.pool_key))
+        except socket.error, msg:
+            raise IOError, msg, sys.exc_traceback
+        # fileno() is -1 until the request is out, so this gets the
+        # readers off the old connection; sent() starts them again
+        self.unstarted = []
+        for reader_start, reader_callback in self.readers:
+            self.unstarted.append(reader_start)
+            reader_start()
+        try:
+            self.watch()
+        except socket.error, msg:
+            raise IOError, msg, sys.exc_traceback
+        return self.pollmeta()
+
     def getmeta(self):
+        if self.state in (CONNECTING, SENDING):
+            self.pollmeta(None)
         Assert(self.state == META)
+        self.raise_error()
         if not self.readahead:
             x, y = self.pollmeta(None)
             while not y:
                 x, y = self.pollmeta(None)
-        file = StringIO.StringIO(self.readahead)
-        errcode, errmsg, headers = self.h.getreply(file)
+        while 1:
+            file = StringIO.StringIO(self.readahead)
+            version = self.readahead[:8]
+            errcode, errmsg, headers = self.h.getreply(file)
+            self.readahead = file.read()
+            if not 100 <= errcode < 200:
+                break
+            # an interim response: the real one follows
+            self.line1seen = 0
+            while not endofheaders.search(self.readahead):
+                x, y = self.pollmeta(None)
+                if y and not endofheaders.search(self.readahead):
+                    raise IOError, x
         self.state = DATA
-        self.readahead = file.read()
+        self.set_framing(version, errcode, headers)
         return errcode, errmsg, headers
 
+    def set_framing(self, version, errcode, headers):
+        """Set up the framer for the body and decide whether we may
+        reuse the connection afterwards."""
+        method = self.args[1]
+        self.body = BodyBuffer()
+        framing = Reader.get_framing(version, method, errcode, headers)
+        self.framer = Reader.wrap_parser(self.body, '', framing=framing)
+        keepalive = 0
+        if hasattr(headers, 'getheader'):
+            connection = string.lower(headers.getheader('connection') or '')
+            if version == 'HTTP/1.1':
+                keepalive = string.find(connection, 'close') < 0
+            else:
+                keepalive = string.find(connection, 'keep-alive') >= 0
+        self.reusable = keepalive \
+                        and not isinstance(self.framer, Reader.CloseFramer)
+        data = self.readahead
+        self.readahead = ''
+        if data:
+            self.framer.feed(data)
+        if len(self.body) or self.framer.done:
+            self.wake_readers(self.readers)
+
     def polldata(self):
+        if self.state in (DONE, CLOS):
+            return "done", 1
         Assert(self.state == DATA)
-        if self.readahead:
+        if len(self.body) or self.framer.done:
             return "processing readahead data", 1
         return ("waiting for data",
                 len(select.select([self], [], [], 0)[0]))
 
     def getdata(self, maxbytes):
+        if self.state in (DONE, CLOS):
+            # the body ended with the last call
+            return ''
         Assert(self.state == DATA)
-        if self.readahead:
-            data = self.readahead[:maxbytes]
-            self.readahead = self.readahead[maxbytes:]
-            return data
-        try:
-            data = self.h._conn.sock.recv(maxbytes)
-        except socket.error, msg:
-            raise IOError, msg, sys.exc_traceback
-        if not data:
-            self.state = DONE
-            # self.close()
+        # a recv() may yield only framing, e.g. a chunk size line, so
+        # keep reading until there is some body or the body is over
+        while not len(self.body) and not self.framer.done:
+            try:
+                data = self.h._conn.sock.recv(maxbytes)
+            except socket.error, msg:
+                raise IOError, msg, sys.exc_traceback
+            if data:
+                self.framer.feed(data)
+            else:
+                self.framer.close()
+        data = self.body.read(maxbytes)
+        readers = self.readers
+        if self.framer.done and not len(self.body):
+            # on a kept-alive connection nothing more arrives to make
+            # the socket readable, so give it up now
+            self.finish()
+        if data and (len(self.body) or self.framer.done):
+            # have the readers call again for what is read already
+            self.wake_readers(readers)
         return data
 
-    def fileno(self):
-        return self.h._conn.sock.fileno()
-
+    def finish(self):
+        """The whole body has been read; give back the connection."""
+        self.state = DONE
+        if self.framer.truncated or self.framer.extra:
+            # closed early, or more than the body; don't trust
+            # this connection again
+            self.reusable = 0
+        self.close()
+
+    def wake_readers(self, readers):
+        # for body data that doesn't make the socket readable
+        for reader_start, reader_callback in readers:
+            if reader_callback:
+                try:
+                    self.app.root.after_idle(reader_callback)
+                except AttributeError:
+                    # no event loop; the caller polls
+                    pass
+
+    def raise_error(self):
+        error = self.error
+        if error:
+            self.error = None
+            raise IOError, error[1], error[2]
 
-# To test this, use ProtocolAPI.test()
+    def fileno(self):
+        # for the readers, so not while we are connecting or sending
+        if self.state in (META, DATA, DONE) and self.h and self.h._conn.sock:
+            return self.h._conn.sock.fileno()
+        return -1
+
+
+def test():
+    """Load from a local keep-alive server and reuse the connection.
+
+    Needs the Grail application (see grailutil.get_grailapp()); the
+    responses have a Content-Length and a chunked body, and the server
+    never closes the connection, so the body has to end without an end
+    of file.  Last a cached copy is revalidated, and the connection
+    must outlive the 304 too.
+    """
+    import threading
+    import Cache
+    app = grailutil.get_grailapp()
+    body = "Hello, world!\n" * 100
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    def serve(server=server, body=body):
+        conn, addr = server.accept()
+        file = conn.makefile('rb')
+        responses = [
+            "HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s"
+            % (len(body), body),
+            "HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+            "%x\r\n%s\r\n0\r\n\r\n" % (len(body), body),
+            "HTTP/1.1 304 Not Modified\r\n\r\n",
+            ]
+        for response in responses:
+            while string.strip(file.readline()):
+                pass
+            conn.send(response)
+        # keep the connection open until the client is done
+        file.readline()
+        conn.close()
+    thread = threading.Thread(target=serve)
+    thread.setDaemon(1)
+    thread.start()
+    url = "//127.0.0.1:%d/" % server.getsockname()[1]
+    woken = []
+    for i in range(2):
+        api = http_access(url, 'GET', {})
+        api.register_reader(lambda: None, lambda woken=woken: woken.append(1))
+        while api.state == WAIT:
+            app.root.update()
+        errcode, errmsg, headers = api.getmeta()
+        Assert(errcode == 200)
+        Assert(api.reused == i)
+        data = ''
+        while api.state == DATA:
+            if not api.polldata()[1]:
+                select.select([api], [], [], 10)
+            app.root.update()
+            del woken[:]
+            data = data + api.getdata(512)
+        # the call that returned the last byte gave up the connection
+        Assert(data == body)
+        Assert(api.state == CLOS)
+        Assert(get_pool(app).idle.has_key(api.pool_key))
+        Assert(api.getdata(512) == '')
+        api.close()
+        # the reader is called back for the ''
+        app.root.update()
+        Assert(woken)
+    class CachedCopy:
+        state = DONE
+        def getmeta(self, body=body):
+            return 200, "OK", {'content-length': str(len(body))}
+        def close(self):
+            pass
+    class Date:
+        def get_str(self):
+            return "Sat, 01 Jan 2000 00:00:00 GMT"
+    item = Cache.SharedItem("http:" + url, 'GET', {}, None, url,
+                            api=CachedCopy(), refresh=Date())
+    api = item.api
+    while not item.pollmeta()[1]:
+        app.root.update()
+    Assert(item.getmeta()[0] == 200)
+    Assert(api.reused)
+    Assert(api.state == CLOS)
+    Assert(get_pool(app).idle.has_key(api.pool_key))
+    # let the server go
+    get_pool(app).reclaim()
+    server.close()
+    print "keep-alive test passed"
+
+
+# To test this, use ProtocolAPI.test(); test() checks keep-alive.
@@ -0,0 +1,94 @@
+"""Append-only buffer of string chunks with fast reads at any offset.
+
+A ChunkBuffer keeps the chunks it is given as they are and a sorted
+list of their starting offsets.  read(offset, maxbytes) finds the
+chunk holding offset by bisection, so reading at an offset that does
+not line up with a chunk boundary costs O(log n) in the number of
+chunks instead of a scan.
+"""
+
+__version__ = "$Revision: 1.1 $"
+
+from bisect import bisect_right
+
+
+class ChunkBuffer:
+    """Append-only sequence of bytes stored as a list of chunks.
+
+    append(data) -- add data at the end
+    read(offset, maxbytes) -- return at most maxbytes starting at offset,
+                              never extending past the end of one chunk;
+                              '' at or beyond the end
+    chunks() -- the list of chunks, e.g. for file.writelines()
+
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.__chunks = []
+        self.__offsets = []
+        self.__length = 0
+
+    def __len__(self):
+        return self.__length
+
+    def __repr__(self):
+        return "<ChunkBuffer: %d bytes in %d chunks>" % (
+            self.__length, len(self.__chunks))
+
+    def append(self, data):
+        if data:
+            self.__chunks.append(data)
+            self.__offsets.append(self.__length)
+            self.__length = self.__length + len(data)
+
+    def read(self, offset, maxbytes):
+        if offset >= self.__length or offset < 0:
+            return ''
+        i = bisect_right(self.__offsets, offset) - 1
+        chunk = self.__chunks[i]
+        delta = offset - self.__offsets[i]
+        if delta == 0 and len(chunk) <= maxbytes:
+            # the common case: a reader in step with the chunks
+            return chunk
+        return chunk[delta:delta+maxbytes]
+
+    def chunks(self):
+        return self.__chunks
+
+
+def test():
+    """Compare reads at random offsets against a plain string."""
+    import random
+    import string
+    buf = ChunkBuffer()
+    whole = ''
+    for i in range(500):
+        data = chr(ord('a') + i % 26) * random.randint(0, 100)
+        buf.append(data)
+        whole = whole + data
+    assert len(buf) == len(whole)
+    for i in range(5000):
+        offset = random.randint(0, len(whole) + 10)
+        maxbytes = random.randint(1, 300)
+        data = buf.read(offset, maxbytes)
+        assert 0 < len(data) <= maxbytes or offset >= len(whole)
+        assert data == whole[offset:offset+len(data)]
+    # reading chunk by chunk rebuilds the whole buffer
+    offset = 0
+    parts = []
+    while 1:
+        data = buf.read(offset, 37)
+        if not data:
+            break
+        parts.append(data)
+        offset = offset + len(data)
+    assert string.join(parts, '') == whole
+    assert string.join(buf.chunks(), '') == whole
+    print "ChunkBuffer tests passed."
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,145 @@
+"""Priority queue of keys ordered by expiration time.
+
+An ExpiryQueue maps keys to expiration times (seconds since the epoch)
+and hands back the expired ones in order.  add() and pop_expired() are
+logarithmic; remove() is constant time because removed or re-added
+keys are left in the heap and skipped when they reach the top.  The
+heap is rebuilt when such stale entries outnumber the live ones.
+"""
+
+__version__ = "$Revision: 1.1 $"
+
+import heapq
+
+
+class ExpiryQueue:
+    """Keys ordered by expiration time.
+
+    add(key, when) -- schedule key to expire at when, replacing any
+                      earlier schedule for it
+    remove(key) -- forget key; does nothing if it is not queued
+    pop_expired(now) -- remove and return the keys expiring before now,
+                        soonest first
+    next_expiry() -- the soonest expiration time, or None if empty
+    first() -- the key expiring soonest, or None if empty
+
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.__heap = []
+        self.__when = {}
+
+    def __len__(self):
+        return len(self.__when)
+
+    def __repr__(self):
+        return "ExpiryQueue(%d keys)" % len(self.__when)
+
+    def has_key(self, key):
+        return self.__when.has_key(key)
+
+    __contains__ = has_key
+
+    def get(self, key, default=None):
+        return self.__when.get(key, default)
+
+    def add(self, key, when):
+        self.__when[key] = when
+        heapq.heappush(self.__heap, (when, key))
+        if len(self.__heap) > 2 * len(self.__when) + 16:
+            self.__rebuild()
+
+    def remove(self, key):
+        if self.__when.has_key(key):
+            del self.__when[key]
+
+    def next_expiry(self):
+        self.__skip_stale()
+        if self.__heap:
+            return self.__heap[0][0]
+        return None
+
+    def first(self):
+        self.__skip_stale()
+        if self.__heap:
+            return self.__heap[0][1]
+        return None
+
+    def pop_expired(self, now):
+        keys = []
+        heap = self.__heap
+        whens = self.__when
+        while heap and heap[0][0] < now:
+            when, key = heapq.heappop(heap)
+            if whens.get(key) == when:
+                del whens[key]
+                keys.append(key)
+        return keys
+
+    def __skip_stale(self):
+        heap = self.__heap
+        whens = self.__when
+        while heap and whens.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+
+    def __rebuild(self):
+        heap = []
+        for key, when in self.__when.items():
+            heap.append((when, key))
+        heapq.heapify(heap)
+        self.__heap = heap
+
+
+def test():
+    """Check the eviction invariants against a plain dictionary."""
+    import random
+    q = ExpiryQueue()
+    model = {}
+    now = 0
+    for i in range(20000):
+        key = random.randint(0, 200)
+        op = random.randint(0, 3)
+        if op == 0:
+            when = now + random.randint(1, 100)
+            q.add(key, when)
+            model[key] = when
+        elif op == 1:
+            q.remove(key)
+            if model.has_key(key):
+                del model[key]
+        elif op == 2:
+            now = now + random.randint(0, 10)
+            expired = q.pop_expired(now)
+            # exactly the keys due before now, soonest first, never a
+            # removed key and never an outdated schedule
+            due = {}
+            for k, when in model.items():
+                if when < now:
+                    due[k] = when
+                    del model[k]
+            assert len(expired) == len(due), (expired, due)
+            last = None
+            for k in expired:
+                assert due.has_key(k)
+                assert last is None or due[k] >= last
+                last = due[k]
+        else:
+            soonest = None
+            if model:
+                soonest = min(model.values())
+            assert q.next_expiry() == soonest
+            if model:
+                assert model[q.first()] == soonest
+        assert len(q) == len(model)
+        for k, when in model.items():
+            assert q.get(k) == when
+        # stale entries must not accumulate without bound
+        assert len(q._ExpiryQueue__heap) <= 2 * len(model) + 17
+    print "ExpiryQueue tests passed."
+
+
+if __name__ == '__main__':
+    test()
@@ -13,6 +13,13 @@ from sgml.utils import *
 from printing.utils import conv_fontsize
 
 
+# Priorities for the '.priority' request parameter, which decides the
+# order in which waiting requests get a socket; lower goes first.
+PRIORITY_DOCUMENT = 0                   # the page being shown
+PRIORITY_INLINE = 1                     # images and applets on it
+PRIORITY_BACKGROUND = 2                 # anything nobody waits for
+
+
 # This is here for compatibility with pre-1.5.2 Python versions.
 try:
     abspath = os.path.abspath
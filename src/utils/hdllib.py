@@ -16,6 +16,8 @@ Classes:
 - PacketUnpacker -- helper for packet unpacking
 - SessionTag -- helper for session tag management
 - HashTable -- hash table
+- Request -- a request sent to handle servers, and its reply
+- TCPReader -- helper for a request sent over TCP
 
 TO DO, doubts, questions:
 
@@ -23,8 +25,6 @@ XXX Constants should only have a prefix 'HP_' or 'HDL_' when their
     name occurs in the spec.  I've tried to fix this but may have
     missed some cases.
 
-XXX Should break up get_data in send_request and poll_request.
-
 XXX When retrying, should we generate a new tag or reuse the old one?
 I think yes, but this means repacking the request.
 
@@ -56,6 +56,7 @@ I think yes, but this means repacking the request.
 # this would be a tremendous increase for handle resolution.
 
 import whrandom
+import errno
 import md5
 import os
 import select
@@ -83,6 +84,13 @@ DEFAULT_HASH_FILE = '/usr/local/etc/hdl_hash.tbl'
 DEFAULT_UDP_PORT = 2222
 DEFAULT_TCP_PORT = 2222
 DEFAULT_ADMIN_PORT = 80                 # Admin protocol uses HTTP now
+
+# Choosing servers and transports
+UNKNOWN_RTT = 1.0                       # assumed for servers not yet heard
+RTT_GAIN = 0.125                        # weight of a new round trip time
+MAX_DATAGRAMS = 4                       # longer replies are also read by TCP
+MAX_TCP_BODY_LENGTH = 64*1024
+TCP_POLL_INTERVAL = 0.1                 # seconds
 FILE_NAME_LENGTH = 128
 HOST_NAME_LENGTH = 64
 MAX_BODY_LENGTH = 1024
@@ -176,6 +184,11 @@ for key, value in error_map.items():
 # Error code set by the parser
 HDL_ERR_INTERNAL_ERROR = HP_INTERNAL_ERROR
 
+# Error replies that hold for every server; any other error only
+# rules out the server that sent it
+FATAL_ERRORS = (HP_HANDLE_NOT_FOUND, HP_HANDLE_DOES_NOT_EXIST,
+                HP_TYPES_NOT_FOUND)
+
 
 # error class for this module
 class Error:
@@ -471,8 +484,12 @@ class HashTable:
     - __init__([filename, [debug, [server, [data]]]]) -- constructor
     - set_debuglevel(debug) -- set debug level
     - hash_handle(hdl) -- hash a handle to handle server info
+    - get_servers(hdl) -- the servers of a handle's bucket
+    - choose_servers(hdl, [fanout]) -- the fastest of those
     - get_data(hdl, [types, [flags, [timeout, [interval]]]]]) --
       resolve a handle
+    - send_request(hdl, [types, [flags, [timeout, [interval]]]]]) --
+      start resolving a handle; returns a Request
 
     """ 
     def __init__(self, filename=None, debug=None, server=None, data=None):
@@ -513,6 +530,7 @@ class HashTable:
         self.tag = SessionTag()
 
         self.bucket_cache = {}
+        self.slots = {}                 # bucket tuples by slot number
 
         if data:
             self._parse_hash_table(data)
@@ -591,6 +609,8 @@ class HashTable:
         # In the _parse_hash_table function, only the primary servers
         # are placed in the bucket cache. Therefore, the library does
         # not take advantage of mirroring handle servers.
+        # [get_servers() now follows the secondary slot numbers, as
+        # far as they name slots parsed here.]
 
         # Verify the checksum before proceeding
         checksum = data[:16]
@@ -668,6 +688,7 @@ class HashTable:
         result = (slot_no, weight, ipaddr, udp_query_port,
                   tcp_query_port, admin_port, secondary_slot_no)
         self.bucket_cache[index] = result
+        self.slots[slot_no] = result
 
 
     def set_debuglevel(self, debug):
@@ -731,15 +752,56 @@ class HashTable:
         raise Error("no bucket found with index %d" % index)
 
 
+    def get_servers(self, hdl):
+        """Return the servers of a handle's bucket.
+
+        The result is a list of bucket tuples as returned by
+        hash_handle(): the bucket's own server followed by the
+        mirrors named by the secondary slot numbers.
+
+        """
+        bucket = self.hash_handle(hdl)
+        servers = [bucket]
+        slot2 = bucket[6]
+        while slot2 >= 0 and self.slots.has_key(slot2):
+            bucket = self.slots[slot2]
+            if bucket in servers:
+                break
+            servers.append(bucket)
+            slot2 = bucket[6]
+        return servers
+
+
+    def choose_servers(self, hdl, fanout=1):
+        """Return the FANOUT servers to send a handle's request to.
+
+        The servers of the bucket are ordered by the round trip times
+        measured so far (see get_rtt()), then by weight.
+
+        """
+        ranked = []
+        for bucket in self.get_servers(hdl):
+            rtt = get_rtt((bucket[2], bucket[3]))
+            if rtt is None:
+                rtt = UNKNOWN_RTT
+            ranked.append((rtt, -bucket[1], bucket))
+        ranked.sort()
+        return map(lambda t: t[2], ranked[:max(fanout, 1)])
+
+
     def get_data(self, hdl, types=[], flags=[], timeout=30, interval=5,
-                 command=HP_QUERY, response=HP_QUERY_RESPONSE):
+                 command=HP_QUERY, response=HP_QUERY_RESPONSE, fanout=1):
         """Get data for HANDLE of the handle server.
 
         Optional arguments are a list of desired TYPES, a list of
         FLAGS, a maximum TIMEOUT in seconds (default 30 seconds), a
         retry INTERVAL (default 5 seconds), a COMMAND code (default
-        HP_QUERY) and an expected RESPONSE code (default
-        HP_QUERY_RESPONSE).
+        HP_QUERY), an expected RESPONSE code (default
+        HP_QUERY_RESPONSE) and the number of servers of the bucket to
+        ask at once, FANOUT (default 1).
+
+        This blocks until the reply is complete; see send_request()
+        for a request that doesn't.
 
         Exceptions:
 
@@ -747,103 +809,310 @@ class HashTable:
         - socket.error
         - whatever xdrlib raises
 
+        """
+        request = self.send_request(hdl, types, flags, timeout, interval,
+                                    command, response, fanout=fanout)
+        try:
+            while not request.poll():
+                request.wait()
+            return request.get_reply()
+        finally:
+            request.close()
+
+
+    def send_request(self, hdl, types=[], flags=[], timeout=30, interval=5,
+                     command=HP_QUERY, response=HP_QUERY_RESPONSE,
+                     sock=None, fanout=1):
+        """Send a request for HANDLE to its handle servers.
+
+        The arguments are those of get_data(), plus an optional UDP
+        socket SOCK to use instead of a new one.  Return a Request;
+        its poll() method collects the reply without blocking.
+
         """
 
         # XXX Charles says:
         # In get_data function, it always makes a UDP connection. This
         # may not be the case for systems behind firewalls.
 
-        mytag = self.tag.session_tag()
+        servers = []
+        tags = []
+        for bucket in self.choose_servers(hdl, fanout):
+            servers.append((bucket[2], bucket[3], bucket[4]))
+            tags.append(self.tag.session_tag())
+        return Request(tags, hdl, types, flags, servers, timeout, interval,
+                       command, response, sock, self.debug)
 
-        p = PacketPacker()
-        p.pack_header(mytag, command=command)
-        p.pack_body(hdl, flags, types)
-        request = p.get_buffer()
 
-        (server, qport) = self.hash_handle(hdl)[2:4]
 
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        if self.debug: print "Send request"
-        s.sendto(request, (server, qport))
-
-        expected = 1
-        responses = {}
-        endtime = time.time() + timeout
+# Round trip times of the servers, shared by all hash tables
+_rtts = {}
 
-        while len(responses) != expected:
+def get_rtt(address):
+    """Return the smoothed round trip time to a server, or None.
 
-            t = time.time()
-            if t > endtime:
-                raise Error("timed out")
-                break
+    ADDRESS is an (ipaddr, udp port) tuple.
 
-            (readers, writers, extras) = select.select(
-                    [s], [], [], min(endtime-t, interval))
+    """
+    return _rtts.get(address)
 
-            if s not in readers:
-                if self.debug: print "Nothing received yet..."
-                t = time.time()
-                if t+interval < endtime:
-                    if self.debug: print "Resend request"
-                    s.sendto(request, (server, qport))
-                continue
+def record_rtt(address, rtt):
+    """Add a round trip time measured for a server to its average."""
+    if _rtts.has_key(address):
+        old = _rtts[address]
+        rtt = old + (rtt - old) * RTT_GAIN
+    _rtts[address] = rtt
 
-            reply, fromaddr = s.recvfrom(1024)
-            u = PacketUnpacker(reply, self.debug)
-            (tag, rcommand, err, sequence, total, version) = \
-                  u.unpack_header()
 
-            if self.debug:
-                print '-'*20
-                print "Reply header:"
-                print "Version:       ", version
-                print "Session tag:   ", tag
-                print "Command:       ", rcommand
-                print "Sequence#:     ", sequence
-                print "#Datagrams:    ", total
-                print "Error code:    ", err,
-                if error_map.has_key(err):
-                    print "(%s)" % error_map[err],
-                print
-                print '-'*20
 
-            if tag != mytag:
-                if self.debug: print "bad session tag"
-                continue
+class Request:
+    """A handle request sent to handle servers, and its reply.
 
-            if rcommand != response:
-                if self.debug: print "bad reply type"
-                continue
+    The request is sent to each server in a list at once (with a
+    session tag of its own), and the first server whose reply is
+    complete wins.  When a reply is announced to need more than
+    MAX_DATAGRAMS datagrams, the request is also sent to that server
+    over TCP, and the reply read from there if it's complete first.
 
-            if not 1 <= sequence <= total and not err:
-                if self.debug: print "bad sequence number"
-                continue
+    Public methods:
 
-            expected = total
-            
-            if err != HP_OK:
-                if self.debug:
-                    print 'err: ', err
-                err_info = u.unpack_error_body(err)
-                if self.debug:
-                    print 'err_info:', `err_info`
-                try:
-                    err_name = error_map[err]
-                except KeyError:
-                    err_name = str(err)
-                if self.debug:
-                    print 'err_name:', `err`
-                raise Error(err_name, err, err_info)
+    - fileno() -- the UDP socket, readable when a reply datagram
+      has arrived
+    - poll() -- handle the datagrams received so far and resend the
+      request if it is time; return true when the reply is complete
+    - deadline() -- the time by which poll() should be called again
+      even if nothing is received
+    - wait() -- block until a datagram arrives or the deadline passes
+    - get_reply() -- return (flags, items) of the complete reply
+    - close() -- close the sockets, except the one passed in
+
+    poll() raises Error when a server says the handle or its types
+    don't exist (FATAL_ERRORS), when every server has returned some
+    other error, or when the request times out.  While one server
+    may still answer, the errors of the others are only recorded.
 
-            flags, items = u.unpack_reply_body()
+    """
 
-            responses[sequence] = (flags, items)
+    def __init__(self, tags, hdl, types, flags, servers, timeout, interval,
+                 command, response, sock=None, debug=DEBUG):
+        self.debug = debug
+        self.tags = tags
+        self.servers = servers          # (ipaddr, udp port, tcp port)
+        self.interval = interval
+        self.response = response
+
+        self.requests = []
+        for tag in tags:
+            p = PacketPacker()
+            p.pack_header(tag, command=command)
+            p.pack_body(hdl, flags, types)
+            self.requests.append(p.get_buffer())
+
+        self.own_sock = sock is None
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock = sock
+
+        # Replies so far, by server index ('tcp' for the TCP reply)
+        self.expected = {}
+        self.responses = {}
+        self.errors = {}                # by server index, or 'tcp'
+        self.winner = None
+        self.tcp = None                 # TCPReader, while one is active
+        self.resent = 0
+        t = time.time()
+        self.starttime = t
+        self.endtime = t + timeout
+        self.send(t)
+
+    def send(self, t):
+        if self.debug: print "Send request"
+        for i in range(len(self.servers)):
+            ipaddr, udpport = self.servers[i][:2]
+            self.sock.sendto(self.requests[i], (ipaddr, udpport))
+        self.sendtime = t
+        self.resendtime = t + self.interval
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def done(self):
+        if self.winner is None:
+            for key, responses in self.responses.items():
+                if len(responses) == self.expected[key]:
+                    self.winner = key
+                    break
+        return self.winner is not None
+
+    def deadline(self):
+        deadline = min(self.resendtime, self.endtime)
+        if self.tcp:
+            # Not seen by the caller's file handler
+            deadline = min(deadline, time.time() + TCP_POLL_INTERVAL)
+        return deadline
+
+    def wait(self):
+        timeout = max(0, self.deadline() - time.time())
+        readers, writers = [self.sock], []
+        if self.tcp:
+            self.tcp.add_sockets(readers, writers)
+        select.select(readers, writers, [], timeout)
+
+    def poll(self):
+        while not self.done():
+            readers, writers = [self.sock], []
+            if self.tcp:
+                self.tcp.add_sockets(readers, writers)
+            (readers, writers, extras) = select.select(readers, writers,
+                                                       [], 0)
+            if not (readers or writers):
+                break
+            if self.sock in readers:
+                reply, fromaddr = self.sock.recvfrom(1024)
+                self.receive(reply)
+            if self.tcp and (readers or writers):
+                self.poll_tcp(readers, writers)
+        if self.done():
+            return 1
+        t = time.time()
+        if t >= self.endtime:
+            for i in range(len(self.servers)):
+                if self.errors.has_key(i):
+                    # more telling than the timeout
+                    raise self.errors[i]
+            raise Error("timed out")
+        if t >= self.resendtime:
+            if t+self.interval < self.endtime:
+                if self.debug: print "Resend request"
+                self.resent = 1
+                self.send(t)
+            else:
+                self.resendtime = self.endtime
+        elif self.debug:
+            print "Nothing received yet..."
+        return 0
 
-        s.close()
+    def poll_tcp(self, readers, writers):
+        tcp = self.tcp
+        try:
+            packets = tcp.poll(readers, writers)
+        except (socket.error, Error), msg:
+            if self.debug: print "TCP error:", msg
+            self.close_tcp()
+            return
+        for packet in packets:
+            self.receive(packet, 'tcp')
+            if self.done() or self.errors.has_key('tcp'):
+                break
+        if self.errors.has_key('tcp'):
+            if self.debug: print "TCP error reply"
+            self.close_tcp()
+            return
+        if tcp.eof and not self.done():
+            if self.debug: print "TCP reply incomplete"
+            self.close_tcp()
+
+    def receive(self, reply, key=None):
+        u = PacketUnpacker(reply, self.debug)
+        (tag, rcommand, err, sequence, total, version) = \
+              u.unpack_header()
 
+        if self.debug:
+            print '-'*20
+            print "Reply header:"
+            print "Version:       ", version
+            print "Session tag:   ", tag
+            print "Command:       ", rcommand
+            print "Sequence#:     ", sequence
+            print "#Datagrams:    ", total
+            print "Error code:    ", err,
+            if error_map.has_key(err):
+                print "(%s)" % error_map[err],
+            print
+            print '-'*20
+
+        if tag not in self.tags:
+            if self.debug: print "bad session tag"
+            return
+        index = self.tags.index(tag)
+        if key is None:
+            key = index
+
+        if rcommand != self.response:
+            if self.debug: print "bad reply type"
+            return
+
+        if not 1 <= sequence <= total and not err:
+            if self.debug: print "bad sequence number"
+            return
+
+        if not self.responses.has_key(key):
+            self.responses[key] = {}
+            if key == index and not self.resent:
+                # Karn: a resent request's replies are ambiguous
+                record_rtt(self.servers[index][:2],
+                           time.time() - self.sendtime)
+
+        if err != HP_OK:
+            if self.debug:
+                print 'err: ', err
+            err_info = u.unpack_error_body(err)
+            if self.debug:
+                print 'err_info:', `err_info`
+            try:
+                err_name = error_map[err]
+            except KeyError:
+                err_name = str(err)
+            if self.debug:
+                print 'err_name:', `err`
+            error = Error(err_name, err, err_info)
+            if err in FATAL_ERRORS:
+                raise error
+            # another server may still answer
+            self.errors[key] = error
+            del self.responses[key]
+            if self.expected.has_key(key):
+                del self.expected[key]
+            for i in range(len(self.servers)):
+                if not self.errors.has_key(i):
+                    return
+            raise error
+
+        if self.errors.has_key(key):
+            # e.g. no longer busy when the request was resent
+            del self.errors[key]
+        self.expected[key] = total
+        flags, items = u.unpack_reply_body()
+
+        self.responses[key][sequence] = (flags, items)
+
+        if total > MAX_DATAGRAMS and key == index and not self.tcp \
+           and not self.responses.has_key('tcp'):
+            self.start_tcp(index)
+
+    def start_tcp(self, index):
+        ipaddr, udpport, tcpport = self.servers[index]
+        if tcpport <= 0:
+            return
+        if self.debug: print "Send request over TCP to", ipaddr, tcpport
+        try:
+            self.tcp = TCPReader((ipaddr, tcpport), self.requests[index])
+        except socket.error, msg:
+            if self.debug: print "TCP error:", msg
+
+    def close_tcp(self):
+        tcp = self.tcp
+        self.tcp = None
+        if self.responses.has_key('tcp') and self.winner != 'tcp':
+            del self.responses['tcp']
+        if tcp:
+            tcp.close()
+
+    def get_reply(self):
         allflags = None
         allitems = []
-        for i in range(1, expected+1):
+        responses = self.responses[self.winner]
+        for i in range(1, self.expected[self.winner]+1):
             if responses.has_key(i):
                 (flags, items) = responses[i]
                 item = items[0]
@@ -867,8 +1136,86 @@ class HashTable:
                     allitems = allitems + items
         return (allflags, allitems)
 
+    def close(self):
+        if self.sock and self.resent:
+            # Charge the servers that never answered for the wait
+            elapsed = time.time() - self.starttime
+            for i in range(len(self.servers)):
+                if not self.responses.has_key(i):
+                    record_rtt(self.servers[i][:2], elapsed)
+        self.close_tcp()
+        sock = self.sock
+        self.sock = None
+        if sock and self.own_sock:
+            sock.close()
+
+
+
+class TCPReader:
+    """A request sent over TCP, and the packets of its reply.
+
+    The connection is made without blocking.  A TCP reply is the
+    same sequence of packets as a UDP one, each delimited by the body
+    length in its header.
+
+    """
+
+    def __init__(self, address, request):
+        self.outbuf = request
+        self.inbuf = ''
+        self.connected = 0
+        self.eof = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(0)
+        err = self.sock.connect_ex(address)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self.sock.close()
+            raise socket.error, (err, os.strerror(err))
+
+    def add_sockets(self, readers, writers):
+        if self.outbuf:
+            writers.append(self.sock)
+        else:
+            readers.append(self.sock)
+
+    def poll(self, readers, writers):
+        """Make progress; return the packets received completely."""
+        if self.sock in writers:
+            if not self.connected:
+                err = self.sock.getsockopt(socket.SOL_SOCKET,
+                                           socket.SO_ERROR)
+                if err:
+                    raise socket.error, (err, os.strerror(err))
+                self.connected = 1
+            n = self.sock.send(self.outbuf)
+            self.outbuf = self.outbuf[n:]
+        packets = []
+        if self.sock in readers:
+            data = self.sock.recv(8*1024)
+            if not data:
+                self.eof = 1
+            self.inbuf = self.inbuf + data
+            while len(self.inbuf) >= HP_HEADER_LENGTH:
+                u = xdrlib.Unpacker(self.inbuf[HP_HEADER_LENGTH-4:
+                                               HP_HEADER_LENGTH])
+                length = u.unpack_uint()
+                if length > MAX_TCP_BODY_LENGTH:
+                    raise Error("TCP reply too long")
+                size = HP_HEADER_LENGTH + length
+                if len(self.inbuf) < size:
+                    break
+                packets.append(self.inbuf[:size])
+                self.inbuf = self.inbuf[size:]
+        return packets
+
+    def close(self):
+        sock = self.sock
+        self.sock = None
+        if sock:
+            sock.close()
+
+
 
-
 def hexstr(s):
     """Convert a string to hexadecimal."""
     return "%02x"*len(s) % tuple(map(ord, s))
@@ -907,18 +1254,41 @@ def fetch_local_hash_table(hdl, ht=None, debug=DEBUG):
     # System for the service handle.
 
     if debug: print "Fetching local hash table for", `hdl`
-    # 1. Get the authority name
-    hdl = get_authority(hdl)
-    # 2. Prefix the "ha.auth/" authority
-    hdl = "ha.auth/" + hdl
+    # 1. Get the authority's "ha.auth/" handle
+    hdl = local_hash_table_handle(hdl)
     if debug: print "Requesting handle", `hdl`
-    # 3. Create a HashTable object if none is provided
+    # 2. Create a HashTable object if none is provided
     if not ht: ht = HashTable(debug=debug)
-    # 4. Send the query and get the reply
-    flags, items = ht.get_data(hdl,
-                               types=[HDL_TYPE_SERVICE_POINTER,
-                                      HDL_TYPE_SERVICE_HANDLE])
-    # 5. Inspect the result
+    # 3. Send the query and get the reply
+    flags, items = ht.get_data(hdl, types=SERVICE_TYPES)
+    # 4. Inspect the result
+    hashtable, handle = parse_service_items(items, debug)
+    if not hashtable and handle:
+        flags, items = ht.get_data(handle,
+                               types=[HDL_TYPE_SERVICE_POINTER])
+        hashtable, handle = parse_service_items(items, debug)
+    if hashtable:
+        return HashTable(data=hashtable, debug=debug)
+
+    raise Error("Didn't get a hash table")
+
+
+# Types to request for the handle of a local hash table
+SERVICE_TYPES = [HDL_TYPE_SERVICE_POINTER, HDL_TYPE_SERVICE_HANDLE]
+
+def local_hash_table_handle(hdl):
+    """Return the handle of the local hash table for a handle."""
+    return "ha.auth/" + get_authority(hdl)
+
+
+def parse_service_items(items, debug=DEBUG):
+    """Find a hash table in the items of a reply.
+
+    Return (hashtable, handle): the hash table data of a service
+    pointer, and the service handle under which it can be requested
+    instead; either may be None.
+
+    """
     hashtable = None
     handle = None
     for type, data in items:
@@ -933,29 +1303,10 @@ def fetch_local_hash_table(hdl, ht=None, debug=DEBUG):
                 hashtable = urndata
                 if debug: print "hash table data =", hexstr(hashtable)
             else:
-                raise Error("Unknown SERVICE_ID: %s" % urnscheme)       
+                raise Error("Unknown SERVICE_ID: %s" % urnscheme)
         else:
             if debug: print "type", type, "=", data
-    if hashtable:
-        return HashTable(data=hashtable, debug=debug)
-    elif handle:
-        flags, items = ht.get_data(handle,
-                               types=[HDL_TYPE_SERVICE_POINTER])
-        for type, data in items:
-            if type == HDL_TYPE_SERVICE_POINTER:
-                urnscheme = data[:16]
-                urndata = data[16:]
-                if debug: print "URN scheme =", `urnscheme`
-                if urnscheme == HANDLE_SERVICE_ID:
-                    hashtable = urndata
-                    if debug: print "hash table data =", hexstr(hashtable)
-                    return HashTable(data=hashtable, debug=debug)
-                else:
-                    raise Error("Unknown SERVICE_ID: %s" % urnscheme)
-            else:
-                if debug: print "type", type, "=", data
-
-    raise Error("Didn't get a hash table")
+    return hashtable, handle
 
 
 def get_authority(hdl):
@@ -0,0 +1,132 @@
+"""Ordered set of keys with constant-time recency updates.
+
+An LRUList keeps its keys in least- to most-recently used order.  It
+is a doubly-linked list threaded through two dictionaries (one for
+each direction), so touch(), remove() and oldest() never have to scan
+the list.  The links are stored as keys rather than node objects, so
+there are no reference cycles to clean up.
+"""
+
+__version__ = "$Revision: 1.1 $"
+
+
+class _Head:
+    """Sentinel marking both ends of the list."""
+    pass
+
+_head = _Head()
+
+
+class LRUList:
+    """Keys ordered from least to most recently used.
+
+    touch(key) -- make key the most recently used, adding it if needed
+    remove(key) -- delete key; raises KeyError if it is not present
+    oldest() -- return the least recently used key; IndexError if empty
+    keys() -- return a list of all keys, least recently used first
+
+    """
+
+    def __init__(self, keys=None):
+        self.clear()
+        if keys:
+            for key in keys:
+                self.touch(key)
+
+    def clear(self):
+        self.__next = {_head: _head}
+        self.__prev = {_head: _head}
+
+    def __len__(self):
+        return len(self.__next) - 1
+
+    def __repr__(self):
+        return "LRUList(%s)" % `self.keys()`
+
+    def has_key(self, key):
+        return self.__next.has_key(key)
+
+    __contains__ = has_key
+
+    def touch(self, key):
+        next = self.__next
+        prev = self.__prev
+        if next.has_key(key):
+            # unlink
+            p = prev[key]
+            n = next[key]
+            next[p] = n
+            prev[n] = p
+        # link in just before the head, i.e. at the most recent end
+        last = prev[_head]
+        next[last] = key
+        prev[key] = last
+        next[key] = _head
+        prev[_head] = key
+
+    append = touch
+
+    def remove(self, key):
+        next = self.__next
+        prev = self.__prev
+        n = next[key]
+        p = prev[key]
+        next[p] = n
+        prev[n] = p
+        del next[key]
+        del prev[key]
+
+    def oldest(self):
+        key = self.__next[_head]
+        if key is _head:
+            raise IndexError, "oldest() of empty LRUList"
+        return key
+
+    def newest(self):
+        key = self.__prev[_head]
+        if key is _head:
+            raise IndexError, "newest() of empty LRUList"
+        return key
+
+    def keys(self):
+        next = self.__next
+        keys = []
+        key = next[_head]
+        while key is not _head:
+            keys.append(key)
+            key = next[key]
+        return keys
+
+
+def test():
+    """Check the list invariants against a plain Python list."""
+    import random
+    lru = LRUList()
+    model = []
+    for i in range(5000):
+        key = random.randint(0, 50)
+        op = random.randint(0, 2)
+        if op == 0:
+            lru.touch(key)
+            if key in model:
+                model.remove(key)
+            model.append(key)
+        elif op == 1 and key in model:
+            lru.remove(key)
+            model.remove(key)
+        elif model:
+            assert lru.oldest() == model[0]
+            assert lru.newest() == model[-1]
+        assert len(lru) == len(model)
+    assert lru.keys() == model
+    try:
+        LRUList().oldest()
+    except IndexError:
+        pass
+    else:
+        raise AssertionError, "oldest() of empty list should fail"
+    print "LRUList tests passed."
+
+
+if __name__ == '__main__':
+    test()